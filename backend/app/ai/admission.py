@@ -0,0 +1,234 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Optional, Tuple
+from ..config import (
+    LLM_MAX_IN_FLIGHT,
+    LLM_MAX_QUEUE,
+    LLM_QUEUE_TIMEOUT,
+    LLM_RATE_RPM,
+    LLM_RATE_BURST,
+    LLM_MODEL_RPM,
+)
+
+
+class AdmissionRejected(Exception):
+    """LLM capacity exhausted; the API answers 429 with Retry-After."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class _TokenBucket:
+    def __init__(self, rpm: float, burst: float, now: float):
+        self.rate = rpm / 60.0
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        # The caller's clock: a later reading would make the first take() refill a negative amount
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Take a token; returns 0 on success, otherwise seconds until one is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        if self.rate <= 0:
+            return 60.0
+        return (1 - self.tokens) / self.rate
+
+
+class _Waiter:
+    __slots__ = ("wake", "granted")
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+class AdmissionController:
+    """Process-wide gate in front of every LLM call.
+
+    At most `max_in_flight` logical calls (a chat turn, a document, a diagram)
+    run at once; up to `max_queue` more wait FIFO for at most `queue_timeout`
+    seconds, anything beyond is rejected immediately. Each upstream attempt
+    additionally takes a token from its (provider, model) bucket, so hedges
+    and fallbacks are accounted against the quota of the model they hit.
+    Works from both threads and the event loop.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = LLM_MAX_IN_FLIGHT,
+        max_queue: int = LLM_MAX_QUEUE,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT,
+        default_rpm: float = LLM_RATE_RPM,
+        burst: float = LLM_RATE_BURST,
+        model_rpm: Optional[Dict[str, float]] = None,
+    ):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.default_rpm = default_rpm
+        self.burst = burst
+        self.model_rpm = dict(model_rpm or {})
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters: deque = deque()
+        self._buckets: Dict[Tuple[str, str], _TokenBucket] = {}
+        self._hold = 1.0  # EWMA of slot hold time, for Retry-After
+        self.admitted = 0
+        self.rejected = 0
+        self.rate_limited = 0
+
+    # ── in-flight slots ──────────────────────────────────────────────
+
+    @contextmanager
+    def slot(self):
+        started = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(started)
+
+    @asynccontextmanager
+    async def slot_async(self):
+        started = await self.acquire_async()
+        try:
+            yield
+        finally:
+            self.release(started)
+
+    def acquire(self) -> float:
+        event = threading.Event()
+        waiter = self._enter(event.set)
+        if waiter is None:
+            return time.monotonic()
+        if event.wait(self.queue_timeout):
+            return time.monotonic()
+        return self._give_up(waiter)
+
+    async def acquire_async(self) -> float:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enter(wake)
+        if waiter is None:
+            return time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+            return time.monotonic()
+        except asyncio.TimeoutError:
+            return self._give_up(waiter)
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    granted = True
+                else:
+                    granted = False
+                    self._waiters.remove(waiter)
+            if granted:
+                self.release(None)
+            raise
+
+    def release(self, started: Optional[float]):
+        with self._lock:
+            if started is not None:
+                self._hold = 0.2 * (time.monotonic() - started) + 0.8 * self._hold
+            if self._waiters:
+                # Hand the slot straight to the oldest waiter
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                self.admitted += 1
+                waiter.wake()
+                return
+            self._in_flight -= 1
+
+    def _enter(self, wake) -> Optional[_Waiter]:
+        with self._lock:
+            if self._in_flight < self.max_in_flight and not self._waiters:
+                self._in_flight += 1
+                self.admitted += 1
+                return None
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                raise AdmissionRejected("LLM capacity exhausted, try again later", self._retry_after_locked())
+            waiter = _Waiter(wake)
+            self._waiters.append(waiter)
+            return waiter
+
+    def _give_up(self, waiter: _Waiter) -> float:
+        with self._lock:
+            if waiter.granted:
+                # Slot arrived just as the wait timed out
+                return time.monotonic()
+            self._waiters.remove(waiter)
+            self.rejected += 1
+            retry_after = self._retry_after_locked()
+        raise AdmissionRejected("Timed out waiting for LLM capacity", retry_after)
+
+    def _retry_after_locked(self) -> float:
+        return self._hold * (len(self._waiters) + 1) / self.max_in_flight
+
+    # ── per-model rate ───────────────────────────────────────────────
+
+    def try_take(self, provider: str, model: str) -> float:
+        """Take one request token for (provider, model); 0 when granted, else seconds to wait."""
+        key = (provider, model)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _TokenBucket(self.model_rpm.get(model, self.default_rpm), self.burst, now)
+            wait = bucket.take(now)
+            if wait:
+                self.rate_limited += 1
+            return wait
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            buckets = {}
+            for (provider, model), bucket in self._buckets.items():
+                tokens = min(bucket.capacity, bucket.tokens + (now - bucket.updated) * bucket.rate)
+                buckets[f"{provider}:{model}"] = {
+                    "rpm": round(bucket.rate * 60, 2),
+                    "tokens": round(tokens, 2),
+                    "capacity": bucket.capacity,
+                }
+            return {
+                "in_flight": self._in_flight,
+                "max_in_flight": self.max_in_flight,
+                "queued": len(self._waiters),
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "rate_limited": self.rate_limited,
+                "buckets": buckets,
+            }
+
+
+def _parse_model_rpm(spec: str) -> Dict[str, float]:
+    """Parse LLM_MODEL_RPM, e.g. "gemini-2.5-pro=5,gemini-2.0-flash=15", into {model: rpm}."""
+    limits = {}
+    for item in (spec or "").split(","):
+        name, sep, value = item.partition("=")
+        if sep and name.strip():
+            limits[name.strip()] = float(value)
+    return limits
+
+
+admission = AdmissionController(model_rpm=_parse_model_rpm(LLM_MODEL_RPM))
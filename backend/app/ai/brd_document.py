@@ -0,0 +1,309 @@
+import json
+import re
+from typing import List, Optional, Set
+from .generators import _normalize_multiline, default_use_cases, default_user_stories, default_leading_indicators
+
+# A section starts at any line beginning with "##" (### included), like the
+# `(?=\n##|$)` boundaries the regex patcher used; the title skips "3." numbering.
+# One scan finds headings and code fences only: other lines are never visited.
+_SCAN = re.compile(r"^(?:[ ]{0,3}(?P<fence>`{3,}|~{3,})|##+[ \t]*\d*\.?[ \t]*(?P<title>[^\n]*))", re.M)
+_HEADING = re.compile(r"^##+\s*\d*\.?\s*(.*?)\s*$")
+_PLACEHOLDER = re.compile(r"-\s*TBD\s*", re.IGNORECASE)
+_EMPTY_BODIES = ("", "-", "—")
+DIAGRAM_SECTION = "Диаграмма"
+# Titles fill_from_slots patches (lower-cased prefixes)
+_GOAL, _DESCRIPTION = "цель проекта", "описание задачи"
+_SCOPE, _USE_CASES, _STORIES, _LEADING = "scope", "сценарии использования", "пользовательские истории", "leading indicators"
+_KPI, _BUSINESS, _FUNCTIONAL = "kpi", "бизнес-требования", "функциональные требования"
+_PATCHED = (_GOAL, _DESCRIPTION, _SCOPE, _USE_CASES, _STORIES, _LEADING, _KPI, _BUSINESS, _FUNCTIONAL)
+
+# Which slots each section is written from (lower-cased title prefixes of the
+# LLM structure and of the template), for incremental regeneration
+SECTION_SOURCES = [
+    (("цель",), ("goal",)),
+    (("описание", "контекст"), ("description",)),
+    (("scope",), ("scope_in", "scope_out")),
+    (("бизнес-требования", "бизнес-правила"), ("business_requirements", "rules")),
+    (("функциональные требования",), ("functional_requirements",)),
+    (("ограничения",), ("constraints",)),
+    (("приоритеты",), ("priorities",)),
+    (("kpi",), ("kpi",)),
+    (("use case", "сценарии использования"), ("use_cases", "alternative_flows")),
+    (("user stories", "пользовательские истории"), ("user_stories",)),
+    (("leading indicators",), ("leading_indicators", "kpi")),
+    (("диаграмма",), ("process_diagram",)),
+]
+# Only drawn by the diagram stage: a change needs no section when the document has none
+_DIAGRAM_SLOTS = {"process_diagram"}
+# Rewritten from the slots by fill_from_slots anyway: never worth an LLM call
+_MIRRORED = (_STORIES, _LEADING)
+
+
+def _trailing_blank(lines: List[str]) -> List[str]:
+    n = len(lines)
+    while n and not lines[n - 1].strip():
+        n -= 1
+    return lines[n:]
+
+
+def _bullets(items) -> List[str]:
+    return [f"- {x}" for x in items]
+
+
+def _numbered(items) -> List[str]:
+    return [f"{i + 1}. {x}" for i, x in enumerate(items)]
+
+
+class Section:
+    """A `##` heading line and the body up to the next heading.
+
+    The body is kept as the raw text slice (each line prefixed with "\\n") and
+    split into `lines` only when a section is read or patched line by line.
+    """
+
+    __slots__ = ("heading", "title", "_raw")
+
+    def __init__(self, heading: str, title: Optional[str] = None, raw: str = ""):
+        self.heading = heading
+        if title is None:
+            m = _HEADING.match(heading)
+            title = m.group(1) if m else heading
+        self.title = title.strip()
+        self._raw = raw
+
+    @property
+    def level(self) -> int:
+        return len(self.heading) - len(self.heading.lstrip("#"))
+
+    @property
+    def lines(self) -> List[str]:
+        return self._raw[1:].split("\n") if self._raw else []
+
+    @lines.setter
+    def lines(self, lines: List[str]):
+        self._raw = "".join("\n" + line for line in lines)
+
+    def matches(self, name: str) -> bool:
+        """Case-insensitive title prefix match: "KPI" matches "KPI и метрики успеха"."""
+        return self.title.lower().startswith(name.lower())
+
+    @property
+    def body(self) -> str:
+        return self._raw.strip()
+
+    def is_placeholder(self) -> bool:
+        body = self.body
+        return body in _EMPTY_BODIES or bool(_PLACEHOLDER.fullmatch(body))
+
+    def set_body(self, lines: List[str]):
+        """Replace the body, keeping the blank lines that separate it from the next heading."""
+        self.lines = list(lines) + _trailing_blank(self.lines)
+
+    def set_block(self, label: str, lines: List[str], to_end: bool = False) -> bool:
+        """Replace the `label` sub-block (e.g. **Входит**) up to the next `**` line, or the section end."""
+        if label not in self._raw:
+            return False
+        body = self.lines
+        start = next(i for i, line in enumerate(body) if label in line)
+        end = len(body)
+        if not to_end:
+            end = next((j for j in range(start + 1, end) if body[j].startswith("**")), end)
+        head = body[start][:body[start].index(label) + len(label)]
+        body[start:end] = [head] + list(lines) + _trailing_blank(body[start:end])
+        self.lines = body
+        return True
+
+
+class BrdDocument:
+    """BRD Markdown as an ordered list of sections, parsed in one scan of the text.
+
+    Lines before the first section (the `# title`) are the preamble; "##"
+    lines inside fenced code do not start sections. `markdown()` returns the
+    input unchanged until a section is modified, so callers can parse, patch
+    the sections they own and serialize without disturbing the rest.
+    """
+
+    __slots__ = ("preamble", "sections")
+
+    def __init__(self, preamble: Optional[List[str]] = None, sections: Optional[List[Section]] = None):
+        self.preamble = preamble if preamble is not None else []
+        self.sections = sections if sections is not None else []
+
+    @classmethod
+    def parse(cls, text: str) -> "BrdDocument":
+        text = text or ""
+        doc = cls()
+        starts = []  # (offset, heading end, title) of section headings outside code fences
+        fence = None
+        for m in _SCAN.finditer(text):
+            mark = m.group("fence")
+            if mark:
+                if fence is None:
+                    fence = mark
+                elif mark[0] == fence[0] and len(mark) >= len(fence):
+                    fence = None
+            elif fence is None:
+                starts.append((m.start(), m.end(), m.group("title")))
+        if not starts:
+            doc.preamble = text.split("\n")
+            return doc
+        first = starts[0][0]
+        doc.preamble = text[:first - 1].split("\n") if first else []
+        ends = [start - 1 for start, _, _ in starts[1:]] + [len(text)]
+        for (start, head_end, title), end in zip(starts, ends):
+            doc.sections.append(Section(text[start:head_end], title, text[head_end:end]))
+        return doc
+
+    def markdown(self) -> str:
+        parts = ["\n".join(self.preamble)] if self.preamble else []
+        for section in self.sections:
+            if parts:
+                parts.append("\n")
+            parts.append(section.heading)
+            parts.append(section._raw)
+        return "".join(parts)
+
+    def set_title(self, title: str):
+        """Replace the `# title` line of the preamble."""
+        for i, line in enumerate(self.preamble):
+            if line.startswith("# "):
+                self.preamble[i] = f"# {title}"
+                return
+
+    def subtree(self, section: Section) -> List[Section]:
+        """`section` and the deeper sections (### under ##) that follow it."""
+        start = self.sections.index(section)
+        end = start + 1
+        while end < len(self.sections) and self.sections[end].level > section.level:
+            end += 1
+        return self.sections[start:end]
+
+    def section_text(self, section: Section) -> str:
+        return "\n".join(f"{s.heading}{s._raw}" for s in self.subtree(section))
+
+    def replace_section(self, section: Section, lines: List[str]):
+        """New body for `section`; its subsections are replaced too (`lines` may contain ### headings)."""
+        nested = self.subtree(section)[1:]
+        # Keep the blank lines before the next section (they trail the last subsection)
+        section.lines = list(lines) + _trailing_blank((nested[-1] if nested else section).lines)
+        if nested:
+            self.sections = [s for s in self.sections if not any(s is n for n in nested)]
+
+    def find(self, name: str) -> List[Section]:
+        return [s for s in self.sections if s.matches(name)]
+
+    def drop(self, name: str) -> "BrdDocument":
+        self.sections = [s for s in self.sections if not s.matches(name)]
+        return self
+
+    def fill_from_slots(self, slots: dict) -> "BrdDocument":
+        """Fill the sections the LLM left empty (or that must mirror the slots) from the collected slots.
+
+        Goal / description / KPI / requirement lists are filled only when the
+        body is a placeholder ("—", "-", "- TBD" or nothing); scope, use
+        cases, user stories and leading indicators always mirror the slots.
+        """
+        ctx = type("Ctx", (), {"slots": slots})()
+        goal = (slots.get("goal") or "TBD").strip()
+        description = (slots.get("description") or "TBD").strip()
+        scope_in = _normalize_multiline(slots.get("scope_in"))
+        scope_out = _normalize_multiline(slots.get("scope_out"))
+        use_cases = slots.get("use_cases") or default_use_cases(ctx)
+        user_stories = slots.get("user_stories") or default_user_stories(ctx)
+        leading = slots.get("leading_indicators") or default_leading_indicators(ctx)
+        singles = {_GOAL: goal, _DESCRIPTION: description}
+        lists = {
+            _KPI: slots.get("kpi") or [],
+            _BUSINESS: slots.get("business_requirements") or [],
+            _FUNCTIONAL: slots.get("functional_requirements") or [],
+        }
+        alternative = use_cases[1] if len(use_cases) > 1 else "Система уточняет данные при ошибках"
+
+        for section in self.sections:
+            key = section.title.lower()
+            if not key.startswith(_PATCHED):
+                continue
+            for name, value in singles.items():
+                if key.startswith(name) and section.body in _EMPTY_BODIES:
+                    section.set_body([value])
+            for name, items in lists.items():
+                if key.startswith(name) and section.is_placeholder():
+                    section.set_body(_bullets(items))
+            if key.startswith(_SCOPE):
+                section.set_block("**Входит**", _bullets(scope_in) or ["- TBD"])
+                section.set_block("**Не входит**", _bullets(scope_out) or ["- TBD"])
+            elif key.startswith(_USE_CASES):
+                section.set_block("**Основной сценарий**", _numbered(use_cases))
+                section.set_block("**Альтернативы**", [f"- {alternative}"], to_end=True)
+            elif key.startswith(_STORIES):
+                section.set_body(_numbered(user_stories))
+            elif key.startswith(_LEADING):
+                section.set_body(_bullets(leading))
+        return self
+
+
+def publish_markdown(markdown: str, with_diagram: bool) -> str:
+    """Markdown of the Confluence page body.
+
+    When the diagram image is published with the page it gets its own
+    section, so the document's own diagram section (the template's mermaid
+    source) is dropped instead of being shown next to the image.
+    """
+    if not with_diagram:
+        return markdown or ""
+    doc = BrdDocument.parse(markdown)
+    if not doc.find(DIAGRAM_SECTION):
+        return markdown or ""
+    return doc.drop(DIAGRAM_SECTION).markdown()
+
+
+def _comparable(value):
+    if isinstance(value, list):
+        # SessionContext.update merges list slots through a set: their order is not stable
+        return sorted(v if isinstance(v, str) else json.dumps(v, ensure_ascii=False, sort_keys=True) for v in value) or None
+    return value or None
+
+
+def changed_slots(old: dict, new: dict) -> Set[str]:
+    """Slot keys whose values differ (None, "" and [] count as the same empty value)."""
+    old, new = old or {}, new or {}
+    return {k for k in set(old) | set(new) if _comparable(old.get(k)) != _comparable(new.get(k))}
+
+
+def stale_sections(doc: BrdDocument, changed: Set[str]) -> Optional[List[Section]]:
+    """Sections to regenerate for `changed` slots; None when a changed slot has no section of its own."""
+    stale, covered = [], set()
+    inside = None  # level of the stale section whose subsections are being skipped
+    for section in doc.sections:
+        if inside is not None and section.level > inside:
+            nested = True
+        else:
+            nested, inside = False, None
+        key = section.title.lower()
+        for prefixes, sources in SECTION_SOURCES:
+            if key.startswith(prefixes):
+                hit = changed.intersection(sources)
+                if hit:
+                    covered |= hit
+                    # Regenerating a section rewrites its subsections too
+                    if not nested and not key.startswith(_MIRRORED):
+                        stale.append(section)
+                        inside = section.level
+                break
+    return stale if covered >= changed - _DIAGRAM_SLOTS else None
+
+
+def section_answer(text: Optional[str]) -> List[str]:
+    """Body lines from an LLM answer for one section: without a ``` wrapper, its own heading or extra sections."""
+    lines = (text or "").strip().split("\n")
+    if len(lines) >= 2 and lines[0].startswith("```") and lines[-1].strip() == "```":
+        lines = lines[1:-1]
+    if lines and lines[0].startswith("#") and not lines[0].startswith("###"):
+        lines = lines[1:]
+    for i, line in enumerate(lines):
+        if line.startswith("# ") or line.startswith("## "):
+            lines = lines[:i]
+            break
+    while lines and not lines[0].strip():
+        lines.pop(0)
+    return lines[:len(lines) - len(_trailing_blank(lines))]
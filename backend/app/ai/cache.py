@@ -0,0 +1,137 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+from ..config import LLM_CACHE_SIZE, LLM_CACHE_TTL, LLM_CACHE_PATH
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCache:
+    """Content-addressed cache for deterministic LLM generations.
+
+    Entries are keyed by sha256 of (provider, model name, system prompt,
+    prompt). The first tier is an in-memory LRU with TTL; when `sqlite_path`
+    is given, entries are also written to a SQLite file so they survive
+    restarts and are shared between uvicorn workers. Thread-safe.
+    """
+
+    def __init__(self, max_entries: int = 256, ttl: float = 3600.0, sqlite_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+        if sqlite_path:
+            try:
+                self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+                self._db.commit()
+            except sqlite3.Error as exc:
+                logger.warning("LLM cache disk tier disabled: %s", exc)
+                self._db = None
+
+    @staticmethod
+    def key(provider: str, model: str, system_prompt: Optional[str], prompt) -> str:
+        if not isinstance(prompt, str):
+            prompt = json.dumps(prompt, ensure_ascii=False, default=str)
+        raw = json.dumps([provider, model, system_prompt or "", prompt], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, provider: str, model: str, system_prompt: Optional[str], prompt) -> Optional[str]:
+        return self.get_any(provider, [model], system_prompt, prompt)
+
+    def get_any(self, provider: str, models: Iterable[str], system_prompt: Optional[str], prompt) -> Optional[str]:
+        """Cached answer of the first model in `models` that has one; counts as one hit or miss."""
+        now = time.time()
+        keys = [self.key(provider, m, system_prompt, prompt) for m in models]
+        with self._lock:
+            for k in keys:
+                value = self._memory_get(k, now)
+                if value is not None:
+                    self.hits += 1
+                    return value
+            for k in keys:
+                value = self._disk_get(k, now)
+                if value is not None:
+                    self._memory_put(k, value, now)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+            self.misses += 1
+        return None
+
+    def put(self, provider: str, model: str, system_prompt: Optional[str], prompt, value: str):
+        if not value:
+            return
+        k = self.key(provider, model, system_prompt, prompt)
+        now = time.time()
+        with self._lock:
+            self._memory_put(k, value, now)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)", (k, value, now)
+                    )
+                    self._db.commit()
+                except sqlite3.Error as exc:
+                    logger.warning("LLM cache disk write failed: %s", exc)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "disk": self._db is not None,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+    def _memory_get(self, k: str, now: float) -> Optional[str]:
+        entry = self._entries.get(k)
+        if entry is None:
+            return None
+        created_at, value = entry
+        if now - created_at > self.ttl:
+            del self._entries[k]
+            return None
+        self._entries.move_to_end(k)
+        return value
+
+    def _memory_put(self, k: str, value: str, created_at: float):
+        self._entries[k] = (created_at, value)
+        self._entries.move_to_end(k)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_get(self, k: str, now: float) -> Optional[str]:
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (k,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM llm_cache WHERE key = ?", (k,))
+                self._db.commit()
+                return None
+            return row[0]
+        except sqlite3.Error as exc:
+            logger.warning("LLM cache disk read failed: %s", exc)
+            return None
+
+
+llm_cache = LLMCache(LLM_CACHE_SIZE, LLM_CACHE_TTL, LLM_CACHE_PATH or None)
@@ -0,0 +1,78 @@
+import json
+from typing import List, Optional, Sequence, Tuple
+from ..config import CONTEXT_MAX_TURNS, CONTEXT_TOKEN_BUDGET, CONTEXT_SUMMARY_TOKENS
+
+# Folded messages are kept as one short line each
+_SUMMARY_LINE_CHARS = 300
+_ROLE_LABELS = {"user": "Пользователь", "assistant": "Аналитик"}
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Cheap token estimate (~4 chars per token); good enough for budgeting."""
+    if not text:
+        return 0
+    return len(text) // 4 + 1
+
+
+class ContextWindow:
+    """Keeps the chat prompt within a fixed token budget.
+
+    The last `max_turns` user/assistant turns are sent verbatim. Older
+    messages are folded into a rolling summary persisted with the session
+    context (SessionContext.summary / summary_upto_id), so they never have to
+    be loaded again. The collected slots already carry the extracted facts,
+    therefore the summary only keeps a short gist of each folded message.
+    """
+
+    def __init__(
+        self,
+        max_turns: int = CONTEXT_MAX_TURNS,
+        token_budget: int = CONTEXT_TOKEN_BUDGET,
+        summary_tokens: int = CONTEXT_SUMMARY_TOKENS,
+    ):
+        self.max_messages = max(1, max_turns) * 2
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+
+    def build(self, ctx, messages: Sequence[Tuple[int, str, str]], user_message: str) -> List[Tuple[str, str]]:
+        """Return the verbatim (sender, text) history for the prompt.
+
+        `messages` are (id, sender, text) rows newer than ctx.summary_upto_id in
+        id order. Messages that do not fit are folded into ctx.summary and
+        ctx.summary_upto_id is advanced; the caller persists ctx.
+        """
+        messages = list(messages)
+        split = max(0, len(messages) - self.max_messages)
+        fold, keep = messages[:split], messages[split:]
+
+        # Whatever is left after slots, the new message and the summary goes to verbatim turns
+        budget = (
+            self.token_budget
+            - estimate_tokens(json.dumps(ctx.slots, ensure_ascii=False))
+            - estimate_tokens(user_message)
+            - self.summary_tokens
+        )
+        used = sum(estimate_tokens(text) for _, _, text in keep)
+        while keep and used > budget:
+            oldest = keep.pop(0)
+            used -= estimate_tokens(oldest[2])
+            fold.append(oldest)
+
+        if fold:
+            ctx.summary = self._fold(ctx.summary, fold)
+            ctx.summary_upto_id = fold[-1][0]
+        return [(sender, text) for _, sender, text in keep]
+
+    def _fold(self, summary: Optional[str], messages: Sequence[Tuple[int, str, str]]) -> str:
+        lines = summary.splitlines() if summary else []
+        for _, sender, text in messages:
+            gist = " ".join((text or "").split())
+            if not gist:
+                continue
+            if len(gist) > _SUMMARY_LINE_CHARS:
+                gist = gist[:_SUMMARY_LINE_CHARS].rstrip() + "…"
+            lines.append(f"- {_ROLE_LABELS.get(sender, sender)}: {gist}")
+        # Rolling: the oldest lines go first once the summary outgrows its share
+        while lines and estimate_tokens("\n".join(lines)) > self.summary_tokens:
+            lines.pop(0)
+        return "\n".join(lines)
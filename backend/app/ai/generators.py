@@ -1,8 +1,10 @@
 import re
+import textwrap
 from jinja2 import Template
 from .session_logic import SessionContext
 
-BRD_TEMPLATE = Template(
+# Dedented before compiling: 4 leading spaces would turn the whole document into a code block
+BRD_TEMPLATE = Template(textwrap.dedent(
     """
     # {{ title }}
 
@@ -59,7 +61,7 @@ BRD_TEMPLATE = Template(
     {{ mermaid }}
     ```
     """
-)
+))
 
 
 def generate_brd_markdown(ctx: SessionContext, title: str) -> str:
@@ -1,9 +1,27 @@
-import os
 import re
 import json
+import time
+import asyncio
 import logging
-from typing import List, Tuple, Optional
-from ..config import OPENAI_API_KEY, GEMINI_API_KEY
+import threading
+import itertools
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable, Iterator, List, Tuple, Optional
+from ..config import (
+    OPENAI_API_KEY,
+    GEMINI_API_KEY,
+    AI_PROBE_INTERVAL,
+    LLM_REQUEST_DEADLINE,
+    LLM_HEDGE_ENABLED,
+    LLM_HEDGE_PERCENTILE,
+    LLM_HEDGE_DELAY,
+    DOCUMENT_INCREMENTAL_MAX_SECTIONS,
+)
+from .cache import llm_cache
+from .pool import ChatSessionCache, configured_genai, gemini_models
+from .router import ModelRouter
+from .admission import AdmissionRejected, admission
+from .brd_document import BrdDocument, changed_slots, section_answer, stale_sections
 
 # Setup logger for corrections
 logger = logging.getLogger("corrector")
@@ -36,6 +54,9 @@ KEYWORD_TERMS = {
     "recommendations": ["рекомендац", "улучшен", "предложен"],
 }
 
+GEMINI_MODEL_NAMES = ["gemini-2.0-flash", "gemini-2.5-flash", "gemini-2.5-pro"]
+OPENAI_MODEL_NAME = "gpt-4o"
+
 SYSTEM_PROMPT = (
     "Ты — AI-агент, выполняющий функции профессионального бизнес-аналитика в крупном банке.\n"
     "Ты ведёшь диалог с сотрудником для сбора бизнес-требований. Вся валюта в тенге.\n\n"
@@ -120,17 +141,18 @@ SYSTEM_PROMPT = (
     "═══════════════════════════════════════════════════════════════\n"
     "```json\n"
     "{\n"
+    "  \"reply\": \"КОРОТКИЙ ответ (2-4 предложения) + ОДИН вопрос\",\n"
     "  \"corrections\": [],\n"
     "  \"delta\": {\n"
     "    \"goal\": \"извлечённая цель (если есть)\",\n"
     "    \"description\": \"извлечённое описание (если есть)\"\n"
     "  },\n"
-    "  \"validation\": {\"is_valid\": true, \"issues\": []},\n"
-    "  \"reply\": \"КОРОТКИЙ ответ (2-4 предложения) + ОДИН вопрос\"\n"
+    "  \"validation\": {\"is_valid\": true, \"issues\": []}\n"
     "}\n"
     "```\n\n"
     
     "ПРАВИЛА:\n"
+    "• reply — всегда ПЕРВОЕ поле JSON\n"
     "• delta — извлечённые данные из сообщения клиента\n"
     "• reply — КОРОТКИЙ ответ! Максимум 3-5 предложений!\n"
     "• Задавай ОДИН вопрос за раз!\n"
@@ -151,70 +173,348 @@ SYSTEM_PROMPT = (
 def _format_context(history: List[Tuple[str, str]]) -> str:
     return "\n".join([f"{role}: {text}" for role, text in history])
 
+
+def _response_text(resp) -> Optional[str]:
+    """Text of a Gemini response, falling back to the first candidate's parts."""
+    text = getattr(resp, "text", None)
+    if text:
+        return text
+    candidates = getattr(resp, "candidates", None)
+    if not candidates:
+        return None
+    parts = getattr(candidates[0].content, "parts", []) if getattr(candidates[0], "content", None) else []
+    for part in parts:
+        part_text = getattr(part, "text", None)
+        if part_text:
+            return part_text
+    return None
+
+
+def _chunk_text(chunk) -> Optional[str]:
+    # .text raises on chunks without text parts (e.g. the final safety-only chunk)
+    try:
+        return chunk.text
+    except Exception:
+        return None
+
+
+_REPLY_KEY_RE = re.compile(r'"reply"\s*:\s*"')
+_JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+def _hex4(text: str) -> Optional[int]:
+    try:
+        return int(text, 16) if len(text) == 4 else None
+    except ValueError:
+        return None
+
+
+def _decode_unicode_escape(buf: str, i: int) -> Optional[Tuple[str, int]]:
+    """Decode the \\uXXXX escape at buf[i] into (text, index after it); None: wait for more data.
+
+    Characters outside the BMP (emoji) arrive as a surrogate pair of two
+    escapes, which may be split across chunks: a high surrogate is held back
+    until the escape after it is complete. Unpaired surrogates become U+FFFD,
+    as they cannot be encoded to UTF-8.
+    """
+    if i + 6 > len(buf):
+        return None
+    code = _hex4(buf[i + 2:i + 6])
+    if code is None:
+        return "", i + 6
+    if 0xDC00 <= code <= 0xDFFF:
+        return "\ufffd", i + 6
+    if not 0xD800 <= code <= 0xDBFF:
+        return chr(code), i + 6
+    tail = buf[i + 6:i + 12]
+    if len(tail) < 6 and "\\u".startswith(tail[:2]):
+        return None
+    low = _hex4(tail[2:6]) if tail.startswith("\\u") else None
+    if low is not None and 0xDC00 <= low <= 0xDFFF:
+        return chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)), i + 12
+    return "\ufffd", i + 6
+
+
+class _ReplyStreamExtractor:
+    """Incrementally decodes the "reply" string out of a streamed JSON answer.
+
+    The model answers with a JSON object; feed() receives raw chunks as they
+    arrive and returns only the newly decoded characters of the reply value,
+    so the client can render the answer before the JSON is complete.
+    """
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = -1  # index of the next undecoded char inside the reply string
+        self._done = False
+
+    def feed(self, chunk: str) -> str:
+        if self._done or not chunk:
+            return ""
+        self._buf += chunk
+        if self._pos < 0:
+            m = _REPLY_KEY_RE.search(self._buf)
+            if not m:
+                return ""
+            self._pos = m.end()
+
+        out = []
+        buf, i = self._buf, self._pos
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self._done = True
+                i += 1
+                break
+            if ch != "\\":
+                out.append(ch)
+                i += 1
+                continue
+            # Escape sequence: wait for more data if it is cut in the middle
+            if i + 1 >= len(buf):
+                break
+            esc = buf[i + 1]
+            if esc == "u":
+                decoded = _decode_unicode_escape(buf, i)
+                if decoded is None:
+                    break
+                text, i = decoded
+                out.append(text)
+                continue
+            out.append(_JSON_ESCAPES.get(esc, esc))
+            i += 2
+        self._pos = i
+        return "".join(out)
+
 class AIModel:
     def __init__(self):
         # Берём ключи напрямую из config.py (захардкожены)
-        gemini_key = GEMINI_API_KEY
-        openai_key = OPENAI_API_KEY
-        logger.info(f"Loading API key: {gemini_key[:20] if gemini_key else 'None'}...")
-        
-        self.use_gemini = bool(gemini_key)
-        self.use_openai = bool(openai_key) and not self.use_gemini
-        self.gemini_working = False
-        
-        if self.use_gemini:
-            import google.generativeai as genai  # type: ignore
-            genai.configure(api_key=gemini_key)
-            self._genai = genai
-            self._gemini_model_names = [
-                "gemini-2.0-flash",
-                "gemini-2.5-flash",
-                "gemini-2.5-pro",
-            ]
-            # Test if Gemini is actually working
+        # Construction is cheap: SDK import and probing happen in start() / on first use
+        self._gemini_key = GEMINI_API_KEY
+        self._openai_key = OPENAI_API_KEY
+
+        self.use_gemini = bool(self._gemini_key)
+        self.use_openai = bool(self._openai_key) and not self.use_gemini
+        # Optimistic until the first probe says otherwise, so cold start never waits for the LLM
+        self.gemini_working = True
+        self._gemini_model_names = GEMINI_MODEL_NAMES if self.use_gemini else []
+        self._openai_model_names = [OPENAI_MODEL_NAME] if self.use_openai else []
+
+        self._init_lock = threading.Lock()
+        self._genai_module = None
+        self._openai_module = None
+        self._initialized = not (self.use_gemini or self.use_openai)
+        self._init_error: Optional[str] = None
+        self._probe_task: Optional[asyncio.Task] = None
+        self._chats = ChatSessionCache()
+        # Fallback order over _gemini_model_names, driven by observed latency / errors
+        self.router = ModelRouter(self._gemini_model_names)
+        # Process-wide in-flight limit, wait queue and per-model token buckets
+        self.admission = admission
+        self._model_status = {
+            name: {"ok": None, "latency_ms": None, "error": None, "checked_at": None}
+            for name in self._gemini_model_names + self._openai_model_names
+        }
+
+    @property
+    def _genai(self):
+        self._init_providers()
+        return self._genai_module
+
+    @property
+    def _openai(self):
+        self._init_providers()
+        return self._openai_module
+
+    def _init_providers(self):
+        """Import and configure the provider SDK once; no network calls."""
+        if self._initialized:
+            return
+        with self._init_lock:
+            if self._initialized:
+                return
             try:
-                test_model = genai.GenerativeModel("gemini-2.0-flash")
-                test_response = test_model.generate_content("test")
-                self.gemini_working = True
-                logger.info("✅ Gemini API working with key: %s...", gemini_key[:20])
-            except Exception as e:
-                logger.error(f"❌ Gemini API failed: {e}")
-                self.gemini_working = False
-                
+                if self.use_gemini:
+                    self._genai_module = configured_genai(self._gemini_key)
+                    logger.info("Gemini configured with key: %s...", self._gemini_key[:20])
+                elif self.use_openai:
+                    import openai  # type: ignore
+                    openai.api_key = self._openai_key
+                    self._openai_module = openai
+                self._init_error = None
+            except Exception as exc:
+                self._init_error = str(exc)
+                logger.error("❌ AI provider init failed: %s", exc)
+                raise
+            self._initialized = True
+
+    async def start(self, probe_interval: float = AI_PROBE_INTERVAL):
+        """Background warm-up: provider init, then periodic model probing."""
+        self._probe_task = asyncio.create_task(self._probe_loop(probe_interval))
+
+    async def stop(self):
+        if self._probe_task:
+            self._probe_task.cancel()
+            await asyncio.gather(self._probe_task, return_exceptions=True)
+            self._probe_task = None
+
+    async def _probe_loop(self, interval: float):
+        while True:
+            try:
+                await asyncio.to_thread(self.probe)
+            except Exception as exc:
+                logger.warning("AI provider probe failed: %s", exc)
+            await asyncio.sleep(interval)
+
+    def probe(self):
+        """Check every configured model with a metadata lookup (no generation is billed)."""
+        self._init_providers()
+        for name in self._model_status:
+            started = time.monotonic()
+            try:
+                if self.use_gemini:
+                    self._genai.get_model(f"models/{name}")
+                else:
+                    self._openai.Model.retrieve(name)
+                ok, error = True, None
+            except Exception as exc:
+                ok, error = False, str(exc)[:200]
+            self._model_status[name] = {
+                "ok": ok,
+                "latency_ms": round((time.monotonic() - started) * 1000, 1),
+                "error": error,
+                "checked_at": datetime.utcnow().isoformat(),
+            }
+        if self.use_gemini:
+            self.gemini_working = any(st["ok"] for st in self._model_status.values())
+            if self.gemini_working:
+                logger.info("✅ Gemini API reachable")
+            else:
+                logger.error("❌ Gemini API failed: no model is reachable")
+
+    def readiness(self) -> dict:
+        """Per-provider / per-model status for /ready."""
+        if self.use_gemini:
+            provider = "gemini"
         elif self.use_openai:
-            import openai  # type: ignore
-            openai.api_key = openai_key
-            self._openai = openai
+            provider = "openai"
+        else:
+            provider = None
+        models = {name: dict(st) for name, st in self._model_status.items()}
+        probed = [st["ok"] for st in models.values() if st["ok"] is not None]
+        if provider is None:
+            state = "local"  # no keys: rule-based replies and template documents
+        elif self._init_error:
+            state = "down"
+        elif not probed:
+            state = "starting"
+        elif all(probed):
+            state = "ready"
+        elif any(probed):
+            state = "degraded"
+        else:
+            state = "down"
+        return {
+            # Optimistic while starting (see gemini_working); only "down" takes the instance out
+            "ready": state != "down",
+            "provider": provider,
+            "state": state,
+            "error": self._init_error,
+            "models": models,
+        }
 
-    def reply_and_slots(self, history: List[Tuple[str, str]], user_message: str, current_slots: dict) -> Tuple[str, dict, bool]:
-        # Check if Gemini is working before trying
+    async def reply_and_slots_async(self, history: List[Tuple[str, str]], user_message: str, current_slots: dict, summary: Optional[str] = None, session_id: Optional[str] = None) -> Tuple[str, dict, bool]:
         if self.use_gemini and not self.gemini_working:
-            logger.error("🔴 Gemini API не работает. Требуется новый API ключ!")
-            delta = self._local_extract_slots(user_message)
-            fallback_reply = (
-                "⚠️ **Gemini API недоступен**\n\n"
-                "Ваш API ключ заблокирован Google (403 leaked).\n\n"
-                "**Решение:**\n"
-                "1. Откройте: https://aistudio.google.com/app/apikey\n"
-                "2. Создайте новый API ключ\n"
-                "3. Обновите файл `.env`\n"
-                "4. Перезапустите backend\n\n"
-                f"Я извлёк из вашего сообщения: {json.dumps(delta, ensure_ascii=False)}"
-            )
-            return fallback_reply, delta, False
-        
-        prompt = (
+            return self._unavailable_reply(user_message)
+
+        prompt = self._build_reply_prompt(user_message, current_slots, summary)
+
+        response_text = None
+        if self.use_gemini or self.use_openai:
+            async with self.admission.slot_async():
+                if self.use_gemini:
+                    response_text = await self._gemini_chat_text_async(history, prompt, session_id)
+                else:
+                    response_text = await self._openai_chat_text_async(history, prompt)
+
+        reply = self._finalize_reply(response_text, user_message, current_slots)
+        self._chats.record(session_id, user_message, reply[0])
+        return reply
+
+    async def stream_reply_and_slots_async(self, history: List[Tuple[str, str]], user_message: str, current_slots: dict, summary: Optional[str] = None, session_id: Optional[str] = None) -> AsyncIterator[Tuple[str, object]]:
+        """Streaming variant of reply_and_slots_async.
+
+        Yields ("admitted", None) once an admission slot and the first model's
+        rate token are held (the first step raises AdmissionRejected instead
+        when there is no capacity or every bucket is empty),
+        ("chunk", text) for every piece of the reply field as it arrives from
+        the provider, then a single ("done", (reply, delta, ready)) with the
+        same result reply_and_slots_async would have returned.
+        """
+        if self.use_gemini and not self.gemini_working:
+            yield "admitted", None
+            yield "done", self._unavailable_reply(user_message)
+            return
+
+        prompt = self._build_reply_prompt(user_message, current_slots, summary)
+
+        extractor = _ReplyStreamExtractor()
+        raw = []
+        if self.use_gemini or self.use_openai:
+            async with self.admission.slot_async():
+                # Take the first rate token before "admitted": an empty bucket is a 429, not a stream error
+                if self.use_gemini:
+                    names = self._admitted_candidates()
+                    first = next(names, None)
+                    chunks = self._gemini_chat_stream_async(
+                        history, prompt, session_id, itertools.chain([first] if first else [], names)
+                    )
+                else:
+                    self._take_openai_token()
+                    chunks = self._openai_chat_stream_async(history, prompt)
+                yield "admitted", None
+                async for chunk in chunks:
+                    raw.append(chunk)
+                    piece = extractor.feed(chunk)
+                    if piece:
+                        yield "chunk", piece
+        else:
+            yield "admitted", None
+
+        reply = self._finalize_reply("".join(raw) or None, user_message, current_slots)
+        self._chats.record(session_id, user_message, reply[0])
+        yield "done", reply
+
+    def forget_session(self, session_id: str):
+        """Drop the live chat of a deleted or finished session."""
+        self._chats.discard(session_id)
+
+    def _build_reply_prompt(self, user_message: str, current_slots: dict, summary: Optional[str] = None) -> str:
+        # summary: rolling digest of turns that no longer fit into the history window
+        earlier = f"Краткое содержание ранней части диалога (факты уже учтены в slots):\n{summary}\n" if summary else ""
+        return (
+            earlier +
             f"Текущие заполненные данные (slots): {json.dumps(current_slots, ensure_ascii=False)}\n"
             f"Последнее сообщение пользователя: \"{user_message}\"\n"
             "Проанализируй сообщение, исправь ошибки, обнови слоты и верни JSON, где reply использует многострочные списки и задаёт следующий вопрос."
         )
-        
-        response_text = None
-        if self.use_gemini:
-            response_text = self._gemini_chat_text(history, prompt)
-        elif self.use_openai:
-            response_text = self._openai_chat_text(history, prompt)
-        
+
+    def _unavailable_reply(self, user_message: str) -> Tuple[str, dict, bool]:
+        logger.error("🔴 Gemini API не работает. Требуется новый API ключ!")
+        delta = self._local_extract_slots(user_message)
+        fallback_reply = (
+            "⚠️ **Gemini API недоступен**\n\n"
+            "Ваш API ключ заблокирован Google (403 leaked).\n\n"
+            "**Решение:**\n"
+            "1. Откройте: https://aistudio.google.com/app/apikey\n"
+            "2. Создайте новый API ключ\n"
+            "3. Обновите файл `.env`\n"
+            "4. Перезапустите backend\n\n"
+            f"Я извлёк из вашего сообщения: {json.dumps(delta, ensure_ascii=False)}"
+        )
+        return fallback_reply, delta, False
+
+    def _finalize_reply(self, response_text: Optional[str], user_message: str, current_slots: dict) -> Tuple[str, dict, bool]:
         if not response_text:
             # Fallback
             delta = self._local_extract_slots(user_message)
@@ -254,8 +554,56 @@ class AIModel:
         reply = self._format_reply_style(reply)
         return reply, delta, ready
 
-    def generate_document_from_slots(self, slots: dict, title: str) -> str:
-        prompt = (
+    async def generate_document_from_slots_async(self, slots: dict, title: str) -> Optional[str]:
+        """LLM-written BRD Markdown; None when no LLM is configured or the call failed.
+
+        The template fallback is left to the caller, so a template document is
+        never mistaken for a generated one (and reused on the next finish).
+        """
+        prompt = self._build_document_prompt(slots, title)
+        text = await self._generate_text_async(prompt)
+        return self._finalize_document(text, slots, title)
+
+    async def update_document_from_slots_async(
+        self, markdown: str, previous_slots: dict, previous_title: Optional[str], slots: dict, title: str
+    ) -> Optional[str]:
+        """Regenerate only the sections of `markdown` whose source slots changed since `previous_slots`.
+
+        Unchanged sections are kept as they are; stale ones are regenerated
+        concurrently, one short LLM call each. Returns None when the whole
+        document should be generated instead: no LLM configured, a changed
+        slot without a section of its own, more than
+        DOCUMENT_INCREMENTAL_MAX_SECTIONS stale sections or a failed call.
+        """
+        doc = BrdDocument.parse(markdown)
+        stale = stale_sections(doc, changed_slots(previous_slots, slots))
+        if stale is None or len(stale) > DOCUMENT_INCREMENTAL_MAX_SECTIONS:
+            return None
+        if not stale and title == previous_title:
+            return doc.fill_from_slots(slots).markdown()
+        if stale and not (self.use_gemini or self.use_openai):
+            return None
+        answers = await asyncio.gather(*(
+            self._generate_text_async(self._build_section_prompt(doc.section_text(s), slots, title)) for s in stale
+        ))
+        for section, answer in zip(stale, answers):
+            lines = section_answer(answer)
+            if not lines:
+                return None
+            doc.replace_section(section, lines)
+        if title != previous_title:
+            doc.set_title(title)
+        return doc.fill_from_slots(slots).markdown()
+
+    async def _generate_text_async(self, prompt: str) -> Optional[str]:
+        if self.use_gemini:
+            return await self._gemini_generate_text_async([prompt])
+        if self.use_openai:
+            return await self._openai_generate_text_async(prompt)
+        return None
+
+    def _build_document_prompt(self, slots: dict, title: str) -> str:
+        return (
             f"Ты — Senior AI Business Analyst. На основе собранных данных сформируй полный Confluence-документ.\n"
             f"Данные: {json.dumps(slots, ensure_ascii=False)}\n"
             f"Заголовок: {title}\n\n"
@@ -280,97 +628,28 @@ class AIModel:
             "• Чётко, ясно, структурировано. Никаких «возможно» или «я думаю».\n"
             "• Документ должен быть готов к копированию в Confluence без правок.\n"
         )
-        
-        text = None
-        if self.use_gemini:
-            text = self._gemini_generate_text([prompt])
-        elif self.use_openai:
-            text = self._openai_generate_text(prompt)
-            
+
+    def _build_section_prompt(self, section_text: str, slots: dict, title: str) -> str:
+        return (
+            f"Ты — Senior AI Business Analyst. Данные требований изменились: обнови один раздел Confluence-документа «{title}».\n"
+            f"Данные: {json.dumps(slots, ensure_ascii=False)}\n\n"
+            f"Текущий раздел:\n{section_text}\n\n"
+            "ТРЕБОВАНИЯ:\n"
+            "• Верни только новое содержимое раздела в Markdown, без его заголовка и без пояснений.\n"
+            "• Сохрани структуру и стиль раздела (подзаголовки ###, списки), измени то, что расходится с данными.\n"
+            "• НЕ генерируй Mermaid код, flowchart или любые диаграммы.\n"
+        )
+
+    def _finalize_document(self, text: Optional[str], slots: dict, title: str) -> Optional[str]:
         if text:
             try:
                 return self._fill_missing_sections(text, slots, title)
             except Exception:
-                pass
-            
-        # Fallback
-        from .generators import generate_brd_markdown
-        from .session_logic import SessionContext
-        return generate_brd_markdown(SessionContext(slots), title)
+                logger.exception("Failed to patch the generated document")
+        return None
 
     def _fill_missing_sections(self, text: str, slots: dict, title: str) -> str:
-        import re
-        from .generators import _normalize_multiline, default_use_cases, default_user_stories, default_leading_indicators
-        s = text
-        goal = (slots.get("goal") or "TBD").strip()
-        description = (slots.get("description") or "TBD").strip()
-        scope_in = _normalize_multiline(slots.get("scope_in"))
-        scope_out = _normalize_multiline(slots.get("scope_out"))
-        kpi = slots.get("kpi") or []
-        use_cases = slots.get("use_cases") or default_use_cases(type("Ctx", (), {"slots": slots})())
-        user_stories = slots.get("user_stories") or default_user_stories(type("Ctx", (), {"slots": slots})())
-        leading = slots.get("leading_indicators") or default_leading_indicators(type("Ctx", (), {"slots": slots})())
-        br = slots.get("business_requirements") or []
-        fr = slots.get("functional_requirements") or []
-
-        def repl_single(header_pattern, value):
-            pattern = re.compile(rf"(##\s*\d*\.?\s*{header_pattern}[^\n]*\n)([\s\S]*?)(?=\n##|$)", re.IGNORECASE)
-            def _r(m):
-                body = m.group(2).strip()
-                if body in ("—", "-", "", "— "):
-                    return m.group(1) + value + "\n"
-                return m.group(0)
-            return pattern.sub(_r, s)
-
-        s = repl_single("Цель проекта", goal)
-        s = repl_single("Описание задачи", description)
-
-        scope_pattern = re.compile(r"(##\s*\d*\.?\s*Scope[\s\S]*?)(?=\n##|$)", re.IGNORECASE)
-        def fix_scope(m):
-            block = m.group(1)
-            def fmt_list(items):
-                return "\n".join([f"- {x}" for x in items]) if items else "- TBD"
-            block = re.sub(r"\*\*Входит\*\*[\s\S]*?(?=\n\*\*|$)", lambda mm: "**Входит**\n" + fmt_list(scope_in) + "\n", block)
-            block = re.sub(r"\*\*Не входит\*\*[\s\S]*?(?=\n\*\*|$)", lambda mm: "**Не входит**\n" + fmt_list(scope_out) + "\n", block)
-            return block
-        s = scope_pattern.sub(fix_scope, s)
-
-        def fix_list_section(header, items):
-            pattern = re.compile(rf"(##\s*\d*\.?\s*{header}[^\n]*\n)([\s\S]*?)(?=\n##|$)", re.IGNORECASE)
-            def _r(m):
-                body = m.group(2).strip()
-                if not body or body in ("—", "-", "— ") or re.fullmatch(r"-\s*TBD(\s*\n?)*", body, re.IGNORECASE):
-                    return m.group(1) + "\n".join([f"- {x}" for x in items]) + "\n"
-                return m.group(0)
-            return pattern.sub(_r, s)
-
-        s = fix_list_section("KPI", kpi)
-        s = fix_list_section("KPI и метрики успеха", kpi)
-        s = fix_list_section("Бизнес-требования", br)
-        s = fix_list_section("Функциональные требования", fr)
-
-        uc_pattern = re.compile(r"(##\s*\d*\.?\s*Сценарии использования[\s\S]*?)(?=\n##|$)", re.IGNORECASE)
-        def fix_uc(m):
-            block = m.group(1)
-            main = "\n".join([f"{i+1}. {x}" for i, x in enumerate(use_cases)])
-            alt = "- " + (use_cases[1] if len(use_cases) > 1 else "Система уточняет данные при ошибках")
-            block = re.sub(r"\*\*Основной сценарий\*\*[\s\S]*?(?=\n\*\*|$)", "**Основной сценарий**\n" + main + "\n", block)
-            block = re.sub(r"\*\*Альтернативы\*\*[\s\S]*?(?=\n##|$)", "**Альтернативы**\n" + alt + "\n", block)
-            return block
-        s = uc_pattern.sub(fix_uc, s)
-
-        us_pattern = re.compile(r"(##\s*\d*\.?\s*Пользовательские истории[^\n]*\n)([\s\S]*?)(?=\n##|$)", re.IGNORECASE)
-        def fix_us(m):
-            body = "\n".join([f"{i+1}. {x}" for i, x in enumerate(user_stories)])
-            return m.group(1) + body + "\n"
-        s = us_pattern.sub(fix_us, s)
-
-        li_pattern = re.compile(r"(##\s*\d*\.?\s*Leading Indicators[^\n]*\n)([\s\S]*?)(?=\n##|$)", re.IGNORECASE)
-        def fix_li(m):
-            body = "\n".join([f"- {x}" for x in leading])
-            return m.group(1) + body + "\n"
-        s = li_pattern.sub(fix_li, s)
-        return s
+        return BrdDocument.parse(text).fill_from_slots(slots).markdown()
 
     def _parse_json_response(self, text: str) -> Tuple[dict, str]:
         """Extracts JSON from text, returns (dict, reply_text)"""
@@ -533,7 +812,6 @@ class AIModel:
                     else:
                         out[slot] = value
         return out
-        return out
 
     def _format_reply_style(self, text: Optional[str]) -> str:
         if not text:
@@ -558,88 +836,222 @@ class AIModel:
             lines.pop()
         return "\n".join(lines).strip()
 
-    def _gemini_chat_text(self, history: List[Tuple[str, str]], prompt: str) -> Optional[str]:
-        for name in getattr(self, "_gemini_model_names", []):
-            try:
-                # Create model with system instruction
-                model = self._genai.GenerativeModel(
-                    model_name=name,
-                    system_instruction=SYSTEM_PROMPT
-                )
-                
-                # Build chat history (without system prompt, it's already set)
-                chat_history = []
-                for role, text in history:
-                    if not text:
-                        continue
-                    chat_history.append({
-                        "role": "user" if role == "user" else "model", 
-                        "parts": [text]
-                    })
-                
-                # Start chat and send message
-                chat = model.start_chat(history=chat_history)
-                resp = chat.send_message(prompt)
-                
-                text = getattr(resp, "text", None)
-                if text:
-                    logger.info(f"Gemini {name} responded successfully")
-                    return text
-                    
-                candidates = getattr(resp, "candidates", None)
-                if not candidates:
+    async def _gemini_chat_text_async(self, history: List[Tuple[str, str]], prompt: str, session_id: Optional[str] = None) -> Optional[str]:
+        return await self._run_candidates_async(
+            "chat", lambda name: self._gemini_chat_attempt_async(name, history, prompt, session_id)
+        )
+
+    async def _gemini_chat_attempt_async(self, name: str, history: List[Tuple[str, str]], prompt: str, session_id: Optional[str]) -> Optional[str]:
+        started = time.monotonic()
+        try:
+            model = gemini_models.get(self._genai, name, SYSTEM_PROMPT)
+            chat = self._chats.checkout(session_id, model, name, history, self._gemini_history)
+            resp = await chat.send_message_async(prompt)
+
+            text = _response_text(resp)
+            if text:
+                self.router.record(name, "chat", time.monotonic() - started, True)
+                self._chats.checkin(session_id, name, chat, history)
+                logger.info(f"Gemini {name} responded successfully")
+                return text
+            self.router.record(name, "chat", time.monotonic() - started, False, "empty response")
+        except Exception as exc:
+            self.router.record(name, "chat", time.monotonic() - started, False, str(exc))
+            logger.warning("Gemini model %s failed: %s", name, exc)
+        return None
+
+    async def _run_candidates_async(self, operation: str, attempt: Callable[[str], Awaitable[Optional[str]]]) -> Optional[str]:
+        """Try router candidates until one answers, within LLM_REQUEST_DEADLINE.
+
+        With LLM_HEDGE_ENABLED the next candidate is also started when the
+        current one has not answered within its latency percentile for
+        `operation` ("chat" / "generate"); the first answer wins. Losing and
+        overdue attempts are cancelled.
+        """
+        deadline = time.monotonic() + LLM_REQUEST_DEADLINE
+        names = self._admitted_candidates()
+        pending = {}
+
+        def launch() -> bool:
+            name = next(names, None)
+            if name is None:
+                return False
+            pending[asyncio.ensure_future(attempt(name))] = name
+            return True
+
+        launch()
+        hedge_at = self._hedge_at(pending, operation)
+        try:
+            while pending:
+                now = time.monotonic()
+                if now >= deadline:
+                    logger.warning("LLM request deadline (%ss) exceeded", LLM_REQUEST_DEADLINE)
+                    return None
+                timeout = deadline - now if hedge_at is None else max(0.0, min(deadline, hedge_at) - now)
+                done, _ = await asyncio.wait(list(pending), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Only a hedge point with time left starts a backup; otherwise the
+                    # wait ran out at the deadline, reported at the top of the loop
+                    if hedge_at is not None and time.monotonic() < deadline:
+                        hedge_at = self._hedge_at(pending, operation) if launch() else None
                     continue
-                parts = getattr(candidates[0].content, "parts", []) if getattr(candidates[0], "content", None) else []
-                for part in parts:
-                    part_text = getattr(part, "text", None)
-                    if part_text:
-                        return part_text
-            except Exception as exc:
-                logger.warning("Gemini model %s failed: %s", name, exc)
+                for task in done:
+                    del pending[task]
+                    text = task.result()
+                    if text:
+                        return text
+                if launch():
+                    hedge_at = self._hedge_at(pending, operation)
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _admitted_candidates(self) -> Iterator[str]:
+        """Router candidates that still have a rate token, taken lazily one attempt at a time.
+
+        A half-open model's trial is claimed only here, when the model is
+        actually about to be attempted. Raises AdmissionRejected when not a
+        single model could be attempted.
+        """
+        waits = []
+        attempted = False
+        for name in self.router.candidates():
+            wait = self.admission.try_take("gemini", name)
+            if wait:
+                waits.append(wait)
                 continue
-        return None
+            if not self.router.begin_trial(name):
+                continue
+            attempted = True
+            yield name
+        if not attempted and waits:
+            raise AdmissionRejected("Gemini rate limit reached for all models", min(waits))
 
-    def _gemini_generate_text(self, parts) -> Optional[str]:
-        for name in getattr(self, "_gemini_model_names", []):
+    def _hedge_at(self, pending: dict, operation: str) -> Optional[float]:
+        """When to start the next candidate if the newest attempt is still running (None: never)."""
+        if not LLM_HEDGE_ENABLED or not pending:
+            return None
+        newest = list(pending.values())[-1]
+        delay = self.router.latency_percentile(newest, operation, LLM_HEDGE_PERCENTILE)
+        if delay is None:
+            delay = LLM_HEDGE_DELAY
+        return time.monotonic() + delay
+
+    async def _gemini_chat_stream_async(
+        self, history: List[Tuple[str, str]], prompt: str, session_id: Optional[str], names: Iterator[str]
+    ) -> AsyncIterator[str]:
+        # names: _admitted_candidates(), its first model already taken by the caller
+        for name in names:
+            emitted = False
+            started = time.monotonic()
             try:
-                model = self._genai.GenerativeModel(name)
-                resp = model.generate_content(parts)
-                text = getattr(resp, "text", None)
-                if text:
-                    return text
-                candidates = getattr(resp, "candidates", None)
-                if candidates:
-                    parts_seq = getattr(candidates[0].content, "parts", []) if getattr(candidates[0], "content", None) else []
-                    for part in parts_seq:
-                        part_text = getattr(part, "text", None)
-                        if part_text:
-                            return part_text
+                model = gemini_models.get(self._genai, name, SYSTEM_PROMPT)
+                chat = self._chats.checkout(session_id, model, name, history, self._gemini_history)
+                resp = await chat.send_message_async(prompt, stream=True)
+                async for chunk in resp:
+                    text = _chunk_text(chunk)
+                    if text:
+                        emitted = True
+                        yield text
+                if emitted:
+                    self.router.record(name, "chat", time.monotonic() - started, True)
+                    self._chats.checkin(session_id, name, chat, history)
+                    logger.info(f"Gemini {name} streamed successfully")
+                    return
+                self.router.record(name, "chat", time.monotonic() - started, False, "empty response")
             except Exception as exc:
-                logger.warning("Gemini model %s (doc) failed: %s", name, exc)
+                self.router.record(name, "chat", time.monotonic() - started, False, str(exc))
+                logger.warning("Gemini model %s (stream) failed: %s", name, exc)
+                if emitted:
+                    return
+                continue
+
+    @staticmethod
+    def _gemini_history(history: List[Tuple[str, str]]) -> List[dict]:
+        # Build chat history (without system prompt, it's already set)
+        chat_history = []
+        for role, text in history:
+            if not text:
                 continue
+            chat_history.append({
+                "role": "user" if role == "user" else "model",
+                "parts": [text]
+            })
+        return chat_history
+
+    async def _gemini_generate_text_async(self, parts) -> Optional[str]:
+        cached = llm_cache.get_any("gemini", self._gemini_model_names, None, parts)
+        if cached:
+            return cached
+        async with self.admission.slot_async():
+            return await self._run_candidates_async("generate", lambda name: self._gemini_generate_attempt_async(name, parts))
+
+    async def _gemini_generate_attempt_async(self, name: str, parts) -> Optional[str]:
+        started = time.monotonic()
+        try:
+            model = gemini_models.get(self._genai, name)
+            resp = await model.generate_content_async(parts)
+            text = _response_text(resp)
+            if text:
+                self.router.record(name, "generate", time.monotonic() - started, True)
+                llm_cache.put("gemini", name, None, parts, text)
+                return text
+            self.router.record(name, "generate", time.monotonic() - started, False, "empty response")
+        except Exception as exc:
+            self.router.record(name, "generate", time.monotonic() - started, False, str(exc))
+            logger.warning("Gemini model %s (doc) failed: %s", name, exc)
         return None
 
-    def _openai_chat_text(self, history: List[Tuple[str, str]], prompt: str) -> Optional[str]:
+    def _take_openai_token(self):
+        wait = self.admission.try_take("openai", OPENAI_MODEL_NAME)
+        if wait:
+            raise AdmissionRejected("OpenAI rate limit reached", wait)
+
+    @staticmethod
+    def _openai_chat_messages(history: List[Tuple[str, str]], prompt: str) -> List[dict]:
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        for role, text in history:
+            messages.append({"role": role, "content": text})
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    async def _openai_chat_text_async(self, history: List[Tuple[str, str]], prompt: str) -> Optional[str]:
+        self._take_openai_token()
         try:
-            messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-            for role, text in history:
-                messages.append({"role": role, "content": text})
-            messages.append({"role": "user", "content": prompt})
-            resp = self._openai.ChatCompletion.create(model="gpt-4o", messages=messages)
+            messages = self._openai_chat_messages(history, prompt)
+            resp = await self._openai.ChatCompletion.acreate(model=OPENAI_MODEL_NAME, messages=messages)
             return resp["choices"][0]["message"]["content"]
         except Exception as exc:
             logger.warning("OpenAI chat failed: %s", exc)
             return None
 
-    def _openai_generate_text(self, prompt: str) -> Optional[str]:
+    async def _openai_chat_stream_async(self, history: List[Tuple[str, str]], prompt: str) -> AsyncIterator[str]:
+        # The caller has taken the rate token (before admitting the stream)
         try:
-            messages = [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt},
-            ]
-            resp = self._openai.ChatCompletion.create(model="gpt-4o", messages=messages)
-            return resp["choices"][0]["message"]["content"]
+            messages = self._openai_chat_messages(history, prompt)
+            async for chunk in await self._openai.ChatCompletion.acreate(model=OPENAI_MODEL_NAME, messages=messages, stream=True):
+                text = chunk["choices"][0].get("delta", {}).get("content")
+                if text:
+                    yield text
         except Exception as exc:
-            logger.warning("OpenAI doc generation failed: %s", exc)
-            return None
+            logger.warning("OpenAI chat stream failed: %s", exc)
 
+    async def _openai_generate_text_async(self, prompt: str) -> Optional[str]:
+        cached = llm_cache.get("openai", OPENAI_MODEL_NAME, SYSTEM_PROMPT, prompt)
+        if cached:
+            return cached
+        async with self.admission.slot_async():
+            self._take_openai_token()
+            try:
+                messages = [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt},
+                ]
+                resp = await self._openai.ChatCompletion.acreate(model=OPENAI_MODEL_NAME, messages=messages)
+                text = resp["choices"][0]["message"]["content"]
+                llm_cache.put("openai", OPENAI_MODEL_NAME, SYSTEM_PROMPT, prompt, text)
+                return text
+            except Exception as exc:
+                logger.warning("OpenAI doc generation failed: %s", exc)
+                return None
@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+from ..config import CHAT_CACHE_SIZE, CHAT_IDLE_SECONDS
+
+_genai_lock = threading.Lock()
+_genai = None
+
+
+def configured_genai(api_key: str):
+    """google.generativeai, configured once per process."""
+    global _genai
+    if _genai is None:
+        with _genai_lock:
+            if _genai is None:
+                import google.generativeai as genai  # type: ignore
+                genai.configure(api_key=api_key)
+                _genai = genai
+    return _genai
+
+
+class ModelPool:
+    """GenerativeModel handles keyed by (model name, system instruction).
+
+    Handles are immutable request templates, so one instance per key is
+    built on first use and shared by all threads and requests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models: Dict[Tuple[str, Optional[str]], object] = {}
+
+    def get(self, genai, name: str, system_instruction: Optional[str] = None):
+        key = (name, system_instruction)
+        model = self._models.get(key)
+        if model is None:
+            with self._lock:
+                model = self._models.get(key)
+                if model is None:
+                    if system_instruction:
+                        model = genai.GenerativeModel(model_name=name, system_instruction=system_instruction)
+                    else:
+                        model = genai.GenerativeModel(name)
+                    self._models[key] = model
+        return model
+
+
+gemini_models = ModelPool()
+
+
+def _turns(history: Sequence[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    # Same filtering as AIModel._gemini_history: empty messages are not sent
+    return [(role, text) for role, text in history if text]
+
+
+class _LiveChat:
+    __slots__ = ("model_name", "chat", "turns", "pending", "used_at")
+
+    def __init__(self, model_name: str, chat, turns: List[Tuple[str, str]]):
+        self.model_name = model_name
+        self.chat = chat
+        self.turns = turns
+        self.pending = False
+        self.used_at = time.monotonic()
+
+
+class ChatSessionCache:
+    """Live `start_chat` objects per dialog session (LRU with idle eviction).
+
+    A chat is checked out for the duration of one turn, so concurrent turns
+    of the same session never share it. After a turn the raw prompt/JSON pair
+    the SDK appended is replaced with the compact (user message, reply) pair
+    stored in the DB; the next turn then matches the cached history as is (or
+    after dropping the turns the context window slid past) and nothing is
+    rebuilt. Any mismatch falls back to a fresh chat.
+    """
+
+    def __init__(self, max_sessions: int = CHAT_CACHE_SIZE, idle_seconds: float = CHAT_IDLE_SECONDS):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _LiveChat]" = OrderedDict()
+
+    def checkout(self, session_id: Optional[str], model, model_name: str, history: Sequence[Tuple[str, str]], to_contents):
+        """Chat for `session_id` positioned right after `history`."""
+        turns = _turns(history)
+        entry = None
+        if session_id:
+            with self._lock:
+                self._evict_idle()
+                entry = self._entries.pop(session_id, None)
+        if entry is not None and entry.model_name == model_name and not entry.pending:
+            drop = len(entry.turns) - len(turns)
+            if drop >= 0 and entry.turns[drop:] == turns:
+                try:
+                    if drop:
+                        del entry.chat.history[:drop]
+                    return entry.chat
+                except Exception:
+                    pass
+        return model.start_chat(history=to_contents(history))
+
+    def checkin(self, session_id: Optional[str], model_name: str, chat, history: Sequence[Tuple[str, str]]):
+        """Return a chat that just answered; it stays pending until record() compacts it."""
+        if not session_id:
+            return
+        entry = _LiveChat(model_name, chat, _turns(history))
+        entry.pending = True
+        with self._lock:
+            self._entries[session_id] = entry
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.max_sessions:
+                self._entries.popitem(last=False)
+
+    def record(self, session_id: Optional[str], user_message: str, reply: str):
+        """Replace the last prompt/response pair with what the DB stores for this turn."""
+        if not session_id:
+            return
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or not entry.pending:
+                return
+            try:
+                history = entry.chat.history
+                if len(history) != len(entry.turns) + 2 or not user_message or not reply:
+                    raise ValueError("unexpected chat history")
+                history[-2:] = [
+                    {"role": "user", "parts": [user_message]},
+                    {"role": "model", "parts": [reply]},
+                ]
+            except Exception:
+                del self._entries[session_id]
+                return
+            entry.turns = entry.turns + [("user", user_message), ("assistant", reply)]
+            entry.pending = False
+            entry.used_at = time.monotonic()
+
+    def discard(self, session_id: str):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _evict_idle(self):
+        deadline = time.monotonic() - self.idle_seconds
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if oldest.used_at >= deadline:
+                break
+            self._entries.popitem(last=False)
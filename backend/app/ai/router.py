@@ -0,0 +1,178 @@
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Sequence
+from ..config import ROUTER_EWMA_ALPHA, ROUTER_FAILURE_THRESHOLD, ROUTER_OPEN_SECONDS
+
+# Score of a model that has not answered yet: assume it is slower than a healthy one
+_UNSEEN_LATENCY = 5.0
+# Expected extra cost (seconds) of a failed attempt: the fallback still has to run
+_FAILURE_PENALTY = 10.0
+# Successful latencies kept per (model, operation) for percentile (hedging) thresholds:
+# a chat turn and a whole document differ by an order of magnitude
+_LATENCY_SAMPLES = 100
+_MIN_SAMPLES_FOR_PERCENTILE = 10
+# Error-rate circuit: at least this many calls and at least this share failing
+_MIN_CALLS_FOR_RATE = 5
+_ERROR_RATE_TO_OPEN = 0.5
+
+
+class _ModelHealth:
+    __slots__ = ("latency", "samples", "error_rate", "calls", "failures", "consecutive_failures",
+                 "state", "opened_at", "trial_started", "last_error")
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.samples: Dict[str, deque] = {}
+        self.error_rate = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = "closed"  # closed / open / half_open
+        self.opened_at = 0.0
+        self.trial_started = 0.0
+        self.last_error: Optional[str] = None
+
+
+class ModelRouter:
+    """Orders fallback candidates by observed health, with a circuit breaker per model.
+
+    Each model keeps an EWMA of its latency and error rate. A model that
+    fails `failure_threshold` times in a row (or half of its recent calls)
+    is opened and skipped for `open_seconds`; then a single trial call is let
+    through (half-open) and closes the circuit again on success. Models are
+    tried by expected cost (latency plus a penalty per error rate); the
+    configured order breaks ties.
+    """
+
+    def __init__(
+        self,
+        names: Sequence[str],
+        alpha: float = ROUTER_EWMA_ALPHA,
+        failure_threshold: int = ROUTER_FAILURE_THRESHOLD,
+        open_seconds: float = ROUTER_OPEN_SECONDS,
+    ):
+        self.names = list(names)
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._health: Dict[str, _ModelHealth] = {name: _ModelHealth() for name in self.names}
+
+    def candidates(self) -> List[str]:
+        """Models to try for one call, best first. Never empty while models are configured.
+
+        Listing claims nothing: a model due for its half-open trial is only
+        claimed by begin_trial, when the call actually attempts it.
+        """
+        now = time.monotonic()
+        ranked = []
+        with self._lock:
+            for index, name in enumerate(self.names):
+                h = self._health[name]
+                if h.state != "closed" and not self._trial_due(h, now):
+                    continue
+                # A model on trial goes after the healthy ones
+                ranked.append((h.state != "closed", self._score(h), index, name))
+        if not ranked:
+            # Everything is open: still try in configured order rather than fail outright
+            return list(self.names)
+        return [name for *_, name in sorted(ranked)]
+
+    def begin_trial(self, name: str) -> bool:
+        """Called right before `name` is attempted; False when another call's trial of it is in progress.
+
+        A model whose open period has elapsed becomes half-open with this call
+        as its single trial. A closed model, or an open one tried because
+        everything is open, is attempted without claiming anything.
+        """
+        h = self._health.get(name)
+        if h is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if h.state == "closed":
+                return True
+            if not self._trial_due(h, now):
+                return h.state == "open"
+            h.state = "half_open"
+            h.trial_started = now
+            return True
+
+    def _trial_due(self, h: _ModelHealth, now: float) -> bool:
+        # One trial at a time; an abandoned trial (cancelled call) expires
+        if h.state == "half_open":
+            return now - h.trial_started >= self.open_seconds
+        return now - h.opened_at >= self.open_seconds
+
+    def record(self, name: str, operation: str, latency: float, ok: bool, error: Optional[str] = None):
+        h = self._health.get(name)
+        if h is None:
+            return
+        with self._lock:
+            h.calls += 1
+            h.latency = latency if h.latency is None else self.alpha * latency + (1 - self.alpha) * h.latency
+            h.error_rate = self.alpha * (0.0 if ok else 1.0) + (1 - self.alpha) * h.error_rate
+            if ok:
+                h.samples.setdefault(operation, deque(maxlen=_LATENCY_SAMPLES)).append(latency)
+                h.consecutive_failures = 0
+                h.state = "closed"
+                return
+            h.failures += 1
+            h.consecutive_failures += 1
+            h.last_error = (error or "")[:200] or None
+            if (
+                h.state == "half_open"
+                or h.consecutive_failures >= self.failure_threshold
+                or (h.calls >= _MIN_CALLS_FOR_RATE and h.error_rate >= _ERROR_RATE_TO_OPEN)
+            ):
+                h.state = "open"
+                h.opened_at = time.monotonic()
+
+    def latency_percentile(self, name: str, operation: str, q: float) -> Optional[float]:
+        """q-th quantile (0..1) of recent successful `operation` latencies; None until enough samples."""
+        h = self._health.get(name)
+        if h is None:
+            return None
+        with self._lock:
+            samples = sorted(h.samples.get(operation, ()))
+        if len(samples) < _MIN_SAMPLES_FOR_PERCENTILE:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            models = {}
+            ranked = []
+            for index, name in enumerate(self.names):
+                h = self._health[name]
+                retry_in = max(0.0, self.open_seconds - (now - h.opened_at)) if h.state == "open" else None
+                if not retry_in:
+                    ranked.append((h.state != "closed", self._score(h), index, name))
+                models[name] = {
+                    "state": h.state,
+                    "latency_ms": round(h.latency * 1000, 1) if h.latency is not None else None,
+                    "p90_ms": self._p90_ms(h),
+                    "error_rate": round(h.error_rate, 3),
+                    "calls": h.calls,
+                    "failures": h.failures,
+                    "consecutive_failures": h.consecutive_failures,
+                    "retry_in_seconds": round(retry_in, 1) if retry_in is not None else None,
+                    "last_error": h.last_error,
+                }
+        # Order the next call would use
+        return {"order": [name for *_, name in sorted(ranked)], "models": models}
+
+    @staticmethod
+    def _p90_ms(h: _ModelHealth) -> Dict[str, float]:
+        p90 = {}
+        for operation, recent in h.samples.items():
+            samples = sorted(recent)
+            p90[operation] = round(samples[min(len(samples) - 1, int(0.9 * len(samples)))] * 1000, 1)
+        return p90
+
+    @staticmethod
+    def _score(h: _ModelHealth) -> float:
+        latency = h.latency if h.latency is not None else _UNSEEN_LATENCY
+        return latency + _FAILURE_PENALTY * h.error_rate
@@ -17,6 +17,9 @@ class SessionContext:
             "leading_indicators": [],
         }
         self.meta = meta or { k: {"confidence": 0.0, "updated": None} for k in self.slots.keys() }
+        # Rolling conversation summary, see ai/context_window.py; persisted by the stores
+        self.summary: Optional[str] = None
+        self.summary_upto_id: int = 0
 
     def is_complete(self) -> bool:
         required = ["goal", "description", "scope_in", "rules", "kpi", "constraints", "priorities"]
@@ -70,18 +73,50 @@ class SessionContextStore:
         row = self.db.query(SessionContextState).filter(SessionContextState.session_id == session_id).one_or_none()
         if not row:
             return SessionContext()
-        return SessionContext.from_json(row.slots_json)
+        return _context_from_row(row)
 
     def save(self, session_id: str, ctx: SessionContext):
         from ..models import SessionContextState
         row = self.db.query(SessionContextState).filter(SessionContextState.session_id == session_id).one_or_none()
         if not row:
-            row = SessionContextState(session_id=session_id, slots_json=ctx.to_json())
+            row = SessionContextState(session_id=session_id)
             self.db.add(row)
-        else:
-            row.slots_json = ctx.to_json()
+        _context_to_row(ctx, row)
         self.db.commit()
 
+class AsyncSessionContextStore:
+    """SessionContextStore counterpart for AsyncSession-based handlers."""
+
+    def __init__(self, db_session):
+        self.db = db_session
+
+    async def get(self, session_id: str) -> SessionContext:
+        from ..models import SessionContextState
+        row = await self.db.get(SessionContextState, session_id)
+        if not row:
+            return SessionContext()
+        return _context_from_row(row)
+
+    async def save(self, session_id: str, ctx: SessionContext):
+        from ..models import SessionContextState
+        row = await self.db.get(SessionContextState, session_id)
+        if not row:
+            row = SessionContextState(session_id=session_id)
+            self.db.add(row)
+        _context_to_row(ctx, row)
+        await self.db.commit()
+
+def _context_from_row(row) -> SessionContext:
+    ctx = SessionContext.from_json(row.slots_json)
+    ctx.summary = row.summary_text
+    ctx.summary_upto_id = row.summary_upto_id or 0
+    return ctx
+
+def _context_to_row(ctx: SessionContext, row):
+    row.slots_json = ctx.to_json()
+    row.summary_text = ctx.summary
+    row.summary_upto_id = ctx.summary_upto_id or None
+
 def plan_next_question(ctx: SessionContext) -> str:
     if not ctx.slots.get("goal"):
         return "Какова главная бизнес-цель проекта? Укажите ключевые метрики успеха."
@@ -6,10 +6,54 @@ load_dotenv()
 
 # Database
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./dev.db")
+# Async driver URL for request handlers; derived from DATABASE_URL when not set
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
 
 # Gemini / OpenAI
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# Seconds between background model availability probes (reported by /ready)
+AI_PROBE_INTERVAL = float(os.getenv("AI_PROBE_INTERVAL", "300"))
+
+# Cache of deterministic LLM generations (documents, diagram steps);
+# LLM_CACHE_PATH enables a SQLite second tier that survives restarts
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "256"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "")
+# Rendered document HTML (Confluence storage format) kept in memory, entries
+HTML_CACHE_SIZE = int(os.getenv("HTML_CACHE_SIZE", "128"))
+
+# Model router: EWMA smoothing, consecutive failures that open a model's circuit, seconds it stays open
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.3"))
+ROUTER_FAILURE_THRESHOLD = int(os.getenv("ROUTER_FAILURE_THRESHOLD", "3"))
+ROUTER_OPEN_SECONDS = float(os.getenv("ROUTER_OPEN_SECONDS", "30"))
+
+# One deadline (seconds) for all model attempts of a non-streaming LLM call
+LLM_REQUEST_DEADLINE = float(os.getenv("LLM_REQUEST_DEADLINE", "60"))
+# Opt-in hedging: start the next model when the current one is slower than its
+# LLM_HEDGE_PERCENTILE latency (LLM_HEDGE_DELAY seconds until enough samples)
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.9"))
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "3"))
+
+# Admission control for all LLM calls: concurrent calls, wait queue (beyond it -> 429),
+# max wait in the queue, and per-model token buckets (requests/minute, burst).
+# LLM_MODEL_RPM overrides the rate per model, e.g. "gemini-2.5-pro=5,gemini-2.0-flash=15"
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "8"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "32"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))
+LLM_RATE_RPM = float(os.getenv("LLM_RATE_RPM", "60"))
+LLM_RATE_BURST = float(os.getenv("LLM_RATE_BURST", "10"))
+LLM_MODEL_RPM = os.getenv("LLM_MODEL_RPM", "")
+
+# Live Gemini chat objects kept per session (LRU size, idle eviction in seconds)
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "200"))
+CHAT_IDLE_SECONDS = float(os.getenv("CHAT_IDLE_SECONDS", "900"))
+
+# Chat prompt context window: verbatim turns, total token budget and the share of the rolling summary
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", "6"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "800"))
 
 # Confluence Integration
 CONFLUENCE_URL = os.getenv("CONFLUENCE_URL")
@@ -17,6 +61,29 @@ CONFLUENCE_EMAIL = os.getenv("CONFLUENCE_EMAIL")
 CONFLUENCE_API_TOKEN = os.getenv("CONFLUENCE_API_TOKEN")
 CONFLUENCE_SPACE_KEY = os.getenv("CONFLUENCE_SPACE_KEY")
 CONFLUENCE_PARENT_PAGE_ID = os.getenv("CONFLUENCE_PARENT_PAGE_ID")
+# Retries on 429/5xx (exponential backoff from CONFLUENCE_BACKOFF seconds, Retry-After wins) and keep-alive pool size
+CONFLUENCE_RETRIES = int(os.getenv("CONFLUENCE_RETRIES", "3"))
+CONFLUENCE_BACKOFF = float(os.getenv("CONFLUENCE_BACKOFF", "0.5"))
+CONFLUENCE_POOL_SIZE = int(os.getenv("CONFLUENCE_POOL_SIZE", "10"))
+# Publish outbox: parallel publishes, attempts before dead-lettering, backoff between attempts (seconds)
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF = float(os.getenv("OUTBOX_BACKOFF", "5"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "600"))
+# Outbox rows written by other processes are picked up at least this often
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "10"))
+
+# Background jobs (/chat/finish)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Running finish jobs (and outbox sends) hold a lease renewed every third of this;
+# any worker process reclaims a row only after its lease expired (its owner died)
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+# Per-stage deadlines; on expiry the template document / local diagram is used
+DOCUMENT_STAGE_TIMEOUT = float(os.getenv("DOCUMENT_STAGE_TIMEOUT", "60"))
+DIAGRAM_STAGE_TIMEOUT = float(os.getenv("DIAGRAM_STAGE_TIMEOUT", "45"))
+# Re-finish regenerates only sections whose slots changed, when at most this many are stale;
+# otherwise the whole document (0: only an unchanged document is reused as is)
+DOCUMENT_INCREMENTAL_MAX_SECTIONS = int(os.getenv("DOCUMENT_INCREMENTAL_MAX_SECTIONS", "3"))
 
 # Frontend CORS
 FRONTEND_ORIGIN = os.getenv("FRONTEND_ORIGIN", "*")
@@ -0,0 +1,48 @@
+import hashlib
+import logging
+from typing import Awaitable, Callable, Optional, Tuple
+from sqlalchemy.exc import IntegrityError
+from .models import AsyncSessionLocal, DiagramImage
+
+logger = logging.getLogger(__name__)
+
+
+def diagram_hash(description: str) -> str:
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+
+async def load_diagram(digest: str) -> Optional[bytes]:
+    async with AsyncSessionLocal() as db:
+        row = await db.get(DiagramImage, digest)
+        return row.image if row else None
+
+
+async def save_diagram(digest: str, image: bytes):
+    async with AsyncSessionLocal() as db:
+        db.add(DiagramImage(hash=digest, image=image))
+        try:
+            await db.commit()
+        except IntegrityError:
+            # Same description rendered concurrently; the stored copy is equivalent
+            await db.rollback()
+
+
+async def get_or_render_diagram(
+    description: str,
+    render: Callable[[str], Awaitable[Optional[bytes]]],
+    fallback: Callable[[str], Awaitable[Optional[bytes]]],
+) -> Tuple[str, Optional[bytes], bool]:
+    """Return (hash, PNG, stored) for `description`, rendering and storing it only on a miss.
+
+    Only `render` (Gemini) results are stored. When it gives nothing the
+    `fallback` image is returned unstored, so the next call retries `render`.
+    """
+    digest = diagram_hash(description)
+    image = await load_diagram(digest)
+    if image is not None:
+        return digest, image, True
+    image = await render(description)
+    if image:
+        await save_diagram(digest, image)
+        return digest, image, True
+    return digest, await fallback(description), False
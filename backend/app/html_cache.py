@@ -0,0 +1,61 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Tuple
+from .config import HTML_CACHE_SIZE
+from .integrations.storage_renderer import render_storage
+
+
+def markdown_hash(markdown: str) -> str:
+    return hashlib.sha256((markdown or "").encode("utf-8")).hexdigest()
+
+
+class HtmlCache:
+    """Rendered Confluence storage HTML of document Markdown, keyed by sha256 of the Markdown.
+
+    Documents keep only their Markdown; HTML is rendered when something needs
+    it (a Confluence publish, GET /document/{id}/html) and kept in an
+    in-memory LRU. The same Markdown always renders the same HTML, so entries
+    never go stale. Thread-safe: the outbox, the API and the republish
+    threads share it.
+    """
+
+    def __init__(self, max_entries: int = 128):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, markdown: str) -> Tuple[str, str]:
+        """(markdown hash, storage HTML), rendering only on a miss."""
+        digest = markdown_hash(markdown)
+        with self._lock:
+            html = self._entries.get(digest)
+            if html is not None:
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return digest, html
+            self.misses += 1
+        # Rendered outside the lock: a concurrent miss on the same key renders twice, harmlessly
+        html = render_storage(markdown or "")
+        with self._lock:
+            self._entries[digest] = html
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return digest, html
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+html_cache = HtmlCache(HTML_CACHE_SIZE)
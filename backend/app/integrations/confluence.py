@@ -1,20 +1,17 @@
 from typing import Optional
+import asyncio
 import logging
 import re
-import base64
-import requests
-from io import BytesIO
-from ..config import (
-    CONFLUENCE_URL,
-    CONFLUENCE_EMAIL,
-    CONFLUENCE_API_TOKEN,
-    CONFLUENCE_SPACE_KEY,
-    CONFLUENCE_PARENT_PAGE_ID,
-    GEMINI_API_KEY,
-)
+from ..config import GEMINI_API_KEY
+from ..ai.cache import llm_cache
+from ..ai.pool import configured_genai, gemini_models
+from ..ai.admission import AdmissionRejected, admission
+from .confluence_client import DIAGRAM_FILENAME, get_confluence_client
 
 logger = logging.getLogger(__name__)
 
+DIAGRAM_MODEL_NAMES = ["gemini-2.0-flash", "gemini-2.5-flash", "gemini-2.5-pro"]
+
 
 def generate_diagram_image_with_gemini(description: str) -> Optional[bytes]:
     """Generate diagram image - try Gemini first, fallback to PIL-based generation."""
@@ -25,15 +22,99 @@ def generate_diagram_image_with_gemini(description: str) -> Optional[bytes]:
     # Try Gemini first if API key is available
     if api_key:
         try:
-            import google.generativeai as genai
-            genai.configure(api_key=api_key)
+            prompt = _diagram_steps_prompt(description)
+            cached = llm_cache.get_any("gemini", DIAGRAM_MODEL_NAMES, None, prompt)
+            if cached:
+                return _generate_diagram_image(_parse_diagram_steps(cached)[:8], "Диаграмма бизнес-процесса")
+
+            genai = configured_genai(api_key)
 
             # Try different model names (updated for current API)
-            for model_name in ["gemini-2.0-flash", "gemini-2.5-flash", "gemini-2.5-pro"]:
-                try:
-                    model = genai.GenerativeModel(model_name)
+            steps = None
+            with admission.slot():
+                for model_name in DIAGRAM_MODEL_NAMES:
+                    if admission.try_take("gemini", model_name):
+                        continue  # model's rate budget is spent, try the next one
+                    try:
+                        model = gemini_models.get(genai, model_name)
+                        response = model.generate_content(prompt)
+                        parsed = _parse_diagram_steps(response.text)
+
+                        if len(parsed) >= 4:
+                            logger.info(f"Gemini generated {len(parsed)} steps using {model_name}")
+                            llm_cache.put("gemini", model_name, None, prompt, response.text)
+                            steps = parsed
+                            break
+
+                    except Exception as e:
+                        logger.warning(f"Model {model_name} failed: {e}")
+                        continue
+            # Render outside the admission slot
+            if steps:
+                return _generate_diagram_image(steps[:8], "Диаграмма бизнес-процесса")
+
+        except AdmissionRejected:
+            raise
+        except Exception as exc:
+            logger.warning(f"Gemini generation failed: {exc}")
+
+    # Fallback: Parse description and generate diagram
+    logger.info("Using fallback diagram generation")
+    return _generate_diagram_from_description(description)
+
+
+async def generate_diagram_image_with_gemini_async(description: str) -> Optional[bytes]:
+    """Diagram drawn from Gemini's process steps; None when Gemini is not configured or fails.
+
+    Unlike generate_diagram_image_with_gemini there is no built-in fallback:
+    callers render locally (_generate_diagram_from_description) and can tell
+    that render apart, e.g. to avoid storing it. PIL rendering runs in a
+    worker thread.
+    """
+    api_key = GEMINI_API_KEY
+
+    if api_key:
+        try:
+            prompt = _diagram_steps_prompt(description)
+            cached = llm_cache.get_any("gemini", DIAGRAM_MODEL_NAMES, None, prompt)
+            if cached:
+                steps = _parse_diagram_steps(cached)
+                return await asyncio.to_thread(_generate_diagram_image, steps[:8], "Диаграмма бизнес-процесса")
+
+            genai = configured_genai(api_key)
+
+            steps = None
+            async with admission.slot_async():
+                for model_name in DIAGRAM_MODEL_NAMES:
+                    if admission.try_take("gemini", model_name):
+                        continue
+                    try:
+                        model = gemini_models.get(genai, model_name)
+                        response = await model.generate_content_async(prompt)
+                        parsed = _parse_diagram_steps(response.text)
+
+                        if len(parsed) >= 4:
+                            logger.info(f"Gemini generated {len(parsed)} steps using {model_name}")
+                            llm_cache.put("gemini", model_name, None, prompt, response.text)
+                            steps = parsed
+                            break
+
+                    except Exception as e:
+                        logger.warning(f"Model {model_name} failed: {e}")
+                        continue
+            if steps:
+                return await asyncio.to_thread(_generate_diagram_image, steps[:8], "Диаграмма бизнес-процесса")
+
+        except AdmissionRejected:
+            raise
+        except Exception as exc:
+            logger.warning(f"Gemini generation failed: {exc}")
+
+    return None
 
-                    prompt = f"""На основе описания проекта создай список ключевых шагов бизнес-процесса.
+
+def _diagram_steps_prompt(description: str) -> str:
+    return f"""На основе описания проекта создай список ключевых шагов бизнес-процесса.
 
 Описание проекта:
 {description}
@@ -57,34 +138,18 @@ def generate_diagram_image_with_gemini(description: str) -> Optional[bytes]:
 Мониторинг результатов
 Завершение проекта"""
 
-                    response = model.generate_content(prompt)
-                    steps_text = response.text.strip()
-
-                    # Parse steps
-                    steps = []
-                    for line in steps_text.split("\n"):
-                        line = line.strip()
-                        # Remove numbering if present
-                        line = re.sub(r"^\d+[\.\)]\s*", "", line)
-                        line = re.sub(r"^[-*•]\s*", "", line)
-                        line = re.sub(r"^\*\*.*?\*\*:?\s*", "", line)  # Remove **bold** prefixes
-                        if line and 3 < len(line) < 80:
-                            steps.append(line[:60])
-
-                    if len(steps) >= 4:
-                        logger.info(f"Gemini generated {len(steps)} steps using {model_name}")
-                        return _generate_diagram_image(steps[:8], "Диаграмма бизнес-процесса")
-
-                except Exception as e:
-                    logger.warning(f"Model {model_name} failed: {e}")
-                    continue
-
-        except Exception as exc:
-            logger.warning(f"Gemini generation failed: {exc}")
 
-    # Fallback: Parse description and generate diagram
-    logger.info("Using fallback diagram generation")
-    return _generate_diagram_from_description(description)
+def _parse_diagram_steps(steps_text: str) -> list:
+    steps = []
+    for line in steps_text.strip().split("\n"):
+        line = line.strip()
+        # Remove numbering if present
+        line = re.sub(r"^\d+[\.\)]\s*", "", line)
+        line = re.sub(r"^[-*•]\s*", "", line)
+        line = re.sub(r"^\*\*.*?\*\*:?\s*", "", line)  # Remove **bold** prefixes
+        if line and 3 < len(line) < 80:
+            steps.append(line[:60])
+    return steps
 
 
 def _generate_diagram_from_description(description: str) -> Optional[bytes]:
@@ -291,45 +356,10 @@ def _generate_diagram_image(steps: list, title: str) -> Optional[bytes]:
 
 def upload_attachment_to_confluence(page_id: str, filename: str, image_data: bytes) -> Optional[str]:
     """Upload an image attachment to a Confluence page."""
-    if not (CONFLUENCE_URL and CONFLUENCE_EMAIL and CONFLUENCE_API_TOKEN):
-        return None
-
-    auth = (CONFLUENCE_EMAIL, CONFLUENCE_API_TOKEN)
-    url = f"{CONFLUENCE_URL}/rest/api/content/{page_id}/child/attachment"
-
-    headers = {
-        "X-Atlassian-Token": "nocheck",
-    }
-
-    files = {
-        "file": (filename, BytesIO(image_data), "image/png"),
-    }
-
-    try:
-        # Check if attachment exists
-        check_url = f"{url}?filename={filename}"
-        resp = requests.get(check_url, auth=auth, timeout=15)
-        resp.raise_for_status()
-        existing = resp.json().get("results", [])
-
-        if existing:
-            # Update existing attachment
-            att_id = existing[0]["id"]
-            update_url = (
-                f"{CONFLUENCE_URL}/rest/api/content/{page_id}/child/attachment/{att_id}/data"
-            )
-            resp = requests.post(update_url, files=files, auth=auth, headers=headers, timeout=30)
-        else:
-            # Create new attachment
-            resp = requests.post(url, files=files, auth=auth, headers=headers, timeout=30)
-
-        resp.raise_for_status()
-        logger.info("Uploaded attachment '%s' to page %s", filename, page_id)
-        return filename
-
-    except Exception as exc:
-        logger.error("Failed to upload attachment: %s", exc)
+    client = get_confluence_client()
+    if client is None:
         return None
+    return client.upload_attachment(page_id, filename, image_data)
 
 
 def extract_mermaid_from_html(html: str) -> Optional[str]:
@@ -375,13 +405,11 @@ def replace_mermaid_with_image(html: str, image_filename: str) -> str:
 
 def publish_to_confluence(title: str, html: str) -> Optional[str]:
     """Создать новую страницу в Confluence (без обновления существующей)."""
-    if not (CONFLUENCE_URL and CONFLUENCE_EMAIL and CONFLUENCE_API_TOKEN and CONFLUENCE_SPACE_KEY):
+    client = get_confluence_client()
+    if client is None:
         logger.info("Confluence credentials are not configured; skipping publish.")
         return None
 
-    auth = (CONFLUENCE_EMAIL, CONFLUENCE_API_TOKEN)
-    headers = {"Content-Type": "application/json"}
-
     # Extract Mermaid code for diagram generation
     mermaid_code = extract_mermaid_from_html(html)
     diagram_image = None
@@ -390,33 +418,17 @@ def publish_to_confluence(title: str, html: str) -> Optional[str]:
         logger.info("Found Mermaid diagram, generating image with Gemini...")
         diagram_image = generate_diagram_image_with_gemini(mermaid_code)
 
-    # First create the page (no search), include ancestors only on create
     html_to_publish = html
     if diagram_image:
-        html_to_publish = replace_mermaid_with_image(html, "process_diagram.png")
-
-    payload = {
-        "type": "page",
-        "title": title,
-        "space": {"key": CONFLUENCE_SPACE_KEY},
-        "body": {"storage": {"value": html_to_publish, "representation": "storage"}},
-    }
-
-    if CONFLUENCE_PARENT_PAGE_ID:
-        payload["ancestors"] = [{"id": int(CONFLUENCE_PARENT_PAGE_ID)}]
+        html_to_publish = replace_mermaid_with_image(html, DIAGRAM_FILENAME)
 
     try:
-        url = f"{CONFLUENCE_URL}/rest/api/content"
-        resp = requests.post(url, json=payload, auth=auth, headers=headers, timeout=15)
-        resp.raise_for_status()
-        logger.info("Created Confluence page '%s'.", title)
-        js = resp.json()
-
+        js = client.create_page(title, html_to_publish)
         page_id = js.get("id")
 
         # Upload diagram image as attachment
         if diagram_image and page_id:
-            upload_attachment_to_confluence(page_id, "process_diagram.png", diagram_image)
+            client.upload_attachment(page_id, DIAGRAM_FILENAME, diagram_image)
 
     except Exception as exc:
         logger.error("Confluence publish failed: %s", exc)
@@ -424,95 +436,15 @@ def publish_to_confluence(title: str, html: str) -> Optional[str]:
             logger.error("Response: %s", exc.response.text)
         return None
 
-    link = js.get("_links", {}).get("webui")
-    if link and CONFLUENCE_URL:
-        return f"{CONFLUENCE_URL}{link}"
-    return None
+    return client.page_url(js)
 
 
 def publish_to_confluence_with_diagram(
     title: str, html: str, diagram_image: Optional[bytes] = None
 ) -> Optional[str]:
     """Publish to Confluence with a pre-generated diagram image (create or update)."""
-    if not (CONFLUENCE_URL and CONFLUENCE_EMAIL and CONFLUENCE_API_TOKEN and CONFLUENCE_SPACE_KEY):
+    client = get_confluence_client()
+    if client is None:
         logger.info("Confluence credentials are not configured; skipping publish.")
         return None
-
-    auth = (CONFLUENCE_EMAIL, CONFLUENCE_API_TOKEN)
-    headers = {"Content-Type": "application/json"}
-    search_url = f"{CONFLUENCE_URL}/rest/api/content"
-    params = {
-        "title": title,
-        "spaceKey": CONFLUENCE_SPACE_KEY,
-        "expand": "version",
-    }
-
-    try:
-        resp = requests.get(search_url, params=params, auth=auth, headers=headers, timeout=15)
-        resp.raise_for_status()
-        results = resp.json().get("results", [])
-    except Exception as exc:
-        logger.error("Confluence search failed: %s", exc)
-        return None
-
-    # Если есть диаграмма — добавляем секцию с изображением в конец страницы
-    html_to_publish = html
-    if diagram_image:
-        diagram_section = """
-<h2>Диаграмма бизнес-процесса</h2>
-<ac:image ac:align="center" ac:layout="center" ac:width="800">
-    <ri:attachment ri:filename="process_diagram.png"/>
-</ac:image>
-"""
-        html_to_publish = html + diagram_section
-
-    is_update = bool(results)
-
-    data = {
-        "type": "page",
-        "title": title,
-        "space": {"key": CONFLUENCE_SPACE_KEY},
-        "body": {"storage": {"value": html_to_publish, "representation": "storage"}},
-    }
-
-    # ВАЖНО: ancestors только при СОЗДАНИИ, при обновлении не трогаем родителя
-    if CONFLUENCE_PARENT_PAGE_ID and not is_update:
-        data["ancestors"] = [{"id": int(CONFLUENCE_PARENT_PAGE_ID)}]
-
-    try:
-        if is_update:
-            page = results[0]
-            page_id = page["id"]
-            version = page.get("version", {}).get("number", 1) + 1
-            data["version"] = {"number": version}
-
-            url = f"{CONFLUENCE_URL}/rest/api/content/{page_id}"
-            resp = requests.put(url, json=data, auth=auth, headers=headers, timeout=15)
-            resp.raise_for_status()
-            logger.info("Updated Confluence page '%s' (v%s).", title, version)
-            js = resp.json()
-        else:
-            url = f"{CONFLUENCE_URL}/rest/api/content"
-            resp = requests.post(url, json=data, auth=auth, headers=headers, timeout=15)
-            resp.raise_for_status()
-            logger.info("Created Confluence page '%s'.", title)
-            js = resp.json()
-            page_id = js.get("id")
-
-        page_id = js.get("id")
-
-        # Upload diagram image as attachment
-        if diagram_image and page_id:
-            upload_attachment_to_confluence(page_id, "process_diagram.png", diagram_image)
-            logger.info("Uploaded diagram to Confluence page %s", page_id)
-
-    except Exception as exc:
-        logger.error("Confluence publish failed: %s", exc)
-        if hasattr(exc, "response") and exc.response is not None:
-            logger.error("Response: %s", exc.response.text)
-        return None
-
-    link = js.get("_links", {}).get("webui")
-    if link and CONFLUENCE_URL:
-        return f"{CONFLUENCE_URL}{link}"
-    return None
+    return client.publish_with_diagram(title, html, diagram_image)
@@ -0,0 +1,296 @@
+from typing import Optional
+import asyncio
+import logging
+import httpx
+from ..config import (
+    CONFLUENCE_URL,
+    CONFLUENCE_EMAIL,
+    CONFLUENCE_API_TOKEN,
+    CONFLUENCE_SPACE_KEY,
+    CONFLUENCE_PARENT_PAGE_ID,
+    CONFLUENCE_POOL_SIZE,
+)
+from .confluence_client import DIAGRAM_FILENAME, TIMEOUTS, PageState, RetryPolicy, plan_publish
+
+logger = logging.getLogger(__name__)
+
+# upload_attachment: existence of the attachment is not known yet
+_LOOKUP = object()
+
+
+class AsyncConfluenceClient:
+    """Async Confluence REST client for use from async FastAPI handlers.
+
+    Mirrors ConfluenceClient in confluence_client.py (same retry policy and
+    per-operation timeouts), but keeps a single httpx.AsyncClient so the
+    event loop is never blocked on Confluence I/O.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        email: str,
+        api_token: str,
+        space_key: str,
+        parent_page_id: Optional[str] = None,
+        pool_size: int = CONFLUENCE_POOL_SIZE,
+        retry: Optional[RetryPolicy] = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.space_key = space_key
+        self.parent_page_id = parent_page_id
+        self.retry = retry or RetryPolicy()
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            auth=(email, api_token),
+            timeout=_timeout("search"),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def request(self, method: str, path: str, op: str = "search", **kwargs) -> httpx.Response:
+        """Send with retries; raises for the final non-2xx response."""
+        kwargs.setdefault("timeout", _timeout(op))
+        attempt = 0
+        while True:
+            try:
+                resp = await self._client.request(method, path, **kwargs)
+            except httpx.TransportError as exc:
+                # A POST that may have reached the server is not repeated
+                retriable = method.upper() != "POST" or isinstance(exc, (httpx.ConnectError, httpx.ConnectTimeout))
+                if not retriable or attempt >= self.retry.retries:
+                    raise
+                wait = self.retry.delay(attempt)
+                logger.warning("Confluence %s %s failed (%s); retrying in %.1fs", method, path, exc, wait)
+            else:
+                if resp.status_code < 400 or not self.retry.should_retry(method, resp.status_code, attempt):
+                    resp.raise_for_status()
+                    return resp
+                wait = self.retry.delay(attempt, resp.headers.get("Retry-After"))
+                logger.warning("Confluence %s %s -> %s; retrying in %.1fs", method, path, resp.status_code, wait)
+            await asyncio.sleep(wait)
+            attempt += 1
+
+    async def find_page(self, title: str, with_attachments: bool = False) -> Optional[dict]:
+        # children.attachment folds the attachment existence check into the search round trip
+        expand = "version,children.attachment" if with_attachments else "version"
+        params = {"title": title, "spaceKey": self.space_key, "expand": expand}
+        resp = await self.request("GET", "/rest/api/content", "search", params=params)
+        results = resp.json().get("results", [])
+        return results[0] if results else None
+
+    async def create_page(self, title: str, html: str) -> dict:
+        data = self._page_payload(title, html)
+        # ancestors только при создании, при обновлении не трогаем родителя
+        if self.parent_page_id:
+            data["ancestors"] = [{"id": int(self.parent_page_id)}]
+        resp = await self.request("POST", "/rest/api/content", "write", json=data)
+        logger.info("Created Confluence page '%s'.", title)
+        return resp.json()
+
+    async def update_page(self, page_id: str, title: str, html: str, version: int) -> dict:
+        data = self._page_payload(title, html)
+        data["version"] = {"number": version}
+        resp = await self.request("PUT", f"/rest/api/content/{page_id}", "write", json=data)
+        logger.info("Updated Confluence page '%s' (v%s).", title, version)
+        return resp.json()
+
+    async def upload_attachment(self, page_id: str, filename: str, data: bytes, existing_id=_LOOKUP) -> str:
+        """Create or replace `filename` on the page; raises when the upload fails.
+
+        `existing_id` skips the existence check when the caller already knows
+        it: an attachment id to update, or None to create.
+        """
+        url = f"/rest/api/content/{page_id}/child/attachment"
+        headers = {"X-Atlassian-Token": "nocheck"}
+        files = {"file": (filename, data, "image/png")}
+        if existing_id is _LOOKUP:
+            existing_id = await self._attachment_id(page_id, filename)
+        try:
+            target = f"{url}/{existing_id}/data" if existing_id else url
+            await self.request("POST", target, "attachment", files=files, headers=headers)
+        except httpx.HTTPStatusError as exc:
+            # Created concurrently or missed by a paginated listing: look it up and replace
+            if existing_id is not None or exc.response.status_code != 400:
+                raise
+            existing_id = await self._attachment_id(page_id, filename)
+            if not existing_id:
+                raise
+            await self.request("POST", f"{url}/{existing_id}/data", "attachment", files=files, headers=headers)
+        logger.info("Uploaded attachment '%s' to page %s", filename, page_id)
+        return filename
+
+    async def _attachment_id(self, page_id: str, filename: str) -> Optional[str]:
+        url = f"/rest/api/content/{page_id}/child/attachment"
+        resp = await self.request("GET", url, "search", params={"filename": filename})
+        existing = resp.json().get("results", [])
+        return existing[0]["id"] if existing else None
+
+    async def get_page(self, page_id: str) -> dict:
+        resp = await self.request("GET", f"/rest/api/content/{page_id}", "search", params={"expand": "version"})
+        return resp.json()
+
+    async def publish_with_diagram(self, title: str, html: str, diagram_image: Optional[bytes] = None) -> Optional[str]:
+        """Create or update the page titled `title`; returns its web URL, None when publishing failed."""
+        try:
+            state = await self.sync_page(title, html, diagram_image)
+        except Exception:
+            return None
+        return state.url if state else None
+
+    async def sync_page(
+        self, title: str, html: str, diagram_image: Optional[bytes] = None, known: Optional[PageState] = None
+    ) -> PageState:
+        """Async counterpart of ConfluenceClient.sync_page: only what changed since `known` is written.
+
+        Round trips are pipelined: the title search also lists the page's
+        attachments, and the diagram upload runs concurrently with the body
+        update whenever the page id is known (stored, found or just created).
+        Any failure, including the diagram upload, is raised: the body refers
+        to the attachment, so the caller (the outbox) retries the whole publish.
+        """
+        html_to_publish, body_hash, attachment_hash, update_body, upload = plan_publish(
+            title, html, diagram_image, known
+        )
+        if known is not None and known.page_id and not update_body and not upload:
+            return known
+
+        # The attachment upload runs next to the page write: it only needs the page id
+        upload_task = None
+        uploaded_now = False
+        try:
+            js = None
+            if known is not None and known.page_id:
+                if upload:
+                    upload_task = asyncio.create_task(
+                        self.upload_attachment(known.page_id, DIAGRAM_FILENAME, diagram_image)
+                    )
+                if update_body:
+                    js = await self._update_known(known, title, html_to_publish)
+                else:
+                    js = {"id": known.page_id, "version": {"number": known.version}}
+                if upload_task is not None and js is None:
+                    # The stored page is gone: the upload to it is moot, redo it below
+                    upload_task.cancel()
+                    await asyncio.gather(upload_task, return_exceptions=True)
+                    upload_task = None
+                if upload_task is not None:
+                    await upload_task
+                    upload_task, uploaded_now = None, True
+            if js is None:
+                # Unknown page, or the known one was deleted: fall back to the title search
+                page = await self.find_page(title, with_attachments=bool(diagram_image))
+                if page:
+                    if diagram_image:
+                        upload_task = asyncio.create_task(self.upload_attachment(
+                            page["id"], DIAGRAM_FILENAME, diagram_image, _listed_attachment_id(page, DIAGRAM_FILENAME)
+                        ))
+                    version = page.get("version", {}).get("number", 1) + 1
+                    js = await self.update_page(page["id"], title, html_to_publish, version)
+                else:
+                    js = await self.create_page(title, html_to_publish)
+                    if diagram_image and js.get("id"):
+                        # A new page has no attachments: no existence check
+                        upload_task = asyncio.create_task(
+                            self.upload_attachment(js["id"], DIAGRAM_FILENAME, diagram_image, None)
+                        )
+                if upload_task is not None:
+                    await upload_task
+                    upload_task, uploaded_now = None, True
+        except Exception as exc:
+            if upload_task is not None:
+                upload_task.cancel()
+            logger.error("Confluence publish failed: %s", exc)
+            if isinstance(exc, httpx.HTTPStatusError):
+                logger.error("Response: %s", exc.response.text)
+            raise
+
+        page_id = js.get("id")
+        uploaded = known.attachment_hash if known is not None and known.page_id == page_id else None
+        if uploaded_now:
+            uploaded = attachment_hash
+        return PageState(
+            page_id,
+            js.get("version", {}).get("number"),
+            self.page_url(js) or (known.url if known is not None else None),
+            body_hash,
+            uploaded,
+        )
+
+    async def _update_known(self, known: PageState, title: str, html: str) -> Optional[dict]:
+        """PUT to the stored page id; None when the page no longer exists."""
+        try:
+            return await self.update_page(known.page_id, title, html, (known.version or 1) + 1)
+        except httpx.HTTPStatusError as exc:
+            if exc.response.status_code == 404:
+                return None
+            if exc.response.status_code != 409:
+                raise
+        # Edited in Confluence since our last publish: retry on top of its current version
+        current = await self.get_page(known.page_id)
+        version = current.get("version", {}).get("number", 1) + 1
+        return await self.update_page(known.page_id, title, html, version)
+
+    def page_url(self, js: dict) -> Optional[str]:
+        link = js.get("_links", {}).get("webui")
+        if link:
+            return f"{self.base_url}{link}"
+        return None
+
+    def _page_payload(self, title: str, html: str) -> dict:
+        return {
+            "type": "page",
+            "title": title,
+            "space": {"key": self.space_key},
+            "body": {"storage": {"value": html, "representation": "storage"}},
+        }
+
+
+def _listed_attachment_id(page: dict, filename: str) -> Optional[str]:
+    """Attachment id from a page fetched with expand=children.attachment; None when absent."""
+    results = ((page.get("children") or {}).get("attachment") or {}).get("results") or []
+    return next((a["id"] for a in results if a.get("title") == filename), None)
+
+
+def _timeout(op: str) -> httpx.Timeout:
+    connect, read = TIMEOUTS[op]
+    return httpx.Timeout(read, connect=connect)
+
+
+_client: Optional[AsyncConfluenceClient] = None
+
+
+def get_async_confluence_client() -> Optional[AsyncConfluenceClient]:
+    """Shared client built from config, or None when Confluence is not configured."""
+    global _client
+    if not (CONFLUENCE_URL and CONFLUENCE_EMAIL and CONFLUENCE_API_TOKEN and CONFLUENCE_SPACE_KEY):
+        return None
+    if _client is None:
+        _client = AsyncConfluenceClient(
+            CONFLUENCE_URL,
+            CONFLUENCE_EMAIL,
+            CONFLUENCE_API_TOKEN,
+            CONFLUENCE_SPACE_KEY,
+            CONFLUENCE_PARENT_PAGE_ID,
+        )
+    return _client
+
+
+async def close_async_confluence_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def sync_confluence_page_async(
+    title: str, html: str, diagram_image: Optional[bytes] = None, known: Optional[PageState] = None
+) -> Optional[PageState]:
+    """Publish skipping whatever is unchanged since `known` (the document's stored PageState)."""
+    client = get_async_confluence_client()
+    if client is None:
+        logger.info("Confluence credentials are not configured; skipping publish.")
+        return None
+    return await client.sync_page(title, html, diagram_image, known)
@@ -0,0 +1,358 @@
+from typing import Optional
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import hashlib
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from ..config import (
+    CONFLUENCE_URL,
+    CONFLUENCE_EMAIL,
+    CONFLUENCE_API_TOKEN,
+    CONFLUENCE_SPACE_KEY,
+    CONFLUENCE_PARENT_PAGE_ID,
+    CONFLUENCE_RETRIES,
+    CONFLUENCE_BACKOFF,
+    CONFLUENCE_POOL_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+DIAGRAM_FILENAME = "process_diagram.png"
+
+# (connect, read) timeouts per operation: searches are cheap, attachments are large
+TIMEOUTS = {
+    "search": (5.0, 15.0),
+    "write": (5.0, 30.0),
+    "attachment": (5.0, 60.0),
+}
+
+
+class RetryPolicy:
+    """When and how long to wait before retrying a Confluence request.
+
+    429 and 5xx are retried with exponential backoff and jitter, honouring
+    Retry-After. Non-idempotent requests (POST) are only retried when the
+    server says it did not process them (429, 503).
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    UNPROCESSED_STATUSES = {429, 503}
+
+    def __init__(self, retries: int = CONFLUENCE_RETRIES, backoff: float = CONFLUENCE_BACKOFF,
+                 max_delay: float = 30.0):
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.max_delay = max_delay
+
+    def should_retry(self, method: str, status: int, attempt: int) -> bool:
+        if attempt >= self.retries:
+            return False
+        if method.upper() == "POST":
+            return status in self.UNPROCESSED_STATUSES
+        return status in self.RETRY_STATUSES
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        hinted = _parse_retry_after(retry_after)
+        if hinted is not None:
+            return min(self.max_delay, hinted)
+        return min(self.max_delay, self.backoff * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def with_diagram_section(html: str) -> str:
+    """Append the diagram section referencing the uploaded attachment to the page body."""
+    return html + f"""
+<h2>Диаграмма бизнес-процесса</h2>
+<ac:image ac:align="center" ac:layout="center" ac:width="800">
+    <ri:attachment ri:filename="{DIAGRAM_FILENAME}"/>
+</ac:image>
+"""
+
+
+def content_hash(data) -> str:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class PageState:
+    """What was last published for a document; persisted on RequirementDocument."""
+
+    __slots__ = ("page_id", "version", "url", "body_hash", "attachment_hash")
+
+    def __init__(self, page_id=None, version=None, url=None, body_hash=None, attachment_hash=None):
+        self.page_id = page_id
+        self.version = version
+        self.url = url
+        self.body_hash = body_hash
+        self.attachment_hash = attachment_hash
+
+    @classmethod
+    def from_document(cls, doc) -> "PageState":
+        return cls(
+            doc.confluence_page_id,
+            doc.confluence_version,
+            doc.confluence_url,
+            doc.confluence_body_hash,
+            doc.confluence_attachment_hash,
+        )
+
+    def apply_to(self, doc):
+        doc.confluence_page_id = self.page_id
+        doc.confluence_version = self.version
+        doc.confluence_url = self.url
+        doc.confluence_body_hash = self.body_hash
+        doc.confluence_attachment_hash = self.attachment_hash
+
+
+def plan_publish(title: str, html: str, diagram_image: Optional[bytes], known: Optional[PageState]):
+    """Page body to publish and which writes `known` makes unnecessary.
+
+    Returns (html_to_publish, body_hash, attachment_hash, update_body, upload_attachment).
+    """
+    html_to_publish = with_diagram_section(html) if diagram_image else html
+    body_hash = content_hash(f"{title}\n{html_to_publish}")
+    attachment_hash = content_hash(diagram_image) if diagram_image else None
+    if known is None or not known.page_id:
+        return html_to_publish, body_hash, attachment_hash, True, bool(diagram_image)
+    update_body = body_hash != known.body_hash
+    upload = bool(diagram_image) and attachment_hash != known.attachment_hash
+    return html_to_publish, body_hash, attachment_hash, update_body, upload
+
+
+class ConfluenceClient:
+    """Confluence REST client over one keep-alive requests.Session.
+
+    The session's connection pool is shared by all threads, so the search,
+    page write and attachment calls of a publish reuse the same TLS
+    connection instead of opening one each.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        email: str,
+        api_token: str,
+        space_key: str,
+        parent_page_id: Optional[str] = None,
+        pool_size: int = CONFLUENCE_POOL_SIZE,
+        retry: Optional[RetryPolicy] = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.space_key = space_key
+        self.parent_page_id = parent_page_id
+        self.retry = retry or RetryPolicy()
+        self._session = requests.Session()
+        self._session.auth = (email, api_token)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+    def close(self):
+        self._session.close()
+
+    def request(self, method: str, path: str, op: str = "search", **kwargs) -> requests.Response:
+        """Send with retries; raises for the final non-2xx response."""
+        url = f"{self.base_url}{path}"
+        kwargs.setdefault("timeout", TIMEOUTS[op])
+        attempt = 0
+        while True:
+            try:
+                resp = self._session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                # A POST that may have reached the server is not repeated
+                retriable = method.upper() != "POST" or isinstance(exc, requests.ConnectTimeout)
+                if not retriable or attempt >= self.retry.retries:
+                    raise
+                wait = self.retry.delay(attempt)
+                logger.warning("Confluence %s %s failed (%s); retrying in %.1fs", method, path, exc, wait)
+            else:
+                if resp.status_code < 400 or not self.retry.should_retry(method, resp.status_code, attempt):
+                    resp.raise_for_status()
+                    return resp
+                wait = self.retry.delay(attempt, resp.headers.get("Retry-After"))
+                logger.warning("Confluence %s %s -> %s; retrying in %.1fs", method, path, resp.status_code, wait)
+            _rewind_files(kwargs)
+            time.sleep(wait)
+            attempt += 1
+
+    def find_page(self, title: str) -> Optional[dict]:
+        params = {"title": title, "spaceKey": self.space_key, "expand": "version"}
+        resp = self.request("GET", "/rest/api/content", "search", params=params)
+        results = resp.json().get("results", [])
+        return results[0] if results else None
+
+    def create_page(self, title: str, html: str) -> dict:
+        data = self._page_payload(title, html)
+        # ancestors только при создании, при обновлении не трогаем родителя
+        if self.parent_page_id:
+            data["ancestors"] = [{"id": int(self.parent_page_id)}]
+        resp = self.request("POST", "/rest/api/content", "write", json=data)
+        logger.info("Created Confluence page '%s'.", title)
+        return resp.json()
+
+    def update_page(self, page_id: str, title: str, html: str, version: int) -> dict:
+        data = self._page_payload(title, html)
+        data["version"] = {"number": version}
+        resp = self.request("PUT", f"/rest/api/content/{page_id}", "write", json=data)
+        logger.info("Updated Confluence page '%s' (v%s).", title, version)
+        return resp.json()
+
+    def upload_attachment(self, page_id: str, filename: str, data: bytes) -> Optional[str]:
+        path = f"/rest/api/content/{page_id}/child/attachment"
+        headers = {"X-Atlassian-Token": "nocheck"}
+        try:
+            resp = self.request("GET", path, "search", params={"filename": filename})
+            existing = resp.json().get("results", [])
+            if existing:
+                path = f"{path}/{existing[0]['id']}/data"
+            files = {"file": (filename, data, "image/png")}
+            self.request("POST", path, "attachment", files=files, headers=headers)
+            logger.info("Uploaded attachment '%s' to page %s", filename, page_id)
+            return filename
+        except Exception as exc:
+            logger.error("Failed to upload attachment: %s", exc)
+            return None
+
+    def get_page(self, page_id: str) -> dict:
+        resp = self.request("GET", f"/rest/api/content/{page_id}", "search", params={"expand": "version"})
+        return resp.json()
+
+    def publish_with_diagram(self, title: str, html: str, diagram_image: Optional[bytes] = None) -> Optional[str]:
+        """Create or update the page titled `title`; returns its web URL."""
+        state = self.sync_page(title, html, diagram_image)
+        return state.url if state else None
+
+    def sync_page(
+        self, title: str, html: str, diagram_image: Optional[bytes] = None, known: Optional[PageState] = None
+    ) -> Optional[PageState]:
+        """Bring the page in line with `html`/`diagram_image`, writing only what changed since `known`.
+
+        With a known page id the title search is skipped; an unchanged body and
+        attachment cost no requests at all. Returns the new state, or None on failure.
+        """
+        html_to_publish, body_hash, attachment_hash, update_body, upload = plan_publish(
+            title, html, diagram_image, known
+        )
+        if known is not None and known.page_id and not update_body and not upload:
+            return known
+
+        try:
+            js = None
+            if known is not None and known.page_id:
+                if update_body:
+                    js = self._update_known(known, title, html_to_publish)
+                else:
+                    js = {"id": known.page_id, "version": {"number": known.version}}
+            if js is None:
+                # Unknown page, or the known one was deleted: fall back to the title search
+                page = self.find_page(title)
+                if page:
+                    version = page.get("version", {}).get("number", 1) + 1
+                    js = self.update_page(page["id"], title, html_to_publish, version)
+                else:
+                    js = self.create_page(title, html_to_publish)
+                upload = bool(diagram_image)
+        except Exception as exc:
+            logger.error("Confluence publish failed: %s", exc)
+            if getattr(exc, "response", None) is not None:
+                logger.error("Response: %s", exc.response.text)
+            return None
+
+        page_id = js.get("id")
+        uploaded = known.attachment_hash if known is not None and known.page_id == page_id else None
+        if upload and page_id and self.upload_attachment(page_id, DIAGRAM_FILENAME, diagram_image):
+            uploaded = attachment_hash
+        return PageState(
+            page_id,
+            js.get("version", {}).get("number"),
+            self.page_url(js) or (known.url if known is not None else None),
+            body_hash,
+            uploaded,
+        )
+
+    def _update_known(self, known: PageState, title: str, html: str) -> Optional[dict]:
+        """PUT to the stored page id; None when the page no longer exists."""
+        try:
+            return self.update_page(known.page_id, title, html, (known.version or 1) + 1)
+        except requests.HTTPError as exc:
+            status = exc.response.status_code if exc.response is not None else None
+            if status == 404:
+                return None
+            if status != 409:
+                raise
+        # Edited in Confluence since our last publish: retry on top of its current version
+        current = self.get_page(known.page_id)
+        version = current.get("version", {}).get("number", 1) + 1
+        return self.update_page(known.page_id, title, html, version)
+
+    def page_url(self, js: dict) -> Optional[str]:
+        link = js.get("_links", {}).get("webui")
+        if link:
+            return f"{self.base_url}{link}"
+        return None
+
+    def _page_payload(self, title: str, html: str) -> dict:
+        return {
+            "type": "page",
+            "title": title,
+            "space": {"key": self.space_key},
+            "body": {"storage": {"value": html, "representation": "storage"}},
+        }
+
+
+def _rewind_files(kwargs: dict):
+    # File objects are consumed by a failed attempt; bytes payloads need nothing
+    for value in (kwargs.get("files") or {}).values():
+        fileobj = value[1] if isinstance(value, tuple) else value
+        if hasattr(fileobj, "seek"):
+            fileobj.seek(0)
+
+
+_client: Optional[ConfluenceClient] = None
+_client_lock = threading.Lock()
+
+
+def get_confluence_client() -> Optional[ConfluenceClient]:
+    """Shared client built from config, or None when Confluence is not configured."""
+    global _client
+    if not (CONFLUENCE_URL and CONFLUENCE_EMAIL and CONFLUENCE_API_TOKEN and CONFLUENCE_SPACE_KEY):
+        return None
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = ConfluenceClient(
+                    CONFLUENCE_URL,
+                    CONFLUENCE_EMAIL,
+                    CONFLUENCE_API_TOKEN,
+                    CONFLUENCE_SPACE_KEY,
+                    CONFLUENCE_PARENT_PAGE_ID,
+                )
+    return _client
+
+
+def close_confluence_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
@@ -0,0 +1,286 @@
+import re
+from typing import List, Optional
+
+# Block-level patterns; tabs are expanded to 4 spaces before matching
+_FENCE = re.compile(r"^ {0,3}(`{3,}|~{3,})\s*([\w+#.-]*)")
+_HEADING = re.compile(r"^ {0,3}(#{1,6})\s+(.*?)(?:\s+#+)?\s*$")
+_HR = re.compile(r"^ {0,3}([-*_])(?:\s*\1){2,}\s*$")
+_LIST = re.compile(r"^( *)([-*+]|\d{1,9}[.)])\s+(.*)$")
+_QUOTE = re.compile(r"^ {0,3}> ?(.*)$")
+_TABLE_SEP = re.compile(r"^\s*\|?\s*:?-+:?\s*(?:\|\s*:?-+:?\s*)*\|?\s*$")
+
+# Inline spans, tried left to right in one scan of the text
+_INLINE = re.compile(
+    r"(?P<tick>`+)(?P<code>.+?)(?P=tick)"
+    r"|\*\*(?P<strong>.+?)\*\*"
+    r"|__(?P<strong2>.+?)__"
+    r"|~~(?P<del>.+?)~~"
+    r"|\[(?P<text>[^\]]+)\]\((?P<url>[^)\s]+)(?:\s+\"[^\"]*\")?\)"
+    r"|(?<![\w*])\*(?P<em>[^*\s](?:[^*]*[^*\s])?)\*(?![\w*])"
+    r"|(?<![\w_])_(?P<em2>[^_\s](?:[^_]*[^_\s])?)_(?![\w_])"
+)
+
+
+def escape(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+def render_storage(markdown: str, diagram_filename: Optional[str] = None) -> str:
+    """Render BRD Markdown straight to Confluence storage format (XHTML + ac: macros).
+
+    One pass over the lines: fenced and indented code become `code` macros,
+    a ```mermaid block becomes an `ac:image` of the `diagram_filename`
+    attachment (or a code macro when no diagram is attached). Supports ATX
+    headings, paragraphs, nested bullet/numbered lists, pipe tables,
+    blockquotes, rules and **bold** / *italic* / ~~strike~~ / `code` / links.
+    Raw HTML is escaped, so the output is always well-formed. Pure function:
+    safe to call from any number of threads.
+    """
+    lines = (markdown or "").replace("\r\n", "\n").replace("\r", "\n").expandtabs(4).split("\n")
+    out: List[str] = []
+    _render_blocks(lines, out, diagram_filename)
+    return "\n".join(out)
+
+
+def find_mermaid(markdown: str) -> Optional[str]:
+    """Source of the first ```mermaid block, without rendering the document."""
+    lines = (markdown or "").replace("\r\n", "\n").split("\n")
+    for i, line in enumerate(lines):
+        m = _FENCE.match(line)
+        if m and m.group(2).lower() == "mermaid":
+            body, _ = _fenced_body(lines, i, m.group(1))
+            return "\n".join(body).strip()
+    return None
+
+
+def _render_blocks(lines: List[str], out: List[str], diagram_filename: Optional[str]):
+    para: List[str] = []
+    i, n = 0, len(lines)
+
+    def flush():
+        if para:
+            out.append("<p>" + _paragraph(para) + "</p>")
+            para.clear()
+
+    while i < n:
+        line = lines[i]
+        if not line.strip():
+            flush()
+            i += 1
+            continue
+
+        m = _FENCE.match(line)
+        if m:
+            flush()
+            body, i = _fenced_body(lines, i, m.group(1))
+            out.append(_code_block(body, m.group(2), diagram_filename))
+            continue
+
+        m = _HEADING.match(line)
+        if m:
+            flush()
+            level = len(m.group(1))
+            out.append(f"<h{level}>{_inline(m.group(2))}</h{level}>")
+            i += 1
+            continue
+
+        if _HR.match(line):
+            flush()
+            out.append("<hr/>")
+            i += 1
+            continue
+
+        if "|" in line and i + 1 < n and _TABLE_SEP.match(lines[i + 1]) and "-" in lines[i + 1]:
+            flush()
+            i = _table(lines, i, out)
+            continue
+
+        if _QUOTE.match(line):
+            flush()
+            quoted = []
+            while i < n and lines[i].strip():
+                q = _QUOTE.match(lines[i])
+                quoted.append(q.group(1) if q else lines[i].strip())
+                i += 1
+            out.append("<blockquote>")
+            _render_blocks(quoted, out, diagram_filename)
+            out.append("</blockquote>")
+            continue
+
+        m = _LIST.match(line)
+        if m and (not para or len(m.group(1)) < 4):
+            flush()
+            i = _list(lines, i, out, diagram_filename)
+            continue
+
+        if not para and line.startswith("    "):
+            # Indented code block: runs until a non-blank line with less indentation
+            body = []
+            while i < n and (lines[i].startswith("    ") or not lines[i].strip()):
+                body.append(lines[i][4:])
+                i += 1
+            while body and not body[-1].strip():
+                body.pop()
+            out.append(_code_block(body, "", diagram_filename))
+            continue
+
+        para.append(line)
+        i += 1
+    flush()
+
+
+def _fenced_body(lines: List[str], start: int, fence: str):
+    """Lines inside the fence opened at `start`, and the index after its closing line."""
+    body = []
+    i = start + 1
+    closing = re.compile(r"^ {0,3}" + re.escape(fence[0]) + "{" + str(len(fence)) + r",}\s*$")
+    while i < len(lines):
+        if closing.match(lines[i]):
+            return body, i + 1
+        body.append(lines[i])
+        i += 1
+    return body, i
+
+
+def _code_block(body: List[str], language: str, diagram_filename: Optional[str]) -> str:
+    language = language.lower()
+    if language == "mermaid" and diagram_filename:
+        return (
+            '<ac:image ac:align="center" ac:layout="center">'
+            f'<ri:attachment ri:filename="{escape(diagram_filename)}"/></ac:image>'
+        )
+    text = "\n".join(body).replace("]]>", "]]]]><![CDATA[>")
+    # Confluence's code macro has no mermaid highlighter: show it as plain text
+    param = (
+        f'<ac:parameter ac:name="language">{escape(language)}</ac:parameter>'
+        if language and language != "mermaid" else ""
+    )
+    return (
+        f'<ac:structured-macro ac:name="code">{param}'
+        f"<ac:plain-text-body><![CDATA[{text}]]></ac:plain-text-body></ac:structured-macro>"
+    )
+
+
+def _table(lines: List[str], i: int, out: List[str]) -> int:
+    header = _cells(lines[i])
+    rows = ["<tr>" + "".join(f"<th>{_inline(c)}</th>" for c in header) + "</tr>"]
+    i += 2
+    while i < len(lines) and lines[i].strip() and "|" in lines[i]:
+        cells = _cells(lines[i])
+        cells += [""] * (len(header) - len(cells))
+        rows.append("<tr>" + "".join(f"<td>{_inline(c)}</td>" for c in cells[: max(len(header), 1)]) + "</tr>")
+        i += 1
+    out.append("<table><tbody>" + "".join(rows) + "</tbody></table>")
+    return i
+
+
+def _cells(line: str) -> List[str]:
+    line = line.strip()
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|") and not line.endswith("\\|"):
+        line = line[:-1]
+    return [c.strip().replace("\\|", "|") for c in re.split(r"(?<!\\)\|", line)]
+
+
+def _list(lines: List[str], i: int, out: List[str], diagram_filename: Optional[str]) -> int:
+    """Render the list starting at `i` (items at its indentation, deeper lines nested); returns the next index."""
+    first = _LIST.match(lines[i])
+    base = len(first.group(1))
+    ordered = first.group(2)[0].isdigit()
+    tag = "ol" if ordered else "ul"
+    items = []  # (text lines, nested block lines)
+    n = len(lines)
+    while i < n:
+        line = lines[i]
+        if not line.strip():
+            # A blank line ends the list unless the list (or an item's body) continues after it
+            j = i + 1
+            while j < n and not lines[j].strip():
+                j += 1
+            if j < n and items and (_indent(lines[j]) > base or _same_list(lines[j], base, ordered)):
+                items[-1][1].extend(lines[i:j])
+                i = j
+                continue
+            break
+        m = _LIST.match(line)
+        indent = _indent(line)
+        if m and indent == base:
+            if m.group(2)[0].isdigit() != ordered:
+                break
+            items.append(([m.group(3)], []))
+            i += 1
+            continue
+        if indent > base and items:
+            if items[-1][1] or m or _block_start(line):
+                items[-1][1].append(line)
+            else:
+                items[-1][0].append(line.strip())
+            i += 1
+            continue
+        if m or not items or _block_start(line):
+            break
+        # Lazy continuation of the last item's text
+        items[-1][0].append(line.strip())
+        i += 1
+
+    out.append(f"<{tag}>")
+    for text, nested in items:
+        body = [_paragraph(text)]
+        if nested:
+            child: List[str] = []
+            _render_blocks(_dedent(nested), child, diagram_filename)
+            body.extend(child)
+        out.append("<li>" + "\n".join(body) + "</li>")
+    out.append(f"</{tag}>")
+    return i
+
+
+def _same_list(line: str, base: int, ordered: bool) -> bool:
+    m = _LIST.match(line)
+    return bool(m) and len(m.group(1)) == base and m.group(2)[0].isdigit() == ordered
+
+
+def _block_start(line: str) -> bool:
+    return bool(_HEADING.match(line) or _FENCE.match(line) or _HR.match(line) or _QUOTE.match(line))
+
+
+def _indent(line: str) -> int:
+    return len(line) - len(line.lstrip(" "))
+
+
+def _dedent(lines: List[str]) -> List[str]:
+    width = min((_indent(l) for l in lines if l.strip()), default=0)
+    return [l[width:] for l in lines]
+
+
+def _paragraph(lines: List[str]) -> str:
+    parts = []
+    for k, line in enumerate(lines):
+        text = _inline(line.strip())
+        # Two trailing spaces: hard line break
+        if k < len(lines) - 1 and line.endswith("  "):
+            text += "<br/>"
+        parts.append(text)
+    return "\n".join(parts)
+
+
+def _inline(text: str) -> str:
+    out = []
+    pos = 0
+    for m in _INLINE.finditer(text):
+        out.append(escape(text[pos:m.start()]))
+        pos = m.end()
+        kind = m.lastgroup
+        if m.group("code") is not None:
+            out.append(f"<code>{escape(m.group('code').strip())}</code>")
+        elif kind in ("strong", "strong2"):
+            out.append(f"<strong>{_inline(m.group(kind))}</strong>")
+        elif kind == "del":
+            out.append(f"<del>{_inline(m.group('del'))}</del>")
+        elif kind == "url":
+            out.append(f'<a href="{escape(m.group("url"))}">{_inline(m.group("text"))}</a>')
+        else:
+            out.append(f"<em>{_inline(m.group(kind))}</em>")
+    out.append(escape(text[pos:]))
+    return "".join(out)
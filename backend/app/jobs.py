@@ -0,0 +1,297 @@
+import asyncio
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+from sqlalchemy import or_, select, update
+from .models import AsyncSessionLocal, DialogSession, RequirementDocument, Job
+from .ai.session_logic import AsyncSessionContextStore
+from .ai.generators import generate_brd_markdown
+from .config import JOB_WORKERS, JOB_LEASE_SECONDS, DOCUMENT_STAGE_TIMEOUT, DIAGRAM_STAGE_TIMEOUT
+from .integrations.confluence import generate_diagram_image_with_gemini_async, _generate_diagram_from_description
+from .diagram_store import diagram_hash, load_diagram, save_diagram
+from .integrations.confluence_async import get_async_confluence_client
+from .outbox import enqueue_publish
+from .lease import keep_alive, lease_deadline
+
+logger = logging.getLogger(__name__)
+
+
+async def create_finish_job(db, session_id: str, title: str) -> Job:
+    """Insert a queued finish job; the caller hands its id to JobRunner.submit."""
+    job = Job(id=str(uuid.uuid4()), session_id=session_id, title=title, status="queued")
+    db.add(job)
+    await db.commit()
+    return job
+
+
+class JobRunner:
+    """In-process worker pool that executes finish jobs off the request path.
+
+    Jobs are persisted in the `jobs` table. A running job holds a lease that
+    its worker keeps renewing; queued work and jobs whose lease expired
+    (their process died) are picked up at start and by a periodic sweep, so
+    several worker processes can share the table. Publishing is handed to
+    the outbox dispatcher.
+    """
+
+    def __init__(self, ai, workers: int = JOB_WORKERS, outbox=None):
+        self.ai = ai
+        self.outbox = outbox
+        self.workers = max(1, workers)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        for job_id in await self._recover():
+            self._queue.put_nowait(job_id)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweep()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, job_id: str):
+        self._queue.put_nowait(job_id)
+
+    async def _recover(self, queued_before: Optional[datetime] = None) -> List[str]:
+        """Requeue running jobs whose lease expired; ids of the queued jobs (updated before `queued_before`).
+
+        A queued id may also sit in another process's queue: the atomic claim
+        in run_finish_job lets only one of them run it.
+        """
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(Job)
+                .where(Job.status == "running", or_(Job.lease_until.is_(None), Job.lease_until < now))
+                .values(status="queued", updated_at=now)
+            )
+            await db.commit()
+            q = select(Job.id).where(Job.status == "queued")
+            if queued_before is not None:
+                # updated_at == now: just reclaimed above
+                q = q.where(or_(Job.updated_at < queued_before, Job.updated_at == now))
+            rows = await db.execute(q.order_by(Job.created_at))
+            return list(rows.scalars())
+
+    async def _sweep(self):
+        # Jobs of a worker process that died (and queued jobs it never started)
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 2)
+            try:
+                for job_id in await self._recover(queued_before=datetime.utcnow() - timedelta(seconds=JOB_LEASE_SECONDS)):
+                    self.submit(job_id)
+            except Exception:
+                logger.exception("Finish job sweep failed")
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await run_finish_job(self.ai, job_id, self.outbox)
+            except Exception:
+                logger.exception("Finish job %s crashed", job_id)
+            finally:
+                self._queue.task_done()
+
+
+async def run_finish_job(ai, job_id: str, outbox=None):
+    """(document || diagram) -> outbox for one job, recording each stage in `jobs`."""
+    now = datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        # Atomic claim: another worker (or process) may have taken it already
+        claimed = await db.execute(
+            update(Job)
+            .where(Job.id == job_id, Job.status == "queued")
+            .values(
+                status="running", started_at=now, updated_at=now, lease_until=lease_deadline(), error=None,
+                document_status="pending", diagram_status="pending", publish_status="pending",
+            )
+        )
+        await db.commit()
+        if claimed.rowcount != 1:
+            return
+        job = await db.get(Job, job_id)
+        sid, title = job.session_id, job.title
+        ctx = await AsyncSessionContextStore(db).get(sid)
+        previous = (await db.execute(
+            select(RequirementDocument.content_markdown, RequirementDocument.slots_snapshot)
+            .where(RequirementDocument.session_id == sid)
+        )).first()
+    slots = ctx.slots
+
+    async with keep_alive(lambda: _renew_lease(job_id)):
+        try:
+            # Document and diagram depend only on slots: run them concurrently,
+            # each with its own deadline and fallback, then publish
+            await _set_job(job_id, stage="generate")
+            (content_md, snapshot), (diagram_image, diagram_digest) = await asyncio.gather(
+                _document_stage(ai, job_id, ctx, title, previous),
+                _diagram_stage(job_id, slots),
+            )
+
+            # The document and its Confluence publish commit together; the outbox
+            # dispatcher sends it (with retries) and sets publish_status
+            publish = get_async_confluence_client() is not None
+            await _finish(job_id, sid, title, content_md, snapshot, diagram_image, diagram_digest, publish)
+            if publish and outbox is not None:
+                outbox.wake()
+        except Exception as exc:
+            logger.exception("Finish job %s failed", job_id)
+            await _set_job(job_id, status="failed", error=str(exc), finished_at=datetime.utcnow())
+
+
+async def _document_stage(ai, job_id: str, ctx, title: str, previous) -> Tuple[str, Optional[str]]:
+    """(Markdown, slots snapshot to store with it); the snapshot is None for the template fallback."""
+    await _set_job(job_id, document_status="running")
+    try:
+        content_md, status = await asyncio.wait_for(
+            _generate_document(ai, ctx.slots, title, previous), timeout=DOCUMENT_STAGE_TIMEOUT
+        )
+    except Exception as exc:
+        logger.warning("Document stage of job %s fell back to template: %r", job_id, exc)
+        content_md, status = None, "fallback"
+    if not content_md:
+        content_md, status = generate_brd_markdown(ctx, title), "fallback"
+    # Only Markdown is stored; HTML is rendered (and cached) when the outbox publishes it
+    await _set_job(job_id, document_status=status)
+    snapshot = json.dumps({"title": title, "slots": ctx.slots}, ensure_ascii=False) if status != "fallback" else None
+    return content_md, snapshot
+
+
+async def _generate_document(ai, slots: dict, title: str, previous) -> Tuple[Optional[str], str]:
+    """Patch the stored document section by section when its snapshot allows, else generate it whole.
+
+    None means the LLM produced nothing; the caller falls back to the template.
+    """
+    if previous is not None and previous.content_markdown and previous.slots_snapshot:
+        snapshot = json.loads(previous.slots_snapshot)
+        content_md = await ai.update_document_from_slots_async(
+            previous.content_markdown, snapshot.get("slots") or {}, snapshot.get("title"), slots, title
+        )
+        if content_md is not None:
+            # reused: nothing changed, no LLM call; incremental: only stale sections regenerated
+            return content_md, "reused" if content_md == previous.content_markdown else "incremental"
+    return await ai.generate_document_from_slots_async(slots, title), "done"
+
+
+async def _diagram_stage(job_id: str, slots: dict) -> Tuple[Optional[bytes], Optional[str]]:
+    """(PNG, its diagram_images hash); the hash is None for a local render, which is not stored."""
+    # Generate diagram description from slots
+    diagram_description = _build_diagram_description(slots)
+    if not diagram_description:
+        await _set_job(job_id, diagram_status="skipped")
+        return None, None
+    # Unchanged slots give the same description: reuse the stored PNG
+    digest = diagram_hash(diagram_description)
+    diagram_image = await load_diagram(digest)
+    if diagram_image:
+        await _set_job(job_id, diagram_status="done")
+        return diagram_image, digest
+    await _set_job(job_id, diagram_status="running")
+    status = "done"
+    try:
+        diagram_image = await asyncio.wait_for(
+            generate_diagram_image_with_gemini_async(diagram_description), timeout=DIAGRAM_STAGE_TIMEOUT
+        )
+    except Exception as exc:
+        logger.warning("Diagram stage of job %s fell back to local rendering: %r", job_id, exc)
+        diagram_image, status = None, "fallback"
+    if not diagram_image:
+        # Gemini is not configured, failed or timed out: draw the description locally
+        diagram_image = await asyncio.to_thread(_generate_diagram_from_description, diagram_description)
+        status = "fallback"
+    if status == "done":
+        # Fallback renders are not stored so the next finish retries Gemini
+        await save_diagram(digest, diagram_image)
+    await _set_job(job_id, diagram_status=status if diagram_image else "failed")
+    return diagram_image, digest if status == "done" else None
+
+
+async def _renew_lease(job_id: str):
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            update(Job).where(Job.id == job_id, Job.status == "running").values(lease_until=lease_deadline())
+        )
+        await db.commit()
+
+
+async def _set_job(job_id: str, **values):
+    values["updated_at"] = datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        await db.execute(update(Job).where(Job.id == job_id).values(**values))
+        await db.commit()
+
+
+async def _finish(
+    job_id: str, sid: str, title: str, content_md: str, snapshot: Optional[str],
+    diagram_image: Optional[bytes], diagram_digest: Optional[str], publish: bool,
+):
+    now = datetime.utcnow()
+    async with AsyncSessionLocal() as db:
+        session = await db.get(DialogSession, sid)
+        if session is None:
+            # Deleted while the job ran (its job row went with it): nothing to store
+            return
+        doc = (await db.execute(select(RequirementDocument).where(RequirementDocument.session_id == sid))).scalar_one_or_none()
+        if not doc:
+            doc = RequirementDocument(session_id=sid)
+            db.add(doc)
+        doc.title = title
+        doc.content_markdown = content_md
+        doc.slots_snapshot = snapshot
+        if publish:
+            await enqueue_publish(db, sid, job_id, diagram_image, diagram_digest)
+        session.finished = True
+        await db.execute(
+            update(Job).where(Job.id == job_id).values(
+                status="done", stage=None, publish_status="queued" if publish else "skipped",
+                finished_at=now, updated_at=now,
+            )
+        )
+        await db.commit()
+
+
+def _build_diagram_description(slots: dict) -> str:
+    """Build description for diagram generation from slots."""
+    parts = []
+
+    if slots.get("title"):
+        parts.append(f"Проект: {slots['title']}")
+    if slots.get("goal"):
+        parts.append(f"Цель: {slots['goal']}")
+    if slots.get("description"):
+        parts.append(f"Описание: {slots['description']}")
+
+    # Add business requirements
+    br = slots.get("business_requirements", [])
+    if br:
+        parts.append(f"Бизнес-требования: {', '.join(br[:3])}")
+
+    # Add functional requirements
+    fr = slots.get("functional_requirements", [])
+    if fr:
+        parts.append(f"Функциональные требования: {', '.join(fr[:3])}")
+
+    # Add use cases flow
+    use_cases = slots.get("use_cases", [])
+    if use_cases:
+        for uc in use_cases[:2]:
+            if isinstance(uc, dict):
+                name = uc.get("name", "")
+                main_flow = uc.get("main_flow", [])
+                if name and main_flow:
+                    parts.append(f"Use Case '{name}': {' -> '.join(main_flow[:5])}")
+
+    # Add KPIs
+    kpis = slots.get("kpi", [])
+    if kpis:
+        parts.append(f"KPI: {', '.join(kpis[:3])}")
+
+    return "\n".join(parts)
@@ -0,0 +1,37 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+from .config import JOB_LEASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def lease_deadline() -> datetime:
+    """`lease_until` for a row claimed (or renewed) now."""
+    return datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)
+
+
+@asynccontextmanager
+async def keep_alive(renew: Callable[[], Awaitable[None]]):
+    """Renew the lease of a claimed row every third of JOB_LEASE_SECONDS while the block runs.
+
+    A row is reclaimed by any worker process only once its lease has
+    expired, i.e. when the process holding it stopped renewing (crashed or
+    was killed); rows held by live workers are left alone.
+    """
+    async def beat():
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                await renew()
+            except Exception as exc:
+                logger.warning("Lease renewal failed: %r", exc)
+
+    task = asyncio.create_task(beat())
+    try:
+        yield
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
@@ -1,79 +1,250 @@
+import asyncio
+import base64
+import json
 import uuid
-from fastapi import FastAPI, Depends
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List, Optional, Tuple
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from markdown2 import Markdown
-from .models import SessionLocal, init_db, DialogSession, Message, RequirementDocument
+from sqlalchemy import select, func, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from .models import AsyncSessionLocal, init_db, DialogSession, Message, RequirementDocument, Job, ConfluenceOutbox
 from .schemas import ChatMessage, ChatReply, FinishRequest, DocumentResponse, HistoryResponse, HistoryItem
-from .schemas import SessionsResponse, SessionItem
+from .schemas import SessionsResponse, SessionItem, JobResponse
 from .ai.model import AIModel
-from .ai.session_logic import SessionContextStore, plan_next_question, extract_slots_from_history
-from .ai.generators import generate_brd_markdown
+from .ai.session_logic import AsyncSessionContextStore, SessionContext, plan_next_question, extract_slots_from_history
+from .ai.context_window import ContextWindow
+from .ai.cache import llm_cache
+from .ai.admission import AdmissionRejected
 from .config import FRONTEND_ORIGIN
-from .integrations.confluence import publish_to_confluence, publish_to_confluence_with_diagram
+from .integrations.confluence import generate_diagram_image_with_gemini_async, _generate_diagram_from_description
+from .integrations.confluence_async import close_async_confluence_client
+from .integrations.confluence_client import close_confluence_client
+from .jobs import JobRunner, create_finish_job, _build_diagram_description
+from .outbox import OutboxDispatcher
+from .diagram_store import get_or_render_diagram, load_diagram
+from .html_cache import html_cache, markdown_hash
+from .singleflight import SingleFlight
 
-init_db()
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Nothing here waits for the LLM: provider init and probing run in the background
+    await asyncio.to_thread(init_db)
+    await ai.start()
+    await outbox.start()
+    await job_runner.start()
+    yield
+    await job_runner.stop()
+    await outbox.stop()
+    await ai.stop()
+    await close_async_confluence_client()
+    close_confluence_client()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[FRONTEND_ORIGIN, "http://localhost:5173", "*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],
 )
 
-def get_db():
-    db = SessionLocal()
-    try:
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected(request: Request, exc: AdmissionRejected):
+    # Быстрый отказ вместо долгого прохода по всем моделям с ошибкой квоты
+    return JSONResponse(
+        status_code=429,
+        content={"detail": exc.reason, "retry_after": exc.retry_after_header},
+        headers={"Retry-After": exc.retry_after_header},
+    )
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 ai = AIModel()
-md = Markdown(extras=["tables", "fenced-code-blocks"])
+outbox = OutboxDispatcher()
+job_runner = JobRunner(ai, outbox=outbox)
+context_window = ContextWindow()
+# Повторные клики "Завершить" / "Сгенерировать диаграмму" ждут уже идущий запрос
+singleflight = SingleFlight()
 
 @app.get("/health")
-def health():
+async def health():
     return {"status": "ok"}
 
+@app.get("/ready")
+async def ready(response: Response):
+    """Готовность к работе: состояние AI-провайдера и каждой модели по последней проверке."""
+    status = ai.readiness()
+    if not status["ready"]:
+        response.status_code = 503
+    return status
+
+@app.get("/ai/router")
+async def ai_router_state():
+    """Состояние маршрутизатора моделей: порядок попыток, задержка, доля ошибок, circuit breaker."""
+    return ai.router.snapshot()
+
+@app.get("/ai/admission")
+async def ai_admission_state():
+    """Контроль допуска к LLM: занятые слоты, очередь, отказы, токен-бакеты по моделям."""
+    return ai.admission.stats()
+
+@app.get("/confluence/outbox")
+async def confluence_outbox_state(db: AsyncSession = Depends(get_db)):
+    """Очередь публикаций в Confluence: строки по статусам, dead-letter и счётчики диспетчера."""
+    rows = await db.execute(select(ConfluenceOutbox.status, func.count()).group_by(ConfluenceOutbox.status))
+    dead = await db.execute(
+        select(ConfluenceOutbox.id, ConfluenceOutbox.session_id, ConfluenceOutbox.attempts,
+               ConfluenceOutbox.last_error, ConfluenceOutbox.updated_at)
+        .where(ConfluenceOutbox.status == "dead")
+        .order_by(ConfluenceOutbox.updated_at.desc())
+        .limit(20)
+    )
+    return {
+        "counts": dict(rows.all()),
+        "dead": [
+            {"id": r.id, "session_id": r.session_id, "attempts": r.attempts,
+             "last_error": r.last_error, "updated_at": r.updated_at}
+            for r in dead
+        ],
+        "dispatcher": outbox.stats(),
+    }
+
+@app.post("/confluence/outbox/{row_id}/retry")
+async def confluence_outbox_retry(row_id: int, db: AsyncSession = Depends(get_db)):
+    """Вернуть публикацию из dead-letter в очередь (попытки считаются заново)."""
+    row = await db.get(ConfluenceOutbox, row_id)
+    if not row or row.status != "dead":
+        raise HTTPException(status_code=404, detail="Dead outbox row not found")
+    row.status, row.attempts, row.next_attempt_at = "pending", 0, datetime.utcnow()
+    await db.commit()
+    outbox.wake()
+    return {"id": row_id, "status": "pending"}
+
+@app.get("/cache/llm")
+async def llm_cache_stats():
+    """Счётчики кэша LLM-генераций (hit/miss, размер)."""
+    return llm_cache.stats()
+
+@app.get("/cache/html")
+async def html_cache_stats():
+    """Счётчики кэша отрендеренного HTML документов."""
+    return html_cache.stats()
+
 @app.post("/chat/message", response_model=ChatReply)
-def chat_message(payload: ChatMessage, db: Session = Depends(get_db)):
+async def chat_message(payload: ChatMessage, db: AsyncSession = Depends(get_db)):
     """
     Обычный чат с бизнес-аналитиком.
     НЕ публикует в Confluence - только общение и сбор данных.
     Публикация происходит через /chat/finish.
     """
-    session_id = payload.session_id or str(uuid.uuid4())
-    session = db.get(DialogSession, session_id)
+    session_id = await _ensure_session(db, payload.session_id)
+    
+    # Получаем контекст и историю в пределах окна
+    store = AsyncSessionContextStore(db)
+    ctx = await store.get(session_id)
+    history = await _prompt_history(db, session_id, ctx, payload.message)
+    
+    # Получаем ответ от AI и извлекаем слоты
+    reply_text, delta, ready = await ai.reply_and_slots_async(history, payload.message, ctx.slots, summary=ctx.summary, session_id=session_id)
+    reply_text = await _save_turn(db, session_id, ctx, history, payload.message, reply_text, delta)
+    
+    # Возвращаем ответ (finished всегда False в обычном чате)
+    return {"session_id": session_id, "reply": reply_text, "finished": False}
+
+@app.post("/chat/message/stream")
+async def chat_message_stream(payload: ChatMessage, db: AsyncSession = Depends(get_db)):
+    """
+    Тот же чат, что и /chat/message, но ответ отдаётся потоком (Server-Sent Events):
+    - event: start — session_id;
+    - event: chunk — очередной фрагмент reply по мере генерации;
+    - event: done — итоговый reply, delta слотов и finished;
+    - event: error — лимит запросов к моделям исчерпан (detail, retry_after), ход не сохраняется.
+    При переполненной очереди к LLM сразу отвечает 429 с Retry-After.
+    Сообщения и слоты сохраняются только после завершения потока.
+    """
+    session_id = await _ensure_session(db, payload.session_id)
+    ctx = await AsyncSessionContextStore(db).get(session_id)
+    history = await _prompt_history(db, session_id, ctx, payload.message)
+
+    stream = ai.stream_reply_and_slots_async(history, payload.message, ctx.slots, summary=ctx.summary, session_id=session_id)
+    # Ждём слот допуска до начала ответа: при перегрузке клиент получает обычный 429
+    await anext(stream)
+
+    async def events():
+        yield _sse("start", {"session_id": session_id})
+        result = None
+        try:
+            async for kind, data in stream:
+                if kind == "chunk":
+                    yield _sse("chunk", {"text": data})
+                elif kind == "done":
+                    result = data
+        except AdmissionRejected as exc:
+            # Лимит запросов к моделям исчерпан уже после начала потока
+            yield _sse("error", {"detail": exc.reason, "retry_after": exc.retry_after_header})
+            return
+        finally:
+            await stream.aclose()
+        reply_text, delta, ready = result
+        # Dependency-scoped session is already closed once the response starts
+        async with AsyncSessionLocal() as stream_db:
+            reply_text = await _save_turn(stream_db, session_id, ctx, history, payload.message, reply_text, delta)
+        yield _sse("done", {"session_id": session_id, "reply": reply_text, "delta": delta, "finished": False})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _ensure_session(db: AsyncSession, session_id: Optional[str]) -> str:
+    session_id = session_id or str(uuid.uuid4())
+    session = await db.get(DialogSession, session_id)
     if not session:
         session = DialogSession(id=session_id)
         db.add(session)
-        db.commit()
-    
+        await db.commit()
+    return session_id
+
+
+async def _prompt_history(db: AsyncSession, session_id: str, ctx: SessionContext, user_message: str) -> List[Tuple[str, str]]:
+    """Messages not yet folded into ctx.summary, trimmed to the prompt context window."""
+    rows = await db.execute(
+        select(Message.id, Message.sender, Message.text)
+        .where(Message.session_id == session_id, Message.id > ctx.summary_upto_id)
+        .order_by(Message.id.asc())
+    )
+    return context_window.build(ctx, rows.all(), user_message)
+
+
+async def _save_turn(db: AsyncSession, session_id: str, ctx: SessionContext, history: List[Tuple[str, str]], user_message: str, reply_text: str, delta: dict) -> str:
+    """Persist one chat turn: user message, updated slots (and summary) and assistant reply."""
     # Сохраняем сообщение пользователя
-    db.add(Message(session_id=session_id, sender="user", text=payload.message))
-    
-    # Получаем историю и контекст
-    history = [(m.sender, m.text) for m in db.query(Message).filter(Message.session_id == session_id).order_by(Message.timestamp.asc()).all()]
-    store = SessionContextStore(db)
-    ctx = store.get(session_id)
-    
-    # Получаем ответ от AI и извлекаем слоты
-    reply_text, delta, ready = ai.reply_and_slots(history, payload.message, ctx.slots)
+    db.add(Message(session_id=session_id, sender="user", text=user_message))
     
     # Если AI не извлёк слоты, пробуем локально
     if not isinstance(delta, dict) or len(delta.keys()) == 0:
         try:
-            delta = ai._local_extract_slots(payload.message)
+            delta = ai._local_extract_slots(user_message)
         except Exception:
             delta = {}
     
     # Обновляем контекст
+    store = AsyncSessionContextStore(db)
     ctx.update(delta)
     extra = extract_slots_from_history(history)
     if extra:
         ctx.update(extra)
-    store.save(session_id, ctx)
+    await store.save(session_id, ctx)
     
     # Если нет ответа, генерируем следующий вопрос
     if not reply_text:
@@ -81,127 +252,119 @@ def chat_message(payload: ChatMessage, db: Session = Depends(get_db)):
 
     # Сохраняем ответ ассистента
     db.add(Message(session_id=session_id, sender="assistant", text=reply_text))
-    db.commit()
-    
-    # Возвращаем ответ (finished всегда False в обычном чате)
-    return {"session_id": session_id, "reply": reply_text, "finished": False}
+    await db.commit()
+    return reply_text
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 @app.get("/chat/history/{session_id}", response_model=HistoryResponse)
-def get_history(session_id: str, db: Session = Depends(get_db)):
-    items = [HistoryItem(sender=m.sender, text=m.text) for m in db.query(Message).filter(Message.session_id == session_id).order_by(Message.timestamp.asc()).all()]
-    return {"session_id": session_id, "items": items}
+async def get_history(
+    session_id: str,
+    request: Request,
+    response: Response,
+    after_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    История диалога. after_id / since отдают только новые сообщения, limit — размер страницы
+    (has_more сообщает, что есть ещё). ETag строится по id последнего сообщения сессии:
+    при совпадении с If-None-Match возвращается 304 без тела.
+    """
+    last_id = (await db.execute(select(func.max(Message.id)).where(Message.session_id == session_id))).scalar()
+    etag = f'W/"{session_id}:{last_id or 0}"'
+    if etag in _if_none_match(request):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
 
-@app.post("/chat/finish", response_model=DocumentResponse)
-def chat_finish(payload: FinishRequest, db: Session = Depends(get_db)):
-    from .integrations.confluence import generate_diagram_image_with_gemini
-    
+    q = select(Message).where(Message.session_id == session_id)
+    if after_id is not None:
+        q = q.where(Message.id > after_id)
+    if since is not None:
+        q = q.where(Message.timestamp > since)
+    q = q.order_by(Message.id.asc())
+    if limit is not None:
+        q = q.limit(limit + 1)
+    rows = (await db.execute(q)).scalars().all()
+    has_more = limit is not None and len(rows) > limit
+    if has_more:
+        rows = rows[:limit]
+
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    items = [
+        HistoryItem(id=m.id, sender=m.sender, text=m.text, timestamp=m.timestamp.isoformat() if m.timestamp else None)
+        for m in rows
+    ]
+    return {"session_id": session_id, "items": items, "last_id": rows[-1].id if rows else after_id, "has_more": has_more}
+
+
+def _if_none_match(request: Request) -> List[str]:
+    header = request.headers.get("if-none-match") or ""
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+@app.post("/chat/finish", response_model=JobResponse, status_code=202)
+async def chat_finish(payload: FinishRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Ставит генерацию документа в очередь и сразу возвращает job.
+    Документ, диаграмма и публикация выполняются воркерами; прогресс — GET /jobs/{job_id}.
+    Если для сессии уже есть job в очереди или в работе, возвращается он (повторный клик не запускает второй).
+    """
     sid = payload.session_id
     if not sid:
-        last = db.query(DialogSession).order_by(DialogSession.started_at.desc()).first()
+        last = (await db.execute(select(DialogSession).order_by(DialogSession.started_at.desc()).limit(1))).scalar_one_or_none()
         sid = last.id if last else str(uuid.uuid4())
-    session = db.get(DialogSession, sid)
-    if not session:
-        session = DialogSession(id=sid)
-        db.add(session)
-        db.commit()
-    history = [(m.sender, m.text) for m in db.query(Message).filter(Message.session_id == sid).order_by(Message.timestamp.asc()).all()]
+    await _ensure_session(db, sid)
     title = payload.title or "Бизнес-требования"
-    store = SessionContextStore(db)
-    ctx = store.get(sid)
-    slots = ctx.slots
-    
-    # Generate document content
-    content_md = ai.generate_document_from_slots(slots, title)
-    if not content_md:
-        content_md = generate_brd_markdown(ctx, title)
-    try:
-        content_html = md.convert(content_md)
-    except Exception:
-        content_html = md.convert(str(content_md or ""))
-    
-    # Generate diagram description from slots
-    diagram_description = _build_diagram_description(slots)
-    diagram_image = None
-    if diagram_description:
-        diagram_image = generate_diagram_image_with_gemini(diagram_description)
-    
-    # Publish to Confluence with diagram
-    try:
-        url = publish_to_confluence_with_diagram(title, content_html, diagram_image)
-    except Exception:
-        url = None
+    job_id = await singleflight.do(("finish", sid), lambda: _start_finish_job(sid, title))
+    job = await db.get(Job, job_id)
+    return _job_response(job, None)
 
-    doc = db.query(RequirementDocument).filter(RequirementDocument.session_id == sid).one_or_none()
-    if not doc:
-        doc = RequirementDocument(session_id=sid)
-        db.add(doc)
-    doc.title = title
-    doc.content_markdown = content_md
-    doc.content_html = content_html
-    doc.confluence_url = url
-    session.finished = True
-    db.commit()
-    return {"session_id": sid, "title": title, "content_markdown": content_md, "confluence_url": url}
-
-
-def _build_diagram_description(slots: dict) -> str:
-    """Build description for diagram generation from slots."""
-    parts = []
-    
-    if slots.get("title"):
-        parts.append(f"Проект: {slots['title']}")
-    if slots.get("goal"):
-        parts.append(f"Цель: {slots['goal']}")
-    if slots.get("description"):
-        parts.append(f"Описание: {slots['description']}")
-    
-    # Add business requirements
-    br = slots.get("business_requirements", [])
-    if br:
-        parts.append(f"Бизнес-требования: {', '.join(br[:3])}")
-    
-    # Add functional requirements
-    fr = slots.get("functional_requirements", [])
-    if fr:
-        parts.append(f"Функциональные требования: {', '.join(fr[:3])}")
-    
-    # Add use cases flow
-    use_cases = slots.get("use_cases", [])
-    if use_cases:
-        for uc in use_cases[:2]:
-            if isinstance(uc, dict):
-                name = uc.get("name", "")
-                main_flow = uc.get("main_flow", [])
-                if name and main_flow:
-                    parts.append(f"Use Case '{name}': {' -> '.join(main_flow[:5])}")
-    
-    # Add KPIs
-    kpis = slots.get("kpi", [])
-    if kpis:
-        parts.append(f"KPI: {', '.join(kpis[:3])}")
-    
-    return "\n".join(parts)
+async def _start_finish_job(sid: str, title: str) -> str:
+    """Id of the session's active finish job; a new one is queued only if none is queued or running."""
+    async with AsyncSessionLocal() as db:
+        active = (await db.execute(
+            select(Job.id)
+            .where(Job.session_id == sid, Job.status.in_(("queued", "running")))
+            .order_by(Job.created_at.desc())
+            .limit(1)
+        )).scalar_one_or_none()
+        if active:
+            return active
+        job = await create_finish_job(db, sid, title)
+    job_runner.submit(job.id)
+    return job.id
 
-@app.get("/context/{session_id}")
-def get_context(session_id: str, db: Session = Depends(get_db)):
-    store = SessionContextStore(db)
-    ctx = store.get(session_id)
-    return {"session_id": session_id, "slots": ctx.slots}
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str, db: AsyncSession = Depends(get_db)):
+    job = await db.get(Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    doc = None
+    if job.status == "done":
+        doc = (await db.execute(select(RequirementDocument).where(RequirementDocument.session_id == job.session_id))).scalar_one_or_none()
+    return _job_response(job, doc)
 
-@app.get("/sessions", response_model=SessionsResponse)
-def list_sessions(db: Session = Depends(get_db)):
-    sessions = db.query(DialogSession).order_by(DialogSession.started_at.desc()).all()
-    items = []
-    for s in sessions:
-        doc = db.query(RequirementDocument).filter(RequirementDocument.session_id == s.id).one_or_none()
-        items.append(SessionItem(id=s.id, started_at=s.started_at.isoformat(), finished=s.finished, title=(doc.title if doc else None)))
-    return {"items": items}
 
-@app.get("/document/{session_id}", response_model=DocumentResponse)
-def get_document(session_id: str, db: Session = Depends(get_db)):
-    doc = db.query(RequirementDocument).filter(RequirementDocument.session_id == session_id).one_or_none()
-    if not doc:
-        return {"session_id": session_id, "title": "Бизнес-требования", "content_markdown": "", "confluence_url": None}
+def _job_response(job: Job, doc: Optional[RequirementDocument]) -> dict:
+    return {
+        "job_id": job.id,
+        "session_id": job.session_id,
+        "status": job.status,
+        "stage": job.stage,
+        "stages": {
+            "document": job.document_status,
+            "diagram": job.diagram_status,
+            "publish": job.publish_status,
+        },
+        "error": job.error,
+        "document": _document_response(job.session_id, doc) if doc else None,
+    }
+
+
+def _document_response(session_id: str, doc: RequirementDocument) -> dict:
     return {
         "session_id": session_id,
         "title": doc.title or "Бизнес-требования",
@@ -209,65 +372,149 @@ def get_document(session_id: str, db: Session = Depends(get_db)):
         "confluence_url": doc.confluence_url,
     }
 
+@app.get("/context/{session_id}")
+async def get_context(session_id: str, db: AsyncSession = Depends(get_db)):
+    store = AsyncSessionContextStore(db)
+    ctx = await store.get(session_id)
+    return {"session_id": session_id, "slots": ctx.slots}
+
+@app.get("/sessions", response_model=SessionsResponse)
+async def list_sessions(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    finished: Optional[bool] = None,
+    title_prefix: Optional[str] = None,
+    started_from: Optional[datetime] = None,
+    started_to: Optional[datetime] = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Сессии от новых к старым, постранично по курсору (started_at, id).
+    next_cursor из ответа передаётся в cursor следующего запроса; None — страниц больше нет.
+    """
+    q = (
+        select(DialogSession.id, DialogSession.started_at, DialogSession.finished, RequirementDocument.title)
+        .outerjoin(RequirementDocument, RequirementDocument.session_id == DialogSession.id)
+    )
+    if finished is not None:
+        q = q.where(DialogSession.finished == finished)
+    if title_prefix:
+        escaped = title_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        q = q.where(RequirementDocument.title.like(f"{escaped}%", escape="\\"))
+    if started_from:
+        q = q.where(DialogSession.started_at >= started_from)
+    if started_to:
+        q = q.where(DialogSession.started_at < started_to)
+    if cursor:
+        after_at, after_id = _decode_cursor(cursor)
+        q = q.where(or_(
+            DialogSession.started_at < after_at,
+            and_(DialogSession.started_at == after_at, DialogSession.id < after_id),
+        ))
+    q = q.order_by(DialogSession.started_at.desc(), DialogSession.id.desc()).limit(limit + 1)
+    rows = (await db.execute(q)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(rows[-1].started_at, rows[-1].id)
+    items = [
+        SessionItem(id=r.id, started_at=r.started_at.isoformat(), finished=bool(r.finished), title=r.title)
+        for r in rows
+    ]
+    return {"items": items, "next_cursor": next_cursor}
+
+
+def _encode_cursor(started_at: datetime, session_id: str) -> str:
+    raw = json.dumps([started_at.isoformat(), session_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        started_at, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(started_at), str(session_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/document/{session_id}", response_model=DocumentResponse)
+async def get_document(session_id: str, db: AsyncSession = Depends(get_db)):
+    doc = (await db.execute(select(RequirementDocument).where(RequirementDocument.session_id == session_id))).scalar_one_or_none()
+    if not doc:
+        return {"session_id": session_id, "title": "Бизнес-требования", "content_markdown": "", "confluence_url": None}
+    return _document_response(session_id, doc)
+
+@app.get("/document/{session_id}/html")
+async def get_document_html(session_id: str, request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    Документ в storage-формате Confluence. HTML не хранится: рендерится из Markdown по запросу
+    и кэшируется по sha256 Markdown; этот же хэш — ETag, при совпадении с If-None-Match — 304 без рендера.
+    """
+    markdown = (await db.execute(
+        select(RequirementDocument.content_markdown).where(RequirementDocument.session_id == session_id)
+    )).scalar_one_or_none()
+    if markdown is None:
+        raise HTTPException(404, "Document not found")
+    etag = f'"{markdown_hash(markdown)}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in _if_none_match(request):
+        return Response(status_code=304, headers=headers)
+    _, html = await asyncio.to_thread(html_cache.render, markdown)
+    return Response(content=html, media_type="text/html; charset=utf-8", headers=headers)
+
 @app.delete("/sessions/{session_id}")
-def delete_session(session_id: str, db: Session = Depends(get_db)):
-    s = db.get(DialogSession, session_id)
+async def delete_session(session_id: str, db: AsyncSession = Depends(get_db)):
+    s = await db.get(DialogSession, session_id)
     if s:
-        db.delete(s)
-        db.commit()
+        await db.delete(s)
+        await db.commit()
+    ai.forget_session(session_id)
     return {"deleted": True}
 
 
 @app.post("/diagram/generate")
-def generate_diagram(payload: dict, db: Session = Depends(get_db)):
+async def generate_diagram(payload: dict, db: AsyncSession = Depends(get_db)):
     """Generate a process diagram image using Gemini API."""
     session_id = payload.get("session_id")
     if not session_id:
         return {"error": "session_id required", "image_base64": None}
     
-    store = SessionContextStore(db)
-    ctx = store.get(session_id)
-    
-    # Build description for diagram from slots
-    slots = ctx.slots
-    description_parts = []
-    
-    if slots.get("title"):
-        description_parts.append(f"Проект: {slots['title']}")
-    if slots.get("goal"):
-        description_parts.append(f"Цель: {slots['goal']}")
-    if slots.get("description"):
-        description_parts.append(f"Описание: {slots['description']}")
-    
-    # Add use cases flow
-    use_cases = slots.get("use_cases", [])
-    if use_cases:
-        for uc in use_cases:
-            if isinstance(uc, dict):
-                name = uc.get("name", "")
-                main_flow = uc.get("main_flow", [])
-                if name and main_flow:
-                    description_parts.append(f"Use Case '{name}': {' -> '.join(main_flow[:5])}")
-    
-    # Add KPIs if available
-    kpis = slots.get("kpi", [])
-    if kpis:
-        description_parts.append(f"KPI: {', '.join(kpis[:3])}")
+    store = AsyncSessionContextStore(db)
+    ctx = await store.get(session_id)
     
-    if not description_parts:
+    description = _build_diagram_description(ctx.slots)
+    if not description:
         return {"error": "No data to generate diagram", "image_base64": None}
     
-    description = "\n".join(description_parts)
-    
-    # Generate diagram using Gemini
-    from .integrations.confluence import generate_diagram_image_with_gemini
-    import base64
-    
-    image_bytes = generate_diagram_image_with_gemini(description)
+    # Generate diagram using Gemini (or reuse the stored one for the same description);
+    # concurrent requests for the same session share one generation
+    digest, image_bytes, stored = await singleflight.do(
+        ("diagram", session_id),
+        lambda: get_or_render_diagram(description, generate_diagram_image_with_gemini_async, _render_diagram_locally),
+    )
     
     if image_bytes:
         image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-        return {"image_base64": image_base64, "error": None}
+        # A local fallback render is not stored, so it has no URL
+        image_url = f"/diagram/{digest}.png" if stored else None
+        return {"image_base64": image_base64, "image_url": image_url, "error": None}
     
     return {"error": "Failed to generate diagram", "image_base64": None}
 
+
+async def _render_diagram_locally(description: str) -> Optional[bytes]:
+    return await asyncio.to_thread(_generate_diagram_from_description, description)
+
+
+@app.get("/diagram/{diagram_hash}.png")
+async def get_diagram_image(diagram_hash: str, request: Request):
+    """PNG диаграммы по sha256 описания; содержимое по хэшу не меняется, поэтому кэшируется навсегда."""
+    etag = f'"{diagram_hash}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if etag in _if_none_match(request):
+        return Response(status_code=304, headers=headers)
+    image = await load_diagram(diagram_hash)
+    if image is None:
+        raise HTTPException(404, "Diagram not found")
+    return Response(content=image, media_type="image/png", headers=headers)
+
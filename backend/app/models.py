@@ -1,12 +1,30 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, Boolean, ForeignKey, Index, LargeBinary
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from datetime import datetime
-from .config import DATABASE_URL
+from .config import DATABASE_URL, ASYNC_DATABASE_URL
+
+_ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+def _async_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    if "+" in scheme or scheme not in _ASYNC_DRIVERS:
+        return url
+    return f"{_ASYNC_DRIVERS[scheme]}{sep}{rest}"
 
 Base = declarative_base()
 engine = create_engine(DATABASE_URL, echo=False, future=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Request handlers use the async engine; scripts and init_db stay on the sync one
+async_engine = create_async_engine(ASYNC_DATABASE_URL or _async_url(DATABASE_URL), echo=False)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 class DialogSession(Base):
     __tablename__ = "dialog_sessions"
@@ -17,6 +35,13 @@ class DialogSession(Base):
     finished = Column(Boolean, default=False)
     messages = relationship("Message", back_populates="session", cascade="all, delete-orphan")
     document = relationship("RequirementDocument", uselist=False, back_populates="session", cascade="all, delete-orphan")
+    jobs = relationship("Job", cascade="all, delete-orphan")
+    outbox = relationship("ConfluenceOutbox", cascade="all, delete-orphan")
+    __table_args__ = (
+        # Keyset pagination of /sessions: ORDER BY started_at DESC, id DESC
+        Index("ix_dialog_sessions_started_at_id", "started_at", "id"),
+        Index("ix_dialog_sessions_finished_started_at_id", "finished", "started_at", "id"),
+    )
 
 class Message(Base):
     __tablename__ = "messages"
@@ -32,18 +57,102 @@ class RequirementDocument(Base):
     id = Column(Integer, primary_key=True, index=True)
     session_id = Column(String, ForeignKey("dialog_sessions.id"), unique=True)
     title = Column(String)
+    # Only the Markdown is stored; HTML is rendered on demand (app/html_cache.py)
     content_markdown = Column(Text)
-    content_html = Column(Text)
+    # JSON {"title", "slots"} the Markdown was generated from (NULL for template fallbacks):
+    # a re-finish regenerates only the sections whose slots changed since
+    slots_snapshot = Column(Text, nullable=True)
     confluence_url = Column(String)
+    # Last publish: lets a re-finish skip the title search and unchanged writes
+    confluence_page_id = Column(String, nullable=True)
+    confluence_version = Column(Integer, nullable=True)
+    confluence_body_hash = Column(String(64), nullable=True)
+    confluence_attachment_hash = Column(String(64), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     session = relationship("DialogSession", back_populates="document")
+    __table_args__ = (
+        # Title prefix filter of /sessions
+        Index("ix_requirement_documents_title", "title"),
+    )
 
 class SessionContextState(Base):
     __tablename__ = "session_contexts"
     session_id = Column(String, primary_key=True, index=True)
     slots_json = Column(Text)
+    # Rolling summary of messages folded out of the prompt window (ids <= summary_upto_id)
+    summary_text = Column(Text, nullable=True)
+    summary_upto_id = Column(Integer, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class Job(Base):
+    """Background /chat/finish pipeline run; one status column per stage."""
+    __tablename__ = "jobs"
+    id = Column(String, primary_key=True, index=True)
+    # Deleted with the session: by the ORM cascade on DialogSession.jobs, and by the
+    # database too where it enforces foreign keys (tables created before keep no ON DELETE)
+    session_id = Column(String, ForeignKey("dialog_sessions.id", ondelete="CASCADE"), index=True)
+    title = Column(String)
+    status = Column(String, default="queued", index=True)  # queued / running / done / failed
+    stage = Column(String, nullable=True)  # generate (document || diagram) / publish
+    document_status = Column(String, default="pending")  # pending / running / done / incremental / reused / fallback / failed / skipped
+    diagram_status = Column(String, default="pending")
+    publish_status = Column(String, default="pending")  # pending / queued (in confluence_outbox) / done / failed / skipped
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    # Renewed by the worker running the job; an expired lease means the worker died
+    lease_until = Column(DateTime, nullable=True)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class ConfluenceOutbox(Base):
+    """Pending Confluence publish of a session's document, committed together with the document."""
+    __tablename__ = "confluence_outbox"
+    id = Column(Integer, primary_key=True, index=True)
+    # Deleted with the session, like jobs (ORM cascade on DialogSession.outbox)
+    session_id = Column(String, ForeignKey("dialog_sessions.id", ondelete="CASCADE"), index=True)
+    job_id = Column(String, nullable=True)
+    # A stored diagram is referenced by its diagram_images hash; only a local
+    # fallback render (never stored there) travels as bytes
+    diagram_hash = Column(String(64), nullable=True)
+    diagram_image = Column(LargeBinary, nullable=True)
+    status = Column(String, default="pending")  # pending / sending / done / superseded / dead
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    last_error = Column(Text, nullable=True)
+    # Renewed by the process sending the row; an expired lease means it died mid-send
+    lease_until = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    __table_args__ = (
+        # Dispatcher poll: WHERE status = 'pending' AND next_attempt_at <= now ORDER BY next_attempt_at
+        Index("ix_confluence_outbox_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+class DiagramImage(Base):
+    """Rendered process diagram, content-addressed by sha256 of its description."""
+    __tablename__ = "diagram_images"
+    hash = Column(String(64), primary_key=True)
+    image = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
+    # create_all skips tables that already exist, so add indexes declared later explicitly
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
 
+def _add_missing_columns():
+    """Lightweight migration: add (nullable) columns declared after a table was created."""
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"))
@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Set
+from sqlalchemy import or_, select, update
+from .models import AsyncSessionLocal, ConfluenceOutbox, RequirementDocument, Job
+from .config import (
+    OUTBOX_CONCURRENCY,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_BACKOFF,
+    OUTBOX_MAX_BACKOFF,
+    OUTBOX_POLL_INTERVAL,
+    JOB_LEASE_SECONDS,
+)
+from .integrations.confluence_async import sync_confluence_page_async, get_async_confluence_client
+from .integrations.confluence_client import PageState
+from .html_cache import html_cache
+from .diagram_store import load_diagram
+from .ai.brd_document import publish_markdown
+from .lease import keep_alive, lease_deadline
+
+logger = logging.getLogger(__name__)
+
+
+async def enqueue_publish(
+    db, session_id: str, job_id: Optional[str], diagram_image: Optional[bytes], diagram_hash: Optional[str] = None
+):
+    """Add an outbox row to the caller's transaction; it commits together with the document it publishes.
+
+    Older pending rows of the session are superseded: the dispatcher always
+    publishes the document as currently stored, so one send is enough. A
+    diagram stored in diagram_images is passed as `diagram_hash` and loaded
+    at send time; `diagram_image` bytes are kept only for an unstored render.
+    """
+    await db.execute(
+        update(ConfluenceOutbox)
+        .where(ConfluenceOutbox.session_id == session_id, ConfluenceOutbox.status == "pending")
+        .values(status="superseded", diagram_image=None)
+    )
+    db.add(ConfluenceOutbox(
+        session_id=session_id, job_id=job_id,
+        diagram_hash=diagram_hash, diagram_image=None if diagram_hash else diagram_image,
+    ))
+
+
+def _render(markdown: str, with_diagram: bool):
+    return html_cache.render(publish_markdown(markdown, with_diagram))
+
+
+class OutboxDispatcher:
+    """Drains `confluence_outbox` into Confluence in the background.
+
+    At most `concurrency` publishes run at once and rows of one session are
+    never sent in parallel. A failed publish is retried with exponential
+    backoff (with jitter) and dead-lettered after `max_attempts`; dead rows
+    stay in the table until retried by hand. Rows survive restarts, so after
+    an outage the backlog drains at the configured concurrency. A row being
+    sent holds a lease its sender keeps renewing; rows left "sending" by a
+    process that died are requeued once the lease expires.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = OUTBOX_CONCURRENCY,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        backoff: float = OUTBOX_BACKOFF,
+        max_backoff: float = OUTBOX_MAX_BACKOFF,
+        poll_interval: float = OUTBOX_POLL_INTERVAL,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.poll_interval = poll_interval
+        self._wake: Optional[asyncio.Event] = None
+        self._swept_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+        self._sessions: Set[str] = set()
+        self.sent = 0
+        self.failed = 0
+        self.dead = 0
+
+    async def start(self):
+        self._wake = asyncio.Event()
+        await self._recover()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = [t for t in [self._task, *self._sending] if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._sending.clear()
+        self._sessions.clear()
+
+    def wake(self):
+        """New rows were committed: look at the table now instead of at the next poll."""
+        if self._wake is not None:
+            self._wake.set()
+
+    def stats(self) -> dict:
+        return {
+            "sending": len(self._sending),
+            "concurrency": self.concurrency,
+            "sent": self.sent,
+            "failed_attempts": self.failed,
+            "dead_lettered": self.dead,
+        }
+
+    async def _recover(self):
+        # Rows of a sender that stopped renewing its lease; live senders' rows are left alone
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(ConfluenceOutbox)
+                .where(
+                    ConfluenceOutbox.status == "sending",
+                    or_(ConfluenceOutbox.lease_until.is_(None), ConfluenceOutbox.lease_until < now),
+                )
+                .values(status="pending")
+            )
+            await db.commit()
+        self._swept_at = time.monotonic()
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            delay = self.poll_interval
+            try:
+                if time.monotonic() - self._swept_at >= JOB_LEASE_SECONDS / 2:
+                    await self._recover()
+                if get_async_confluence_client() is not None:
+                    delay = await self._dispatch_due()
+            except Exception:
+                logger.exception("Outbox dispatch failed")
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(0.05, delay))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch_due(self) -> float:
+        """Start sends for due rows while slots are free; returns seconds until the next due row."""
+        free = self.concurrency - len(self._sending)
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            rows = await db.execute(
+                select(ConfluenceOutbox.id, ConfluenceOutbox.session_id, ConfluenceOutbox.next_attempt_at)
+                .where(ConfluenceOutbox.status == "pending")
+                .order_by(ConfluenceOutbox.next_attempt_at, ConfluenceOutbox.id)
+                .limit(self.concurrency * 4 + len(self._sessions))
+            )
+            pending = rows.all()
+        delay = self.poll_interval
+        for row_id, session_id, due_at in pending:
+            if due_at is not None and due_at > now:
+                delay = min(delay, (due_at - now).total_seconds())
+                break
+            if free <= 0:
+                break
+            if session_id in self._sessions:
+                continue
+            if not await self._claim(row_id):
+                continue
+            free -= 1
+            self._sessions.add(session_id)
+            task = asyncio.create_task(self._send(row_id, session_id))
+            self._sending.add(task)
+            task.add_done_callback(self._sent)
+        return delay
+
+    def _sent(self, task: asyncio.Task):
+        self._sending.discard(task)
+        # A slot is free: pick up the next due row right away
+        self.wake()
+
+    async def _claim(self, row_id: int) -> bool:
+        async with AsyncSessionLocal() as db:
+            claimed = await db.execute(
+                update(ConfluenceOutbox)
+                .where(ConfluenceOutbox.id == row_id, ConfluenceOutbox.status == "pending")
+                .values(status="sending", updated_at=datetime.utcnow(), lease_until=lease_deadline())
+            )
+            await db.commit()
+            return claimed.rowcount == 1
+
+    async def _send(self, row_id: int, session_id: str):
+        try:
+            async with keep_alive(lambda: self._renew_lease(row_id)):
+                await self._publish(row_id, session_id)
+        finally:
+            self._sessions.discard(session_id)
+
+    async def _renew_lease(self, row_id: int):
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(ConfluenceOutbox)
+                .where(ConfluenceOutbox.id == row_id, ConfluenceOutbox.status == "sending")
+                .values(lease_until=lease_deadline())
+            )
+            await db.commit()
+
+    async def _publish(self, row_id: int, session_id: str):
+        async with AsyncSessionLocal() as db:
+            row = await db.get(ConfluenceOutbox, row_id)
+            doc = (await db.execute(
+                select(RequirementDocument).where(RequirementDocument.session_id == session_id)
+            )).scalar_one_or_none()
+            if row is None:
+                # The session was deleted while the row waited or was being claimed
+                return
+            if doc is None:
+                row.status, row.last_error = "dead", "document not found"
+                await db.commit()
+                return
+            title, markdown, image, known = doc.title, doc.content_markdown, row.diagram_image, PageState.from_document(doc)
+            digest = row.diagram_hash
+        if digest:
+            image = await load_diagram(digest)
+
+        # Parsing and rendering a large document would stall the event loop
+        _, html = await asyncio.to_thread(_render, markdown, image is not None)
+        state, error = None, None
+        try:
+            state = await sync_confluence_page_async(title, html, image, known)
+        except Exception as exc:
+            error = repr(exc)
+        if state is not None and state.url:
+            await self._succeeded(row_id, session_id, state)
+        else:
+            await self._failed(row_id, error or "Confluence publish failed")
+
+    async def _succeeded(self, row_id: int, session_id: str, state: PageState):
+        async with AsyncSessionLocal() as db:
+            row = await db.get(ConfluenceOutbox, row_id)
+            doc = (await db.execute(
+                select(RequirementDocument).where(RequirementDocument.session_id == session_id)
+            )).scalar_one_or_none()
+            if row is None or doc is None:
+                # Session deleted during the send; the page stays, nothing to record it on
+                return
+            state.apply_to(doc)
+            row.status, row.last_error, row.diagram_image = "done", None, None
+            row.attempts = (row.attempts or 0) + 1
+            if row.job_id:
+                await db.execute(update(Job).where(Job.id == row.job_id).values(publish_status="done"))
+            await db.commit()
+        self.sent += 1
+
+    async def _failed(self, row_id: int, error: str):
+        async with AsyncSessionLocal() as db:
+            row = await db.get(ConfluenceOutbox, row_id)
+            if row is None:
+                return
+            row.attempts = (row.attempts or 0) + 1
+            row.last_error = error[:1000]
+            if row.attempts >= self.max_attempts:
+                row.status = "dead"
+                self.dead += 1
+                logger.error("Outbox row %s dead-lettered after %s attempts: %s", row_id, row.attempts, error)
+                if row.job_id:
+                    await db.execute(update(Job).where(Job.id == row.job_id).values(publish_status="failed"))
+            else:
+                row.status = "pending"
+                row.next_attempt_at = datetime.utcnow() + timedelta(seconds=self._backoff(row.attempts))
+            await db.commit()
+        self.failed += 1
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.max_backoff, self.backoff * (2 ** (attempts - 1))) * random.uniform(0.5, 1.0)
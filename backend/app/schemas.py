@@ -21,12 +21,16 @@ class DocumentResponse(BaseModel):
     confluence_url: Optional[str]
 
 class HistoryItem(BaseModel):
+    id: Optional[int] = None
     sender: str
     text: str
+    timestamp: Optional[str] = None
 
 class HistoryResponse(BaseModel):
     session_id: str
     items: List[HistoryItem]
+    last_id: Optional[int] = None
+    has_more: bool = False
 
 class SessionItem(BaseModel):
     id: str
@@ -36,4 +40,18 @@ class SessionItem(BaseModel):
 
 class SessionsResponse(BaseModel):
     items: List[SessionItem]
+    next_cursor: Optional[str] = None
 
+class JobStages(BaseModel):
+    document: str
+    diagram: str
+    publish: str
+
+class JobResponse(BaseModel):
+    job_id: str
+    session_id: str
+    status: str
+    stage: Optional[str] = None
+    stages: JobStages
+    error: Optional[str] = None
+    document: Optional[DocumentResponse] = None
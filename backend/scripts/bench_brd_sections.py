@@ -0,0 +1,212 @@
+"""Microbenchmark: single-pass BrdDocument section patching vs the regex patcher it replaced.
+
+    python scripts/bench_brd_sections.py --sizes 50,100,200 --repeat 5
+
+Generates LLM-style BRD documents of the given sizes (KB): the sections the
+patcher fills (with "—" placeholders) plus many requirement sections with
+subsections, lists and code. Both implementations patch the same document
+from the same slots; reports the median time per document and whether the
+outputs agree (blank-line runs normalized: the regex version leaves extra
+empty lines after replaced blocks).
+"""
+import argparse
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+from app.ai.brd_document import BrdDocument
+from app.ai.generators import _normalize_multiline, default_use_cases, default_user_stories, default_leading_indicators
+
+SLOTS = {
+    "goal": "Сократить время обработки заявок",
+    "description": "Сервис приёма и маршрутизации клиентских заявок",
+    "scope_in": ["Приём заявок", "Маршрутизация", "Отчёты"],
+    "scope_out": ["Изменение процессов отделений"],
+    "kpi": ["Среднее время обработки", "Доля заявок без эскалации"],
+    "business_requirements": ["Заявка регистрируется за 1 минуту"],
+    "functional_requirements": ["API приёма заявок", "Панель оператора"],
+}
+
+_HEAD = """# Бизнес-требования
+
+## 1. Цель проекта
+—
+
+## 2. Описание задачи
+—
+
+## 3. Scope: входит / не входит
+
+**Входит**
+—
+
+**Не входит**
+—
+
+## 4. Бизнес-требования
+- TBD
+
+## 5. Функциональные требования
+—
+
+## 6. KPI и метрики успеха
+—
+"""
+
+_FILLER = """
+## {n}. Требование {n}
+
+Система **должна** обрабатывать сценарий {n} без участия оператора; исключения фиксируются в журнале.
+
+### {n}.1 Критерии приёмки
+- Ответ за 2 секунды для 95% запросов сценария {n}
+- Ошибки валидации возвращаются с кодом и описанием
+- Аудит изменений хранится 5 лет
+
+### {n}.2 Пример запроса
+```json
+{{"scenario": {n}, "priority": "high"}}
+```
+"""
+
+_TAIL = """
+## 90. Сценарии использования (Use Case)
+**Основной сценарий**
+—
+
+**Альтернативы**
+—
+
+## 91. Пользовательские истории (User Stories)
+—
+
+## 92. Leading Indicators
+—
+"""
+
+
+def build_document(kb: int) -> str:
+    parts, size, n = [_HEAD], len(_HEAD.encode("utf-8")) + len(_TAIL.encode("utf-8")), 7
+    while size < kb * 1024:
+        part = _FILLER.format(n=n)
+        parts.append(part)
+        size += len(part.encode("utf-8"))
+        n += 1
+    parts.append(_TAIL)
+    return "".join(parts)
+
+
+def legacy_fill(text: str, slots: dict, title: str) -> str:
+    """The regex patcher BrdDocument.fill_from_slots replaced (AIModel._fill_missing_sections), kept as the baseline."""
+    s = text
+    goal = (slots.get("goal") or "TBD").strip()
+    description = (slots.get("description") or "TBD").strip()
+    scope_in = _normalize_multiline(slots.get("scope_in"))
+    scope_out = _normalize_multiline(slots.get("scope_out"))
+    kpi = slots.get("kpi") or []
+    use_cases = slots.get("use_cases") or default_use_cases(type("Ctx", (), {"slots": slots})())
+    user_stories = slots.get("user_stories") or default_user_stories(type("Ctx", (), {"slots": slots})())
+    leading = slots.get("leading_indicators") or default_leading_indicators(type("Ctx", (), {"slots": slots})())
+    br = slots.get("business_requirements") or []
+    fr = slots.get("functional_requirements") or []
+
+    def repl_single(header_pattern, value):
+        pattern = re.compile(rf"(##\s*\d*\.?\s*{header_pattern}[^\n]*\n)([\s\S]*?)(?=\n##|$)", re.IGNORECASE)
+        def _r(m):
+            body = m.group(2).strip()
+            if body in ("—", "-", "", "— "):
+                return m.group(1) + value + "\n"
+            return m.group(0)
+        return pattern.sub(_r, s)
+
+    s = repl_single("Цель проекта", goal)
+    s = repl_single("Описание задачи", description)
+
+    scope_pattern = re.compile(r"(##\s*\d*\.?\s*Scope[\s\S]*?)(?=\n##|$)", re.IGNORECASE)
+    def fix_scope(m):
+        block = m.group(1)
+        def fmt_list(items):
+            return "\n".join([f"- {x}" for x in items]) if items else "- TBD"
+        block = re.sub(r"\*\*Входит\*\*[\s\S]*?(?=\n\*\*|$)", lambda mm: "**Входит**\n" + fmt_list(scope_in) + "\n", block)
+        block = re.sub(r"\*\*Не входит\*\*[\s\S]*?(?=\n\*\*|$)", lambda mm: "**Не входит**\n" + fmt_list(scope_out) + "\n", block)
+        return block
+    s = scope_pattern.sub(fix_scope, s)
+
+    def fix_list_section(header, items):
+        pattern = re.compile(rf"(##\s*\d*\.?\s*{header}[^\n]*\n)([\s\S]*?)(?=\n##|$)", re.IGNORECASE)
+        def _r(m):
+            body = m.group(2).strip()
+            if not body or body in ("—", "-", "— ") or re.fullmatch(r"-\s*TBD(\s*\n?)*", body, re.IGNORECASE):
+                return m.group(1) + "\n".join([f"- {x}" for x in items]) + "\n"
+            return m.group(0)
+        return pattern.sub(_r, s)
+
+    s = fix_list_section("KPI", kpi)
+    s = fix_list_section("KPI и метрики успеха", kpi)
+    s = fix_list_section("Бизнес-требования", br)
+    s = fix_list_section("Функциональные требования", fr)
+
+    uc_pattern = re.compile(r"(##\s*\d*\.?\s*Сценарии использования[\s\S]*?)(?=\n##|$)", re.IGNORECASE)
+    def fix_uc(m):
+        block = m.group(1)
+        main = "\n".join([f"{i+1}. {x}" for i, x in enumerate(use_cases)])
+        alt = "- " + (use_cases[1] if len(use_cases) > 1 else "Система уточняет данные при ошибках")
+        block = re.sub(r"\*\*Основной сценарий\*\*[\s\S]*?(?=\n\*\*|$)", "**Основной сценарий**\n" + main + "\n", block)
+        block = re.sub(r"\*\*Альтернативы\*\*[\s\S]*?(?=\n##|$)", "**Альтернативы**\n" + alt + "\n", block)
+        return block
+    s = uc_pattern.sub(fix_uc, s)
+
+    us_pattern = re.compile(r"(##\s*\d*\.?\s*Пользовательские истории[^\n]*\n)([\s\S]*?)(?=\n##|$)", re.IGNORECASE)
+    def fix_us(m):
+        body = "\n".join([f"{i+1}. {x}" for i, x in enumerate(user_stories)])
+        return m.group(1) + body + "\n"
+    s = us_pattern.sub(fix_us, s)
+
+    li_pattern = re.compile(r"(##\s*\d*\.?\s*Leading Indicators[^\n]*\n)([\s\S]*?)(?=\n##|$)", re.IGNORECASE)
+    def fix_li(m):
+        body = "\n".join([f"- {x}" for x in leading])
+        return m.group(1) + body + "\n"
+    s = li_pattern.sub(fix_li, s)
+    return s
+
+
+def single_pass(text: str, slots: dict, title: str) -> str:
+    return BrdDocument.parse(text).fill_from_slots(slots).markdown()
+
+
+def _normalized(text: str) -> str:
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def timed(fill, text: str, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fill(text, SLOTS, "Бизнес-требования")
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="BRD section patching microbenchmark.")
+    parser.add_argument("--sizes", default="50,100,200", help="comma-separated document sizes, KB")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per size (median is reported)")
+    args = parser.parse_args(argv)
+
+    print(f"{'KB':>5} {'sections':>8} {'regex ms':>9} {'parser ms':>10} {'speedup':>8} {'same':>5}")
+    for kb in [int(x) for x in args.sizes.split(",") if x.strip()]:
+        text = build_document(kb)
+        sections = len(BrdDocument.parse(text).sections)
+        legacy = timed(legacy_fill, text, args.repeat)
+        parsed = timed(single_pass, text, args.repeat)
+        same = _normalized(legacy_fill(text, SLOTS, "")) == _normalized(single_pass(text, SLOTS, ""))
+        print(f"{len(text.encode('utf-8')) // 1024:>5} {sections:>8} {legacy * 1000:>9.2f} {parsed * 1000:>10.2f} "
+              f"{legacy / parsed:>7.1f}x {'yes' if same else 'no':>5}", flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""Benchmark publish_to_confluence_with_diagram against the local Confluence stub.
+
+    python scripts/bench_confluence_publish.py --docs 200 --levels 1,4,8,16 --latency 50
+    python scripts/bench_confluence_publish.py --error-rate 0.05 --rate-limit 1200
+    python scripts/bench_confluence_publish.py --client async     # pipelined AsyncConfluenceClient
+
+For every concurrency level `--docs` new documents are published twice:
+the first pass creates the pages, the second updates them (search +
+versioned PUT + attachment update). Reports throughput, latency
+percentiles, requests per publish and the injected 429/5xx the retry policy
+absorbed.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+sys.path.append(str(ROOT / "scripts"))
+from confluence_stub import ConfluenceStub
+
+
+def _percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+_HTML = "<h1>Бизнес-требования</h1>" + "<p>Описание требования.</p>" * 50
+
+
+def run_pass(publish, docs: int, concurrency: int, image: bytes, tag: str):
+    html = _HTML
+
+    def one(i):
+        started = time.perf_counter()
+        url = publish(f"{tag} {i}", html, image)
+        return time.perf_counter() - started, bool(url)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(docs)))
+    elapsed = time.perf_counter() - started
+    latencies = [r[0] for r in results]
+    return elapsed, latencies, sum(1 for r in results if not r[1])
+
+
+def run_pass_async(make_client, docs: int, concurrency: int, image: bytes, tag: str):
+    async def run():
+        # httpx clients are bound to the loop that uses them: one per pass
+        client = make_client()
+        gate = asyncio.Semaphore(concurrency)
+
+        async def one(i):
+            async with gate:
+                started = time.perf_counter()
+                url = await client.publish_with_diagram(f"{tag} {i}", _HTML, image)
+                return time.perf_counter() - started, bool(url)
+
+        try:
+            return await asyncio.gather(*(one(i) for i in range(docs)))
+        finally:
+            await client.aclose()
+
+    started = time.perf_counter()
+    results = asyncio.run(run())
+    elapsed = time.perf_counter() - started
+    return elapsed, [r[0] for r in results], sum(1 for r in results if not r[1])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Confluence publish throughput against the local stub.")
+    parser.add_argument("--docs", type=int, default=100, help="documents per pass (default 100)")
+    parser.add_argument("--levels", default="1,4,8,16", help="comma-separated concurrency levels")
+    parser.add_argument("--latency", type=float, default=30.0, help="stub latency per request, ms")
+    parser.add_argument("--jitter", type=float, default=10.0, help="stub latency jitter, ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="stub share of 5xx answers")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="stub requests per minute before 429")
+    parser.add_argument("--image-kb", type=int, default=60, help="diagram attachment size, KB")
+    parser.add_argument("--client", choices=["sync", "async"], default="sync",
+                        help="sync: publish_to_confluence_with_diagram; async: AsyncConfluenceClient")
+    args = parser.parse_args(argv)
+
+    stub = ConfluenceStub(latency_ms=args.latency, jitter_ms=args.jitter,
+                          error_rate=args.error_rate, rate_limit_rpm=args.rate_limit).start()
+    # The integration reads its settings at import time
+    os.environ.update(
+        CONFLUENCE_URL=stub.url,
+        CONFLUENCE_EMAIL="bench@example.com",
+        CONFLUENCE_API_TOKEN="bench",
+        CONFLUENCE_SPACE_KEY="BENCH",
+    )
+    os.environ.pop("CONFLUENCE_PARENT_PAGE_ID", None)
+    levels = [int(x) for x in args.levels.split(",") if x.strip()]
+    os.environ.setdefault("CONFLUENCE_POOL_SIZE", str(max(levels)))
+    from app.integrations.confluence import publish_to_confluence_with_diagram
+    from app.integrations.confluence_client import close_confluence_client
+    from app.integrations.confluence_async import AsyncConfluenceClient
+
+    image = os.urandom(args.image_kb * 1024)
+    print(f"{args.client} client; stub {stub.url}: latency {args.latency}±{args.jitter} ms, errors {args.error_rate:.0%}, "
+          f"rate limit {args.rate_limit or 'off'} rpm; {args.docs} docs/pass, {args.image_kb} KB diagram")
+    print(f"{'conc':>5} {'pass':>7} {'docs/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'req/doc':>8} {'429':>5} {'5xx':>5} {'failed':>6}")
+    try:
+        for level in levels:
+            # Fresh pages per level, one keep-alive pool per level
+            close_confluence_client()
+            tag = f"Bench c{level} {time.time_ns()}"
+            for name in ("create", "update"):
+                before = stub.state.stats()["requests"]
+                if args.client == "async":
+                    def make_client():
+                        # Two connections per publish: the page write and the upload overlap
+                        return AsyncConfluenceClient(stub.url, "bench@example.com", "bench", "BENCH", pool_size=2 * level)
+                    elapsed, latencies, failed = run_pass_async(make_client, args.docs, level, image, tag)
+                else:
+                    elapsed, latencies, failed = run_pass(publish_to_confluence_with_diagram, args.docs, level, image, tag)
+                after = stub.state.stats()["requests"]
+                delta = {k: after.get(k, 0) - before.get(k, 0) for k in after}
+                served = sum(v for k, v in delta.items() if not k.isdigit())
+                errors_5xx = sum(v for k, v in delta.items() if k.isdigit() and k.startswith("5"))
+                print(
+                    f"{level:>5} {name:>7} {args.docs / elapsed:>8.1f} "
+                    f"{statistics.median(latencies) * 1000:>8.0f} {_percentile(latencies, 0.95) * 1000:>8.0f} "
+                    f"{max(latencies) * 1000:>8.0f} {served / args.docs:>8.2f} "
+                    f"{delta.get('429', 0):>5} {errors_5xx:>5} {failed:>6}",
+                    flush=True,
+                )
+    finally:
+        close_confluence_client()
+        stub.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""Benchmark the single-pass storage renderer against markdown2 + regex rewriting.
+
+    python scripts/bench_storage_renderer.py --sections 10,100,500 --threads 4
+
+For each size a BRD-like document is generated (headings, paragraphs with
+inline markup, nested lists, tables, code and one mermaid block) and rendered
+both ways:
+
+    two-pass:    markdown2 convert -> extract_mermaid_from_html -> replace_mermaid_with_image
+    single-pass: find_mermaid -> render_storage(diagram_filename=...)
+
+Reports the median time per document, Markdown throughput, the same work
+spread over a thread pool (markdown2 gets one instance per thread, it is not
+thread-safe), whether the output parses as XML, which Confluence's storage
+format requires, and whether the mermaid block became the diagram image.
+"""
+import argparse
+import statistics
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+from markdown2 import Markdown
+from app.integrations.confluence import extract_mermaid_from_html, replace_mermaid_with_image
+from app.integrations.confluence_client import DIAGRAM_FILENAME
+from app.integrations.storage_renderer import find_mermaid, render_storage
+
+_SECTION = """## {n}. Раздел {n}
+
+Описание требования {n}: система **должна** фиксировать *каждое* изменение, см. `audit_log` и [регламент](https://example.com/rules/{n}).
+Вторая строка абзаца с ~~устаревшим~~ условием & символами <, >.
+
+- Правило {n}.1
+- Правило {n}.2
+    - Уточнение {n}.2.a
+    - Уточнение {n}.2.b
+- Правило {n}.3
+
+1. Шаг сценария {n}
+2. Шаг сценария {n}
+
+| Метрика | Цель | Срок |
+|---|---|---|
+| KPI {n} | 95% | Q{q} |
+| SLA {n} | 4 ч | Q{q} |
+
+> Примечание аналитика к разделу {n}.
+
+```sql
+SELECT * FROM requests WHERE section = {n};
+```
+"""
+
+_MERMAID = """## Диаграмма процесса
+
+```mermaid
+flowchart LR
+A[Старт] --> B{Данных достаточно?}
+B -->|да| C[Генерация BRD]
+B -->|нет| D[Уточнение]
+```
+"""
+
+
+def build_document(sections: int) -> str:
+    parts = ["# Бизнес-требования\n"]
+    parts += [_SECTION.format(n=n, q=n % 4 + 1) for n in range(1, sections + 1)]
+    parts.append(_MERMAID)
+    return "\n".join(parts)
+
+
+_local = threading.local()
+
+
+def two_pass(markdown: str) -> str:
+    if not hasattr(_local, "md"):
+        _local.md = Markdown(extras=["tables", "fenced-code-blocks"])
+    html = _local.md.convert(markdown)
+    if extract_mermaid_from_html(html):
+        html = replace_mermaid_with_image(html, DIAGRAM_FILENAME)
+    return html
+
+
+def single_pass(markdown: str) -> str:
+    return render_storage(markdown, DIAGRAM_FILENAME if find_mermaid(markdown) else None)
+
+
+def well_formed(storage: str) -> bool:
+    try:
+        ET.fromstring(f'<r xmlns:ac="ac" xmlns:ri="ri">{storage}</r>')
+        return True
+    except ET.ParseError:
+        return False
+
+
+def timed(render, markdown: str, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        render(markdown)
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def threaded(render, markdown: str, docs: int, threads: int) -> float:
+    """Documents per second when `docs` renders share a pool of `threads`."""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda _: render(markdown), range(docs)))
+    return docs / (time.perf_counter() - started)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Markdown -> Confluence storage rendering benchmark.")
+    parser.add_argument("--sections", default="10,100,500", help="comma-separated document sizes, in BRD sections")
+    parser.add_argument("--repeat", type=int, default=5, help="single-thread runs per size (median is reported)")
+    parser.add_argument("--threads", type=int, default=4, help="thread pool size for the throughput run")
+    parser.add_argument("--docs", type=int, default=40, help="documents per throughput run")
+    args = parser.parse_args(argv)
+
+    print(f"{'sections':>8} {'KB':>6} {'renderer':>11} {'ms/doc':>9} {'MB/s':>7} "
+          f"{'docs/s x' + str(args.threads):>11} {'xml ok':>6} {'diagram':>7}")
+    for sections in [int(x) for x in args.sections.split(",") if x.strip()]:
+        markdown = build_document(sections)
+        size = len(markdown.encode("utf-8"))
+        results = {}
+        for name, render in (("two-pass", two_pass), ("single-pass", single_pass)):
+            render(markdown)  # warm-up: regex compilation, markdown2 instance
+            seconds = timed(render, markdown, args.repeat)
+            rate = threaded(render, markdown, args.docs, args.threads)
+            results[name] = seconds
+            storage = render(markdown)
+            print(f"{sections:>8} {size / 1024:>6.0f} {name:>11} {seconds * 1000:>9.2f} "
+                  f"{size / seconds / 1e6:>7.2f} {rate:>11.1f} {'yes' if well_formed(storage) else 'no':>6} "
+                  f"{'yes' if '<ac:image' in storage else 'no':>7}", flush=True)
+        print(f"{'':>8} {'':>6} {'speedup':>11} {results['two-pass'] / results['single-pass']:>8.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
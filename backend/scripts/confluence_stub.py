@@ -0,0 +1,330 @@
+"""Local stand-in for the Confluence REST API subset the integration uses.
+
+    python scripts/confluence_stub.py --port 8090 --latency 80 --error-rate 0.05 --rate-limit 300
+
+then point the backend at it with CONFLUENCE_URL=http://127.0.0.1:8090 (any
+email / token / space key). Implemented endpoints:
+
+    GET  /rest/api/content?title=&spaceKey=           search by title (expand=children.attachment supported)
+    GET  /rest/api/content/{id}                        page with version
+    POST /rest/api/content                             create (400 on duplicate title)
+    PUT  /rest/api/content/{id}                        update (409 unless version = current + 1)
+    GET  /rest/api/content/{id}/child/attachment       list, ?filename= filter
+    POST /rest/api/content/{id}/child/attachment       create (400 if the name exists)
+    POST /rest/api/content/{id}/child/attachment/{att}/data   update data
+    GET  /__stats                                      request counters (not part of Confluence)
+
+State is in memory. Latency, 5xx errors and 429 rate limiting are injected
+per request; see --help.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+_CONTENT = re.compile(r"^/rest/api/content(?:/(\d+))?$")
+_ATTACHMENTS = re.compile(r"^/rest/api/content/(\d+)/child/attachment(?:/(att\d+)/data)?$")
+_FILENAME = re.compile(rb'filename="([^"]+)"')
+
+
+class StubState:
+    """Pages, attachments, injection settings and counters, guarded by one lock."""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+                 rate_limit_rpm: float = 0.0, retry_after: int = 1):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rpm = rate_limit_rpm
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.pages = {}  # id -> {"id", "title", "space", "version", "body", "ancestors"}
+        self.attachments = {}  # page id -> {filename: {"id", "size", "version"}}
+        self.next_id = 1000
+        self.counters = {}
+        self._tokens = rate_limit_rpm / 60.0 if rate_limit_rpm else 0.0
+        self._updated = time.monotonic()
+
+    def count(self, key: str):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def new_id(self) -> int:
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def rate_limited(self) -> bool:
+        # Token bucket with one second of burst
+        if not self.rate_limit_rpm:
+            return False
+        rate = self.rate_limit_rpm / 60.0
+        with self.lock:
+            now = time.monotonic()
+            self._tokens = min(max(1.0, rate), self._tokens + (now - self._updated) * rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return False
+            return True
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "pages": len(self.pages),
+                "attachments": sum(len(a) for a in self.attachments.values()),
+                "requests": dict(self.counters),
+            }
+
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately: without this, delayed ACKs add ~40 ms per request
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        # ── plumbing ─────────────────────────────────────────────────
+
+        def _send(self, code: int, body=None, headers: Optional[dict] = None):
+            payload = json.dumps(body if body is not None else {}).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _body(self) -> bytes:
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def _inject(self, op: str) -> bool:
+            """Apply latency / rate limit / errors; True when a response was already sent."""
+            state.count(op)
+            delay = state.latency_ms + random.uniform(-state.jitter_ms, state.jitter_ms)
+            if delay > 0:
+                time.sleep(delay / 1000.0)
+            if state.rate_limited():
+                state.count("429")
+                self._send(429, {"message": "Rate limit exceeded"}, {"Retry-After": str(state.retry_after)})
+                return True
+            if state.error_rate and random.random() < state.error_rate:
+                code = random.choice((500, 502, 503))
+                state.count(str(code))
+                self._send(code, {"message": "Injected error"})
+                return True
+            return False
+
+        def _route(self, method: str):
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            body = self._body() if method in ("POST", "PUT") else b""
+            if method == "GET" and url.path == "/__stats":
+                return self._send(200, state.stats())
+            m = _ATTACHMENTS.match(url.path)
+            if m:
+                page_id, att_id = m.groups()
+                if method == "GET" and not att_id:
+                    return self._list_attachments(page_id, query)
+                if method == "POST":
+                    return self._save_attachment(page_id, att_id, body)
+            m = _CONTENT.match(url.path)
+            if m:
+                page_id = m.group(1)
+                if method == "GET":
+                    return self._get_page(page_id, query) if page_id else self._search(query)
+                if method == "POST" and not page_id:
+                    return self._create(body)
+                if method == "PUT" and page_id:
+                    return self._update(page_id, body)
+            self._send(404, {"message": f"No stub for {method} {url.path}"})
+
+        def do_GET(self):
+            self._route("GET")
+
+        def do_POST(self):
+            self._route("POST")
+
+        def do_PUT(self):
+            self._route("PUT")
+
+        # ── content ──────────────────────────────────────────────────
+
+        def _page_json(self, page: dict, expand: str = "") -> dict:
+            js = {
+                "id": page["id"],
+                "type": "page",
+                "title": page["title"],
+                "space": {"key": page["space"]},
+                "version": {"number": page["version"]},
+                "_links": {"webui": f"/spaces/{page['space']}/pages/{page['id']}"},
+            }
+            if "children.attachment" in expand:
+                items = state.attachments.get(page["id"], {})
+                results = [{"id": a["id"], "title": name} for name, a in items.items()]
+                js["children"] = {"attachment": {"results": results, "size": len(results)}}
+            return js
+
+        def _search(self, query: dict):
+            if self._inject("search"):
+                return
+            with state.lock:
+                found = [
+                    self._page_json(p, query.get("expand", "")) for p in state.pages.values()
+                    if p["title"] == query.get("title") and p["space"] == query.get("spaceKey")
+                ]
+            self._send(200, {"results": found, "size": len(found)})
+
+        def _get_page(self, page_id: str, query: dict):
+            if self._inject("get"):
+                return
+            with state.lock:
+                page = state.pages.get(page_id)
+                js = self._page_json(page, query.get("expand", "")) if page else None
+            if js is None:
+                return self._send(404, {"message": "Page not found"})
+            self._send(200, js)
+
+        def _create(self, body: bytes):
+            if self._inject("create"):
+                return
+            data = json.loads(body or b"{}")
+            title, space = data.get("title"), (data.get("space") or {}).get("key")
+            if not title or not space:
+                return self._send(400, {"message": "title and space are required"})
+            page_id = str(state.new_id())
+            with state.lock:
+                if any(p["title"] == title and p["space"] == space for p in state.pages.values()):
+                    return self._send(400, {"message": "A page with this title already exists"})
+                page = state.pages[page_id] = {
+                    "id": page_id, "title": title, "space": space, "version": 1,
+                    "body": data.get("body", {}).get("storage", {}).get("value", ""),
+                    "ancestors": data.get("ancestors") or [],
+                }
+                js = self._page_json(page)
+            self._send(200, js)
+
+        def _update(self, page_id: str, body: bytes):
+            if self._inject("update"):
+                return
+            data = json.loads(body or b"{}")
+            with state.lock:
+                page = state.pages.get(page_id)
+                if page is None:
+                    return self._send(404, {"message": "Page not found"})
+                version = (data.get("version") or {}).get("number")
+                if version != page["version"] + 1:
+                    return self._send(409, {"message": f"Version must be {page['version'] + 1}"})
+                page.update(version=version, title=data.get("title", page["title"]),
+                            body=data.get("body", {}).get("storage", {}).get("value", ""))
+                js = self._page_json(page)
+            self._send(200, js)
+
+        # ── attachments ──────────────────────────────────────────────
+
+        def _list_attachments(self, page_id: str, query: dict):
+            if self._inject("attachment_list"):
+                return
+            with state.lock:
+                if page_id not in state.pages:
+                    return self._send(404, {"message": "Page not found"})
+                items = state.attachments.get(page_id, {})
+                name = query.get("filename")
+                results = [
+                    {"id": att["id"], "title": filename, "version": {"number": att["version"]}}
+                    for filename, att in items.items() if name is None or filename == name
+                ]
+            self._send(200, {"results": results, "size": len(results)})
+
+        def _save_attachment(self, page_id: str, att_id: Optional[str], body: bytes):
+            if self._inject("attachment_update" if att_id else "attachment_create"):
+                return
+            if self.headers.get("X-Atlassian-Token") != "nocheck":
+                return self._send(403, {"message": "XSRF check failed"})
+            m = _FILENAME.search(body)
+            if not m:
+                return self._send(400, {"message": "multipart file is required"})
+            filename = m.group(1).decode("utf-8", "replace")
+            with state.lock:
+                if page_id not in state.pages:
+                    return self._send(404, {"message": "Page not found"})
+                items = state.attachments.setdefault(page_id, {})
+                if att_id:
+                    att = next((a for a in items.values() if a["id"] == att_id), None)
+                    if att is None:
+                        return self._send(404, {"message": "Attachment not found"})
+                    att.update(size=len(body), version=att["version"] + 1)
+                else:
+                    if filename in items:
+                        return self._send(400, {"message": "Cannot add a new attachment with same file name"})
+                    att = items[filename] = {"id": f"att{state.next_id + 1}", "size": len(body), "version": 1}
+                    state.next_id += 1
+                js = {"results": [{"id": att["id"], "title": filename, "version": {"number": att["version"]}}]}
+            self._send(200, js)
+
+    return Handler
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops SYNs under concurrent benchmarks (1 s retransmit stalls)
+    request_queue_size = 128
+
+
+class ConfluenceStub:
+    """The stub server on a background thread; port 0 picks a free port."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, **injection):
+        self.state = StubState(**injection)
+        self.server = _Server((host, port), make_handler(self.state))
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "ConfluenceStub":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local Confluence REST stand-in.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0, help="added latency per request, ms")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- random latency, ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered 500/502/503")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="requests per minute before 429, 0 = off")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with 429")
+    args = parser.parse_args(argv)
+    stub = ConfluenceStub(
+        args.host, args.port, latency_ms=args.latency, jitter_ms=args.jitter,
+        error_rate=args.error_rate, rate_limit_rpm=args.rate_limit, retry_after=args.retry_after,
+    )
+    print(f"Confluence stub on {stub.url} (stats: {stub.url}/__stats)", flush=True)
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
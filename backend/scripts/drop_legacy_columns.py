@@ -0,0 +1,64 @@
+"""Drop columns the models no longer declare. Irreversible: back up the database first.
+
+    python scripts/drop_legacy_columns.py            # list what would be dropped
+    python scripts/drop_legacy_columns.py --apply    # drop it
+
+The app never drops columns itself: init_db only adds the ones declared
+later, so older code keeps working against the same database until the
+operator runs this once every instance is on the current version.
+"""
+import argparse
+import sys
+from pathlib import Path
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+from app.models import engine
+
+# Columns no longer declared on the models whose data is worth reclaiming
+LEGACY_COLUMNS = [
+    ("requirement_documents", "content_html"),  # rendered on demand from content_markdown
+]
+
+
+def present_columns():
+    insp = inspect(engine)
+    return [
+        (table, column)
+        for table, column in LEGACY_COLUMNS
+        if insp.has_table(table) and column in {c["name"] for c in insp.get_columns(table)}
+    ]
+
+
+def drop_column(table: str, column: str) -> str:
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+        return "dropped"
+    except SQLAlchemyError:
+        # SQLite before 3.35 cannot drop columns: at least free the data
+        with engine.begin() as conn:
+            conn.execute(text(f"UPDATE {table} SET {column} = NULL"))
+        return "cleared (DROP COLUMN not supported)"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Drop columns the models no longer declare.")
+    parser.add_argument("--apply", action="store_true", help="drop them (default: only list)")
+    args = parser.parse_args(argv)
+
+    columns = present_columns()
+    if not columns:
+        print("No legacy columns left.")
+        return 0
+    for table, column in columns:
+        if args.apply:
+            print(f"{table}.{column}: {drop_column(table, column)}")
+        else:
+            print(f"{table}.{column}: would be dropped (run with --apply)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,250 @@
+"""Re-render and republish stored RequirementDocument rows to Confluence.
+
+    python scripts/republish_documents.py --workers 4 --rate 120
+    python scripts/republish_documents.py --resume          # continue after Ctrl+C / crash
+
+Documents are streamed from the DB by id. HTML is rendered from the stored
+Markdown and published through the shared Confluence client, which skips
+pages whose body and diagram did not change. Progress is checkpointed as
+the highest id below which every document is finished.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+from sqlalchemy import func, select
+from app.models import SessionLocal, RequirementDocument, DiagramImage
+from app.ai.session_logic import SessionContextStore
+from app.diagram_store import diagram_hash
+from app.integrations.confluence import _generate_diagram_from_description
+from app.integrations.confluence_client import PageState, get_confluence_client
+from app.html_cache import html_cache
+from app.ai.brd_document import publish_markdown
+from app.jobs import _build_diagram_description
+
+class RateLimiter:
+    """Spaces calls at least 60/rpm seconds apart across all threads (0 = unlimited)."""
+
+    def __init__(self, rpm: float):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next)
+            self._next = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class Checkpoint:
+    """Contiguous watermark of finished ids, persisted atomically as JSON."""
+
+    def __init__(self, path: Path, last_id: int = 0, failed=None):
+        self.path = path
+        self.last_id = last_id
+        self.failed = set(failed or [])
+        self._started = []  # ids in submission order
+        self._finished = set()
+
+    @classmethod
+    def load(cls, path: Path) -> "Checkpoint":
+        if not path.exists():
+            return cls(path)
+        data = json.loads(path.read_text(encoding="utf-8"))
+        return cls(path, data.get("last_id", 0), data.get("failed", []))
+
+    def started(self, doc_id: int):
+        self._started.append(doc_id)
+
+    def finished(self, doc_id: int, ok: bool):
+        self._finished.add(doc_id)
+        if ok:
+            self.failed.discard(doc_id)
+        else:
+            self.failed.add(doc_id)
+        while self._started and self._started[0] in self._finished:
+            self.last_id = self._started.pop(0)
+            self._finished.discard(self.last_id)
+
+    def save(self):
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp.write_text(json.dumps({"last_id": self.last_id, "failed": sorted(self.failed)}), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+def iter_document_ids(after_id: int, batch_size: int, limit: int = 0):
+    """Yield document ids above `after_id` in keyset-paginated batches."""
+    yielded = 0
+    while True:
+        with SessionLocal() as db:
+            ids = db.execute(
+                select(RequirementDocument.id)
+                .where(RequirementDocument.id > after_id)
+                .order_by(RequirementDocument.id)
+                .limit(batch_size)
+            ).scalars().all()
+        for doc_id in ids:
+            yield doc_id
+            yielded += 1
+            if limit and yielded >= limit:
+                return
+        if len(ids) < batch_size:
+            return
+        after_id = ids[-1]
+
+
+def load_diagram(db, session_id: str, mode: str):
+    if mode == "none":
+        return None
+    description = _build_diagram_description(SessionContextStore(db).get(session_id).slots)
+    if not description:
+        return None
+    row = db.get(DiagramImage, diagram_hash(description))
+    if row is not None:
+        return row.image
+    if mode == "local":
+        return _generate_diagram_from_description(description)
+    return None
+
+
+def republish(doc_id: int, client, limiter: RateLimiter, diagrams: str, dry_run: bool) -> str:
+    """Publish one document; returns published / unchanged / failed / empty."""
+    with SessionLocal() as db:
+        doc = db.get(RequirementDocument, doc_id)
+        if doc is None or not doc.content_markdown:
+            return "empty"
+        image = load_diagram(db, doc.session_id, diagrams)
+        _, html = html_cache.render(publish_markdown(doc.content_markdown, image is not None))
+        title, known = doc.title or "Бизнес-требования", PageState.from_document(doc)
+    if dry_run:
+        return "unchanged"
+    limiter.wait()
+    state = client.sync_page(title, html, image, known)
+    if state is None:
+        return "failed"
+    if state is known:
+        return "unchanged"
+    with SessionLocal() as db:
+        doc = db.get(RequirementDocument, doc_id)
+        state.apply_to(doc)
+        db.commit()
+    return "published"
+
+
+class Progress:
+    def __init__(self, total: int, every: float):
+        self.total = total
+        self.every = every
+        self.counts = {"published": 0, "unchanged": 0, "failed": 0, "empty": 0}
+        self.started = time.monotonic()
+        self._last = self.started
+
+    def add(self, outcome: str):
+        self.counts[outcome] += 1
+        now = time.monotonic()
+        if now - self._last >= self.every:
+            self._last = now
+            self.report()
+
+    def report(self, final: bool = False):
+        done = sum(self.counts.values())
+        elapsed = max(1e-9, time.monotonic() - self.started)
+        rate = done / elapsed
+        eta = (self.total - done) / rate if rate and not final else 0
+        counts = " ".join(f"{k}={v}" for k, v in self.counts.items())
+        prefix = "Done" if final else "Progress"
+        print(f"{prefix}: {done}/{self.total} in {elapsed:.1f}s, {rate:.2f} docs/s, ETA {eta:.0f}s | {counts}", flush=True)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Re-render and republish requirement documents to Confluence.")
+    parser.add_argument("--workers", type=int, default=4, help="parallel publishes (default 4)")
+    parser.add_argument("--rate", type=float, default=60, help="max publishes per minute, 0 = unlimited (default 60)")
+    parser.add_argument("--batch-size", type=int, default=100, help="ids fetched per DB query (default 100)")
+    parser.add_argument("--limit", type=int, default=0, help="stop after this many documents")
+    parser.add_argument("--checkpoint", type=Path, default=ROOT / "republish.checkpoint.json")
+    parser.add_argument("--resume", action="store_true", help="continue after the checkpoint's last id")
+    parser.add_argument("--retry-failed", action="store_true", help="with --resume: also redo ids that failed before")
+    parser.add_argument("--diagrams", choices=["stored", "local", "none"], default="stored",
+                        help="stored: reuse saved diagrams; local: render missing ones without Gemini; none: text only")
+    parser.add_argument("--report-every", type=float, default=5.0, help="seconds between progress lines")
+    parser.add_argument("--dry-run", action="store_true", help="render only, do not call Confluence")
+    args = parser.parse_args(argv)
+
+    client = get_confluence_client()
+    if client is None and not args.dry_run:
+        print("Confluence is not configured (CONFLUENCE_URL / EMAIL / API_TOKEN / SPACE_KEY).", file=sys.stderr)
+        return 2
+
+    checkpoint = Checkpoint.load(args.checkpoint) if args.resume else Checkpoint(args.checkpoint)
+    retry_ids = sorted(checkpoint.failed) if args.retry_failed else []
+    with SessionLocal() as db:
+        total = db.execute(
+            select(func.count()).select_from(RequirementDocument).where(RequirementDocument.id > checkpoint.last_id)
+        ).scalar_one()
+    if args.limit:
+        total = min(total, args.limit)
+    total += len(retry_ids)
+    print(f"Republishing {total} documents after id {checkpoint.last_id} with {args.workers} workers", flush=True)
+
+    limiter = RateLimiter(args.rate)
+    progress = Progress(total, args.report_every)
+    workers = max(1, args.workers)
+    pending = {}
+    interrupted = False
+    ids = iter_document_ids(checkpoint.last_id, args.batch_size, args.limit)
+
+    def collect(done):
+        for future in done:
+            doc_id, watermark = pending.pop(future)
+            try:
+                outcome = future.result()
+            except Exception as exc:
+                print(f"Document {doc_id} failed: {exc!r}", file=sys.stderr)
+                outcome = "failed"
+            if watermark:
+                checkpoint.finished(doc_id, outcome != "failed")
+            elif outcome != "failed":
+                checkpoint.failed.discard(doc_id)
+            progress.add(outcome)
+        checkpoint.save()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            # Earlier failures first (outside the watermark), then the stream
+            for doc_id, watermark in [(i, False) for i in retry_ids] + [(i, True) for i in ids]:
+                while len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                if watermark:
+                    checkpoint.started(doc_id)
+                future = pool.submit(republish, doc_id, client, limiter, args.diagrams, args.dry_run)
+                pending[future] = (doc_id, watermark)
+        except KeyboardInterrupt:
+            interrupted = True
+            print("Interrupted: finishing in-flight documents...", file=sys.stderr, flush=True)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    checkpoint.save()
+    progress.report(final=True)
+    print(f"Checkpoint: last_id={checkpoint.last_id}, failed={len(checkpoint.failed)} -> {args.checkpoint}")
+    if interrupted:
+        return 130
+    return 1 if progress.counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+"""Streaming decode of the "reply" field (/chat/message/stream).
+
+    cd backend && python -m pytest -q tests
+"""
+import json
+import sys
+from pathlib import Path
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT))
+from app.ai.model import _ReplyStreamExtractor
+
+
+def _stream(raw: str, cuts) -> str:
+    extractor = _ReplyStreamExtractor()
+    pieces, start = [], 0
+    for cut in list(cuts) + [len(raw)]:
+        pieces.append(extractor.feed(raw[start:cut]))
+        start = cut
+    return "".join(pieces)
+
+
+def test_emoji_split_across_chunks():
+    reply = "Понял 😀 задачу"
+    raw = json.dumps({"reply": reply, "delta": {}})  # ensure_ascii: 😀 -> 😀
+    assert "\\ud83d\\ude00" in raw
+    high = raw.index("\\ud83d")
+    # every cut inside and around the surrogate pair
+    for cut in range(high - 1, high + 14):
+        text = _stream(raw, [cut])
+        assert text == reply, cut
+        text.encode("utf-8")
+
+
+def test_every_chunk_boundary():
+    reply = "Зафиксировал: push и SMS 📱.\n\nКакие \"сроки\"? 🚀 \\ конец"
+    raw = json.dumps({"reply": reply, "corrections": []})
+    for cut in range(len(raw)):
+        assert _stream(raw, [cut]) == reply, cut
+    assert _stream(raw, range(1, len(raw))) == reply
+
+
+def test_unpaired_surrogates_are_replaced():
+    raw = '{"reply": "a\\ud83d b \\ude00c\\ud83d"}'
+    text = _stream(raw, range(1, len(raw)))
+    assert text == "a� b �c�"
+    text.encode("utf-8")
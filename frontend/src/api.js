@@ -9,22 +9,99 @@ export async function sendMessage(sessionId, message) {
   return await r.json()
 }
 
-export async function getHistory(sessionId) {
-  const r = await fetch(`${BASE}/chat/history/${sessionId}`)
+// 429 от бэкенда: очередь к LLM переполнена, повторить можно через Retry-After секунд
+function busyMessage(retryAfter) {
+  return `Сервис перегружен, повторите через ${retryAfter || 'несколько'} с`
+}
+
+// Потоковый вариант sendMessage: onChunk получает фрагменты ответа по мере генерации,
+// промис резолвится итоговым { session_id, reply, delta, finished }.
+export async function sendMessageStream(sessionId, message, { onStart, onChunk } = {}) {
+  const r = await fetch(`${BASE}/chat/message/stream`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json', Accept: 'text/event-stream' },
+    body: JSON.stringify({ session_id: sessionId, message })
+  })
+  if (r.status === 429) throw new Error(busyMessage(r.headers.get('Retry-After')))
+  const reader = r.body.getReader()
+  const decoder = new TextDecoder()
+  let buf = ''
+  let result = null
+  while (true) {
+    const { value, done } = await reader.read()
+    if (done) break
+    buf += decoder.decode(value, { stream: true })
+    let idx
+    while ((idx = buf.indexOf('\n\n')) !== -1) {
+      const raw = buf.slice(0, idx)
+      buf = buf.slice(idx + 2)
+      let event = 'message'
+      let data = ''
+      for (const line of raw.split('\n')) {
+        if (line.startsWith('event:')) event = line.slice(6).trim()
+        else if (line.startsWith('data:')) data += line.slice(5).trim()
+      }
+      const payload = data ? JSON.parse(data) : {}
+      if (event === 'start' && onStart) onStart(payload)
+      else if (event === 'chunk' && onChunk) onChunk(payload.text)
+      else if (event === 'done') result = payload
+      else if (event === 'error') throw new Error(busyMessage(payload.retry_after))
+    }
+  }
+  return result
+}
+
+// params: { after_id, since, limit } — только новые сообщения; ETag/304 обрабатывает HTTP-кэш браузера
+export async function getHistory(sessionId, params = {}) {
+  const qs = new URLSearchParams()
+  for (const [k, v] of Object.entries(params)) {
+    if (v !== undefined && v !== null && v !== '') qs.set(k, v)
+  }
+  const q = qs.toString()
+  const r = await fetch(`${BASE}/chat/history/${sessionId}${q ? `?${q}` : ''}`)
   return await r.json()
 }
 
-export async function finishDialog(sessionId, title) {
+// Завершение выполняется фоновым job: ставим его в очередь и опрашиваем /jobs/{id},
+// пока он не завершится. Публикация в Confluence идёт после него через outbox —
+// ждём и её (не дольше publishTimeoutMs), чтобы в документе был confluence_url.
+// Резолвится итоговым документом.
+export async function finishDialog(sessionId, title, { onProgress, intervalMs = 1500, publishTimeoutMs = 60000 } = {}) {
   const r = await fetch(`${BASE}/chat/finish`, {
     method: 'POST',
     headers: { 'Content-Type': 'application/json' },
     body: JSON.stringify({ session_id: sessionId, title })
   })
+  let job = await r.json()
+  let publishDeadline = null
+  const publishing = () => {
+    if (job.status !== 'done' || !['queued', 'pending'].includes(job.stages?.publish)) return false
+    if (publishDeadline === null) publishDeadline = Date.now() + publishTimeoutMs
+    return Date.now() < publishDeadline
+  }
+  while (job.status === 'queued' || job.status === 'running' || publishing()) {
+    if (onProgress) onProgress(job)
+    await new Promise(res => setTimeout(res, intervalMs))
+    job = await getJob(job.job_id)
+  }
+  if (onProgress) onProgress(job)
+  if (job.status === 'failed') throw new Error(job.error || 'Не удалось сформировать документ')
+  return job.document
+}
+
+export async function getJob(jobId) {
+  const r = await fetch(`${BASE}/jobs/${jobId}`)
   return await r.json()
 }
 
-export async function listSessions() {
-  const r = await fetch(`${BASE}/sessions`)
+// params: { cursor, limit, finished, title_prefix, started_from, started_to }
+export async function listSessions(params = {}) {
+  const qs = new URLSearchParams()
+  for (const [k, v] of Object.entries(params)) {
+    if (v !== undefined && v !== null && v !== '') qs.set(k, v)
+  }
+  const q = qs.toString()
+  const r = await fetch(`${BASE}/sessions${q ? `?${q}` : ''}`)
   return await r.json()
 }
 
@@ -44,6 +121,7 @@ export async function generateDiagram(sessionId) {
     headers: { 'Content-Type': 'application/json' },
     body: JSON.stringify({ session_id: sessionId })
   })
+  if (r.status === 429) return { image_base64: null, error: busyMessage(r.headers.get('Retry-After')) }
   return await r.json()
 }
 
@@ -1,6 +1,6 @@
 import React, { useEffect, useMemo, useRef, useState } from 'react'
 import { useParams, useNavigate } from 'react-router-dom'
-import { sendMessage, finishDialog, getHistory, getDocument, generateDiagram } from '../api.js'
+import { sendMessageStream, finishDialog, getHistory, getDocument, generateDiagram } from '../api.js'
 import ReactMarkdown from 'react-markdown'
 import remarkGfm from 'remark-gfm'
 import mermaid from 'mermaid'
@@ -401,13 +401,30 @@ export default function ChatSession({ newSession }){
   const onSend = async ()=>{
     if (!input.trim()) return
     setLoading(true)
-    const resp = await sendMessage(sessionId, input)
-    setSessionId(resp.session_id)
-    setMessages(m => [...m, { role: 'user', text: input }, { role: 'bot', text: resp.reply }])
+    const text = input
+    setMessages(m => [...m, { role: 'user', text }, { role: 'bot', text: '' }])
     setInput('')
     setHint('')
-    if (newSession && !params.id) navigate(`/session/${resp.session_id}`)
-    setLoading(false)
+    const setBotText = (update) => setMessages(m => {
+      const copy = m.slice()
+      const last = copy[copy.length - 1]
+      copy[copy.length - 1] = { ...last, text: update(last.text) }
+      return copy
+    })
+    try {
+      const resp = await sendMessageStream(sessionId, text, {
+        onChunk: (piece) => setBotText(prev => prev + piece)
+      })
+      setSessionId(resp.session_id)
+      setBotText(() => resp.reply)
+      if (newSession && !params.id) navigate(`/session/${resp.session_id}`)
+    } catch (e) {
+      // Сообщение не сохранено на сервере — возвращаем текст в поле ввода
+      setBotText(() => `⚠️ ${e.message}`)
+      setInput(text)
+    } finally {
+      setLoading(false)
+    }
   }
 
   return (
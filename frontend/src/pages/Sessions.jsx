@@ -4,19 +4,32 @@ import { listSessions, deleteSession } from '../api.js'
 
 export default function Sessions(){
   const [items, setItems] = useState([])
+  const [cursor, setCursor] = useState(null)
   const [loading, setLoading] = useState(false)
-  const load = async ()=>{
+  const [titlePrefix, setTitlePrefix] = useState('')
+  const [finished, setFinished] = useState('')
+  const load = async (after = null)=>{
     setLoading(true)
-    const r = await listSessions()
-    setItems(r.items||[])
+    const r = await listSessions({ cursor: after, title_prefix: titlePrefix.trim(), finished })
+    setItems(prev => after ? [...prev, ...(r.items||[])] : (r.items||[]))
+    setCursor(r.next_cursor || null)
     setLoading(false)
   }
-  useEffect(()=>{ load() },[])
-  const onDelete = async (id)=>{ await deleteSession(id); load() }
+  useEffect(()=>{ load() },[finished])
+  const onDelete = async (id)=>{ await deleteSession(id); setItems(prev => prev.filter(it => it.id !== id)) }
   return (
     <div className="container">
       <h2 style={{margin:'12px 0'}}>Мои сессии</h2>
-      {loading && <div className="skeleton"/>}
+      <div style={{display:'flex',gap:8,marginBottom:12}}>
+        <input value={titlePrefix} onChange={e=>setTitlePrefix(e.target.value)} onKeyDown={e=>{ if (e.key==='Enter') load() }} placeholder="Название начинается с…" style={{flex:1,padding:'8px'}} />
+        <select value={finished} onChange={e=>setFinished(e.target.value)} style={{padding:'8px'}}>
+          <option value="">Все</option>
+          <option value="true">Завершённые</option>
+          <option value="false">Незавершённые</option>
+        </select>
+        <button className="btn secondary" onClick={()=>load()}>Найти</button>
+      </div>
+      {loading && !items.length && <div className="skeleton"/>}
       <div style={{display:'grid',gridTemplateColumns:'repeat(3,1fr)',gap:12}}>
         {items.map(it => (
           <div key={it.id} className="card" style={{animation:'slideUp .25s ease both'}}>
@@ -29,6 +42,11 @@ export default function Sessions(){
           </div>
         ))}
       </div>
+      {cursor && (
+        <div style={{marginTop:12,textAlign:'center'}}>
+          <button className="btn secondary" onClick={()=>load(cursor)} disabled={loading}>{loading ? 'Загрузка...' : 'Показать ещё'}</button>
+        </div>
+      )}
     </div>
   )
 }